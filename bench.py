@@ -0,0 +1,731 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Description:
+    Benchmarks for ip2map.py. A local stand-in for the geo api is started
+    on a free port, so the numbers do not depend on (or hammer) a real provider.
+    The stages read, extract, uniq, validate, lookups, join, aggregate and render are
+    timed on generated workloads and the results are printed as json; saved
+    with --output, they can be compared to a later run with --compare.
+
+Usage:
+    bench.py [options]
+
+    Options:
+      -h, --help            show this help message and exit
+      -n N, --ips=N         number of ip addresses to look up, default: 2000
+      --latency=MS          latency of the stub geo api in milliseconds, default: 5
+      -w N, --workers=N     comma separated worker counts to compare, default: 1,8,32
+      --validate=N          number of ip addresses for the validation benchmark, default: 200000
+      --aggregate=N         number of rows for the aggregation benchmark, default: 200000
+      --join-sizes=N        comma separated row counts for the join benchmark, default: 1000,2000,4000,8000
+      --server-rps=N        requests per second the stub geo api allows in the throttling
+                            benchmark, default: 200
+      --max-rps=N           comma separated --max-rps values to compare in the throttling
+                            benchmark, default: 0,100,190
+      --errors=N            every Nth request of the stub geo api fails (503) in the
+                            error benchmark, default: 10
+      --rows=N              number of rows of the generated csv for the read, extract,
+                            uniq and pipeline benchmarks, default: 100000
+      --dup-ratio=R         share of the rows repeating an earlier ip, default: 0.3
+      --ipv6-ratio=R        share of IPv6 addresses, default: 0.1
+      --extra-columns=N     number of columns next to the ip, default: 2
+      --stages=NAMES        comma separated benchmarks to run, default: all of
+                            ip2loc,provider,throttled,errors,validate,aggregate,join,read,extract,uniq,pipeline
+      --generate=FILE       only write the generated csv to FILE, eg: for a run of ip2map.py
+      -o FILE, --output=FILE
+                            write the results to FILE as well
+      --compare=FILE        add the seconds of the same benchmarks in an earlier --output
+                            and the change to the results
+
+Examples:
+    $ ./bench.py -n 5000 --latency 20 -w 1,16,64
+
+    $ ./bench.py --stages read,uniq,pipeline --rows 1000000 -o before.json
+    $ ./bench.py --stages read,uniq,pipeline --rows 1000000 --compare before.json
+        times the stages on the same million rows before and after a change,
+        "change" is the ratio of the seconds (below 1 is faster)
+
+    $ ./bench.py --stages extract --rows 2000000
+        pulls the ip's out of the workload written as a web server log, all of them, the first
+        field only and gzip compressed, "mb_per_sec" is the throughput
+
+    $ ./bench.py --generate 10M.csv --rows 10000000 --dup-ratio 0.5 --ipv6-ratio 0.2
+        writes a csv of 10 million rows to try ip2map.py on
+"""
+from optparse import OptionParser
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import os, csv, json, time, random, socket, struct, threading, zlib, re, platform, multiprocessing
+
+import ip2map
+
+__author__ = 'Sriram G'
+__version__ = '1'
+__license__ = 'GPLv3'
+
+
+fake_geo = ip2map.fake_geo
+
+LEGACY_BUBBLE = '{"code":"%s" , "name":"%s", "value":%d, "color":"#6c00ff"}'    # a bubble of the html, as main() used to write it
+
+STAGES = ("ip2loc", "provider", "throttled", "errors", "validate", "aggregate", "join", "read", "extract", "uniq", "pipeline")
+
+# what a benchmark measured with, results with the same are compared by --compare
+PARAMS = ("stage", "step", "function", "engine", "provider", "workers", "ips", "rows", "locations",
+          "max_rps", "server_max_rps", "error_every", "dup_ratio", "ipv6_ratio", "extra_columns")
+
+
+class StubGeoServer(ThreadingMixIn, HTTPServer):
+    """
+    local stand-in for the geo api: GET /geoip/<ip> answers with fake_geo(ip)
+    after `latency` seconds, POST /batch with a json list of ip's answers
+    like the ip-api.com batch endpoint. like a free provider it can throttle, answering
+    429 to the requests over `max_rps` in a second, every `spike_every`th
+    request can take `spike` seconds longer and every `error_every`th
+    request can fail with 503
+    """
+    daemon_threads = True
+    request_queue_size = 128
+    latency = 0.0
+
+    def __init__(self, latency=0.0, port=0, max_rps=0, spike_every=0, spike=0.0, error_every=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), StubGeoHandler)
+        self.latency = float(latency)
+        self.max_rps = max_rps
+        self.spike_every = spike_every
+        self.spike = float(spike)
+        self.error_every = error_every
+        self.requests = 0
+        self.throttled = 0
+        self.errors = 0
+        self.second = (0, 0)    # current second, requests in it
+        self.lock = threading.Lock()
+
+    def admit(self):
+        """
+        count a request against the rate limit of the server
+        returns: delay before answering (as float), or the http status to answer instead (as int)
+        """
+        with self.lock:
+            self.requests += 1
+            now = int(time.time())
+            second, count = self.second
+            count = count + 1 if second == now else 1
+            self.second = (now, count)
+            if self.max_rps and count > self.max_rps:
+                self.throttled += 1
+                return 429
+            if self.error_every and self.requests % self.error_every == 0:
+                self.errors += 1
+                return 503
+            if self.spike_every and self.requests % self.spike_every == 0:
+                return self.latency + self.spike
+            return self.latency
+
+    @property
+    def api_url(self):
+        return "http://127.0.0.1:%d/geoip/%%s" % self.server_address[1]
+
+    def start(self):
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+        return self
+
+
+class StubGeoHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # keep-alive
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.answer(lambda: fake_geo(self.path.rsplit('/', 1)[-1]))
+
+    def do_POST(self):
+        ips = json.loads(self.rfile.read(int(self.headers.getheader("Content-Length", 0))))
+        self.answer(lambda: [ip_api_geo(ip) for ip in ips])
+
+    def answer(self, make_body):
+        delay = self.server.admit()
+        if isinstance(delay, int):
+            self.send_response(delay)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if delay > 0:
+            time.sleep(delay)
+        body = json.dumps(make_body())
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def ip_api_geo(ip):
+    """
+    fake_geo(ip) the way the ip-api.com batch endpoint answers
+    returns: geo details (as dict)
+    """
+    g = fake_geo(ip)
+    return {"status": "success", "query": ip, "country": g["country"], "countryCode": g["country_code"],
+            "region": g["region_code"], "regionName": g["region"], "city": g["city"], "zip": g["postal_code"],
+            "lat": g["latitude"], "lon": g["longitude"], "isp": g["isp"], "as": "%s %s" % (g["asn"], g["isp"])}
+
+
+def random_ips(n, seed=42):
+    """
+    generate n random public looking IPv4 addresses
+    returns: ip addresses (as list)
+    """
+    rnd = random.Random(seed)
+    return [socket.inet_ntoa(struct.pack("!I", rnd.randint(0x01000000, 0xdfffffff))) for i in xrange(n)]
+
+
+def _mix(k, seed):
+    """
+    spread the numbers 0, 1, 2, ... over 32 bits, a different k gives a different result
+    returns: int
+    """
+    x = (k * 0x9e3779b1 + seed * 0x85ebca6b) & 0xffffffff
+    x ^= x >> 16
+    x = (x * 0x7feb352d) & 0xffffffff
+    return x ^ (x >> 15)
+
+
+def workload_ip(k, ipv6_ratio=0.0, seed=42):
+    """
+    the k-th distinct ip of a workload, IPv6 for about ipv6_ratio of them
+    returns: ip address (as str)
+    """
+    x = _mix(k, seed)
+    if _mix(k, seed + 1) % 1000 < ipv6_ratio * 1000:
+        return socket.inet_ntop(socket.AF_INET6, struct.pack("!IIQ", 0x20010000 | (x & 0xffff), x, _mix(k, seed + 2)))
+    return socket.inet_ntoa(struct.pack("!I", 0x01000000 + x % 0xde000000))
+
+
+def workload(n, dup_ratio=0.0, ipv6_ratio=0.0, extra_columns=0, seed=42):
+    """
+    generate the n rows of a csv input: an ip, which for about dup_ratio
+    of the rows repeats an ip of an earlier row, and extra_columns columns
+    of text. the same arguments give the same rows
+    returns: header (as list), rows (as generator of lists)
+    """
+    header = ["ip"] + ["col%d" % (i + 1) for i in xrange(extra_columns)]
+    rnd = random.Random(seed)
+
+    def rows():
+        distinct = 0
+        for i in xrange(n):
+            if distinct and rnd.random() < dup_ratio:
+                k = rnd.randrange(distinct)
+            else:
+                k = distinct
+                distinct += 1
+            yield [workload_ip(k, ipv6_ratio, seed)] + ["%s %d" % (name, i) for name in header[1:]]
+
+    return header, rows()
+
+
+def write_workload(fn, n, dup_ratio=0.0, ipv6_ratio=0.0, extra_columns=0, seed=42):
+    """
+    write the rows of workload() to the csv file fn
+    returns: none
+    """
+    header, rows = workload(n, dup_ratio, ipv6_ratio, extra_columns, seed)
+    with open(fn, "wb") as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+def write_log(fn, n, dup_ratio=0.0, ipv6_ratio=0.0, seed=42):
+    """
+    write the ip's of workload() to fn as the access log of a web server,
+    one request per line with the ip in the first field
+    returns: none
+    """
+    header, rows = workload(n, dup_ratio, ipv6_ratio, 0, seed)
+    with open(fn, "wb") as f:
+        for i, row in enumerate(rows):
+            f.write('%s - - [16/Oct/2026:10:%02d:%02d +0000] "GET /items/%d?v=1.2.3 HTTP/1.1" 200 %d "-" '
+                    '"Mozilla/5.0 (X11; Linux x86_64) Firefox/118.0"\n' % (row[0], i / 60 % 60, i % 60, i, i % 5000))
+
+
+def timed(fn, *args, **kwargs):
+    """
+    call fn and measure the wall time
+    returns: seconds (as float), result of fn
+    """
+    start = time.time()
+    result = fn(*args, **kwargs)
+    return time.time() - start, result
+
+
+def bench_ip2loc(ips, workers_list, server):
+    """
+    look up the same ip's with a different number of workers
+    returns: results (as list of dicts)
+    """
+    ip2map.API_URL = server.api_url
+    results = []
+    for workers in workers_list:
+        server.requests = 0
+        secs, rows = timed(ip2map.ip2loc, ips, workers)
+        assert [r[0] for r in rows] == ips, "results out of order"
+        results.append({"stage": "ip2loc", "workers": workers, "ips": len(ips), "seconds": round(secs, 4),
+                        "ips_per_sec": round(len(ips) / secs, 1), "requests": server.requests})
+    return results
+
+
+def bench_throttled(ips, workers, server, rates):
+    """
+    look up the ip's at a server that throttles and has latency spikes,
+    once for each --max-rps in rates (0 is unlimited), to see which rate
+    gets the most ip's through without being refused
+    returns: results (as list of dicts)
+    """
+    ip2map.API_URL = server.api_url
+    results = []
+    for rate in rates:
+        server.requests = server.throttled = 0
+        client = ip2map.GeoClient(ip2map.geo_session(workers), workers, max_rps=rate, timeout=2)
+        secs, rows = timed(ip2map.ip2loc, ips, workers, client=client)
+        results.append({"stage": "throttled", "max_rps": rate, "server_max_rps": server.max_rps, "workers": workers,
+                        "ips": len(ips), "found": len(rows), "seconds": round(secs, 4),
+                        "ips_per_sec": round(len(rows) / secs, 1), "requests": server.requests,
+                        "throttled": server.throttled, "retried": client.retried})
+    return results
+
+
+def bench_errors(ips, workers, server):
+    """
+    look up the ip's at a server that fails every server.error_every-th
+    request, to see what the retries cost and that no ip is lost
+    returns: results (as list of dicts)
+    """
+    server.requests = server.errors = 0
+    client = ip2map.GeoClient(ip2map.geo_session(workers), workers, timeout=2,
+                              breaker=ip2map.CircuitBreaker(len(ips)), provider=ip2map.TelizeProvider(server.api_url))
+    secs, rows = timed(ip2map.ip2loc, ips, workers, client=client)
+    return [{"stage": "errors", "error_every": server.error_every, "workers": workers, "ips": len(ips),
+             "found": len(rows), "seconds": round(secs, 4), "ips_per_sec": round(len(rows) / secs, 1),
+             "requests": server.requests, "errors": server.errors, "retried": client.retried}]
+
+
+def bench_providers(ips, workers, server):
+    """
+    look up the same ip's one per request (telize), in batches (ip-api)
+    and with the in-process fake provider
+    returns: results (as list of dicts)
+    """
+    results = []
+    for provider in (ip2map.TelizeProvider(server.api_url), ip2map.IpApiProvider(server.api_url.replace("geoip/%s", "batch")),
+                     ip2map.FakeProvider()):
+        server.requests = 0
+        client = ip2map.GeoClient(ip2map.geo_session(workers), workers, provider=provider)
+        secs, rows = timed(ip2map.ip2loc, ips, workers, client=client)
+        assert [r[0] for r in rows] == ips, "results out of order"
+        results.append({"stage": "provider", "provider": provider.name, "batch_size": provider.batch_size,
+                        "workers": workers, "ips": len(ips), "seconds": round(secs, 4),
+                        "ips_per_sec": round(len(ips) / secs, 1), "requests": server.requests})
+    return results
+
+
+def legacy_is_valid_ip(ip):
+    """
+    is_valid_ip() as it was before normalize_ips(), kept as the reference for bench_validate
+    validates the given IP addresses
+    ip v4 or ipv6 can be passed
+    returns: True if IP detected or False (bool)
+    """
+    def is_valid_ipv4(ip):
+        """
+        validates IPv4 addresses.
+        """
+        pattern = re.compile(r"""
+            ^
+            (?:
+              # Dotted variants:
+              (?:
+                # Decimal 1-255 (no leading 0's)
+                [3-9]\d?|2(?:5[0-5]|[0-4]?\d)?|1\d{0,2}
+              |
+                0x0*[0-9a-f]{1,2}  # Hexadecimal 0x0 - 0xFF (possible leading 0's)
+              |
+                0+[1-3]?[0-7]{0,2} # Octal 0 - 0377 (possible leading 0's)
+              )
+              (?:                  # Repeat 0-3 times, separated by a dot
+                \.
+                (?:
+                  [3-9]\d?|2(?:5[0-5]|[0-4]?\d)?|1\d{0,2}
+                |
+                  0x0*[0-9a-f]{1,2}
+                |
+                  0+[1-3]?[0-7]{0,2}
+                )
+              ){0,3}
+            |
+              0x0*[0-9a-f]{1,8}    # Hexadecimal notation, 0x0 - 0xffffffff
+            |
+              0+[0-3]?[0-7]{0,10}  # Octal notation, 0 - 037777777777
+            |
+              # Decimal notation, 1-4294967295:
+              429496729[0-5]|42949672[0-8]\d|4294967[01]\d\d|429496[0-6]\d{3}|
+              42949[0-5]\d{4}|4294[0-8]\d{5}|429[0-3]\d{6}|42[0-8]\d{7}|
+              4[01]\d{8}|[1-3]\d{0,9}|[4-9]\d{0,8}
+            )
+            $
+        """, re.VERBOSE | re.IGNORECASE)
+        return pattern.match(ip) is not None
+
+
+    def is_valid_ipv6(ip):
+        """
+        validates IPv6 addresses.
+        """
+        pattern = re.compile(r"""
+            ^
+            \s*                         # Leading whitespace
+            (?!.*::.*::)                # Only a single wildcard allowed
+            (?:(?!:)|:(?=:))            # Colon if it would be part of a wildcard
+            (?:                         # Repeat 6 times:
+                [0-9a-f]{0,4}           #   A group of at most four hexadecimal digits
+                (?:(?<=::)|(?<!::):)    #   Colon unless preceded by wildcard
+            ){6}                        #
+            (?:                         # Either
+                [0-9a-f]{0,4}           #   Another group
+                (?:(?<=::)|(?<!::):)    #   Colon unless preceded by wildcard
+                [0-9a-f]{0,4}           #   Last group
+                (?: (?<=::)             #   Colon iff preceded by exactly one colon
+                 |  (?<!:)              #
+                 |  (?<=:) (?<!::) :    #
+                 )                      # OR
+             |                          #   A v4 address with NO leading zeros
+                (?:25[0-4]|2[0-4]\d|1\d\d|[1-9]?\d)
+                (?: \.
+                    (?:25[0-4]|2[0-4]\d|1\d\d|[1-9]?\d)
+                ){3}
+            )
+            \s*                         # Trailing whitespace
+            $
+        """, re.VERBOSE | re.IGNORECASE | re.DOTALL)
+        return pattern.match(ip) is not None
+
+
+    return is_valid_ipv4(ip) or is_valid_ipv6(ip)
+
+
+def mixed_ips(n, seed=7):
+    """
+    generate n ip addresses as they show up in real inputs: mostly IPv4,
+    some IPv6, private ones and garbage
+    returns: ip addresses (as list)
+    """
+    rnd = random.Random(seed)
+    ips = random_ips(n, seed)
+    for i in xrange(0, n, 10):
+        ips[i] = socket.inet_ntop(socket.AF_INET6, struct.pack("!QQ", rnd.getrandbits(64) | (0x2 << 60), rnd.getrandbits(64)))
+    for i in xrange(5, n, 20):
+        ips[i] = "10.%d.%d.%d" % (rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255))
+    for i in xrange(7, n, 50):
+        ips[i] = "not-an-ip-%d" % i
+    return ips
+
+
+def bench_validate(n):
+    """
+    validate the same ip's with the old regex based is_valid_ip and
+    with ip2map.normalize_ips
+    returns: results (as list of dicts)
+    """
+    ips = mixed_ips(n)
+    secs_old, old = timed(lambda: [legacy_is_valid_ip(ip) for ip in ips])
+    secs_new, new = timed(ip2map.normalize_ips, ips)
+    secs_one, _ = timed(lambda: [ip2map.is_valid_ip(ip) for ip in ips])
+    agree = sum(1 for o, r in zip(old, new) if o == (r[3] != ip2map.IP_INVALID))
+    return [{"stage": "validate", "ips": n, "seconds": round(secs_new, 4), "ips_per_sec": round(n / secs_new),
+             "is_valid_ip_seconds": round(secs_one, 4), "legacy_seconds": round(secs_old, 4),
+             "legacy_ips_per_sec": round(n / secs_old), "speedup": round(secs_old / secs_new, 1), "agree": agree}]
+
+
+def bench_aggregate(n, locations=500):
+    """
+    count n enriched rows for the map, with the numpy columns of
+    ip2map.MapStats and with its pure python fallback
+    returns: results (as list of dicts)
+    """
+    rows = [ip2map.geo_row(ip, fake_geo(str(zlib.crc32(ip) % locations))) + ["label"] for ip in random_ips(n)]
+    results = []
+    numpy = ip2map.numpy
+    for name, module in (("python", None), ("numpy", numpy)):
+        if name == "numpy" and numpy is None:
+            continue
+        ip2map.numpy = module
+        stats = ip2map.MapStats(12)
+        secs, _ = timed(ip2map.aggregate, (rows[i:i + ip2map.CHUNK_SIZE] for i in xrange(0, n, ip2map.CHUNK_SIZE)), 12, stats)
+        results.append({"stage": "aggregate", "engine": name, "rows": n, "locations": locations,
+                        "seconds": round(secs, 4), "rows_per_sec": round(n / secs)})
+    ip2map.numpy = numpy
+    return results
+
+
+def legacy_join(processed, data, ip_col_key):
+    """
+    the join of the extra input columns as main() used to do it,
+    kept as the reference for bench_join
+    returns: joined rows (as list)
+    """
+    final_processed = []
+    new_csv_header = []
+    for ip in processed:
+        found = filter(lambda x: x[ip_col_key] == ip[0], data)
+        tmp = []
+        for dicts in found:
+            for k, v in dicts.iteritems():
+                if k not in ip_col_key:
+                    tmp.append(v)
+                    if k not in new_csv_header: new_csv_header.append(k)
+            final_processed.append(ip + tmp)
+    return final_processed
+
+
+def legacy_bubbles(final_processed, latsStats, label_col):
+    """
+    the bubble data as main() used to build it, kept as the reference for bench_join
+    returns: map data (as list of str)
+    """
+    mapData = []
+    for i in latsStats:
+        found = filter(lambda x: x[1] == i[0], final_processed)
+        code = "%s-%s" % (found[0][3], str(found[0][6]).replace("/", ""))
+        mapData.append(LEGACY_BUBBLE % (code, found[0][label_col], i[1]))
+    return mapData
+
+
+def bench_join(sizes):
+    """
+    join the extra input columns and build the bubble data, the old
+    quadratic way and with ip2map.join_columns / ip2map.MapStats,
+    for growing input sizes so the scaling can be compared
+    returns: results (as list of dicts)
+    """
+    results = []
+    for n in sizes:
+        ips = random_ips(n, seed=n)
+        header = ["ip", "label", "desc"]
+        data = [{"ip": ip, "label": "label %d" % i, "desc": "desc %d" % i} for i, ip in enumerate(ips)]
+        processed = [ip2map.geo_row(ip, fake_geo(ip)) for ip in ips]
+        new_csv_header = ip2map.extra_columns(header, "ip")
+
+        def indexed():
+            rows = ip2map.join_columns(processed, data, "ip", new_csv_header)
+            stats = ip2map.MapStats(12)
+            for row in rows:
+                stats.add(row)
+            bubbles = stats.bubbles
+            return rows, [bubbles[lat] + (count,) for lat, count in stats.lats_stats()]
+
+        def legacy():
+            rows = legacy_join(processed, data, "ip")
+            stats = ip2map.MapStats(12)
+            for row in rows:
+                stats.add(row)
+            return rows, legacy_bubbles(rows, stats.lats_stats(), 12)
+
+        secs_new, (rows_new, bubbles_new) = timed(indexed)
+        secs_old, (rows_old, bubbles_old) = timed(legacy)
+        assert rows_new == rows_old, "joined rows differ"
+        assert [LEGACY_BUBBLE % b for b in bubbles_new] == bubbles_old, "bubbles differ"
+        results.append({"stage": "join", "rows": n, "seconds": round(secs_new, 4),
+                        "legacy_seconds": round(secs_old, 4), "speedup": round(secs_old / max(secs_new, 1e-9), 1)})
+    return results
+
+
+def bench_read(fn, workload_params):
+    """
+    read the generated csv fn all at once (read_csv_file) and one row at a time (read_csv_stream)
+    returns: results (as list of dicts)
+    """
+    results = []
+    secs, (header, n_cols, rows) = timed(ip2map.read_csv_file, fn)
+    results.append(dict(workload_params, stage="read", function="read_csv_file", rows=len(rows),
+                        seconds=round(secs, 4), rows_per_sec=round(len(rows) / secs)))
+    secs, n = timed(lambda: sum(1 for row in ip2map.read_csv_stream(fn)[1]))
+    results.append(dict(workload_params, stage="read", function="read_csv_stream", rows=n,
+                        seconds=round(secs, 4), rows_per_sec=round(n / secs)))
+    return results
+
+
+def bench_extract(fn, workload_params):
+    """
+    pull the ip's out of the log fn (written by write_log): all of them, the
+    first field only, and both from a gzip copy of fn
+    returns: results (as list of dicts)
+    """
+    results = []
+    gz_file = fn + ".gz"
+    with open(fn, "rb") as f, open(gz_file, "wb") as gz:
+        gz.write(ip2map.gzip_bytes(f.read()))
+    mb = os.path.getsize(fn) / 1e6
+    try:
+        for name, source, field in (("extract_ips", fn, 0), ("extract_ips --field 1", fn, 1),
+                                    ("extract_ips gzip", gz_file, 0), ("extract_ips gzip --field 1", gz_file, 1)):
+            secs, n = timed(lambda: sum(1 for ip in ip2map.extract_ips(source, field)))
+            results.append(dict(workload_params, stage="extract", function=name, ips=n, mb=round(mb, 1),
+                                seconds=round(secs, 4), mb_per_sec=round(mb / secs)))
+    finally:
+        os.remove(gz_file)
+    return results
+
+
+def bench_uniq(fn, workload_params):
+    """
+    drop the repeated ip's of the generated csv fn with uniq_list and uniq_stream
+    returns: results (as list of dicts)
+    """
+    header, n_cols, rows = ip2map.read_csv_file(fn)
+    results = []
+    for name, fn in (("uniq_list", ip2map.uniq_list), ("uniq_stream", lambda rows, key: list(ip2map.uniq_stream(rows, key)))):
+        secs, unique = timed(fn, rows, "ip")
+        results.append(dict(workload_params, stage="uniq", function=name, rows=len(rows), unique=len(unique),
+                            seconds=round(secs, 4), rows_per_sec=round(len(rows) / secs)))
+    return results
+
+
+def bench_pipeline(fn, workload_params, svg_file="worldHigh.svg"):
+    """
+    take the generated csv fn through the stages of ip2map.py one after
+    the other, with the made up locations of the fake provider: parse
+    (read, validate and drop the repeated ip's), enrich (look up and join
+    the extra columns), aggregate, and render the amMaps html and the svg
+    returns: results (as list of dicts)
+    """
+    results = []
+
+    def step(name, rows, fn, *args):
+        secs, result = timed(fn, *args)
+        results.append(dict(workload_params, stage="pipeline", step=name, rows=rows, seconds=round(secs, 4),
+                            rows_per_sec=round(rows / max(secs, 1e-9))))
+        return result
+
+    data = ip2map.parse(fn)
+    rows = step("parse", workload_params["rows"], list, data.rows)
+    data.rows = iter(rows)
+    enricher = ip2map.Enricher(1, ip2map.GeoClient(provider=ip2map.FakeProvider()))
+    chunks = step("enrich", len(rows), list, ip2map.enrich(data, enricher))
+    stats = step("aggregate", len(rows), ip2map.aggregate, chunks, 12)
+    step("render_html", len(rows), ip2map.render, stats, "html")
+    if os.path.isfile(svg_file):
+        step("render_svg", len(rows), ip2map.render, stats, "svg", "HEAT MAP", "", False, 0, 0, svg_file)
+    return results
+
+
+def compare(results, fn):
+    """
+    add the seconds of the same benchmarks in the earlier results file fn
+    and the change (seconds now / seconds then) to the results
+    returns: none
+    """
+    with open(fn) as f:
+        before = dict((tuple((k, r.get(k)) for k in PARAMS), r) for r in json.load(f))
+    for r in results:
+        old = before.get(tuple((k, r.get(k)) for k in PARAMS))
+        if old is not None and "seconds" in old and "seconds" in r:
+            r["baseline_seconds"] = old["seconds"]
+            r["change"] = round(r["seconds"] / max(old["seconds"], 1e-9), 2)
+
+
+def main():
+    """
+    main function
+    """
+    parser = OptionParser(usage="usage: %prog [options]", version="%prog v1")
+    parser.add_option("-n","--ips", dest="ips",type="int",help="number of ip addresses to look up, default: 2000", metavar="N",default=2000)
+    parser.add_option("--latency", dest="latency",type="float",help="latency of the stub geo api in milliseconds, default: 5", metavar="MS",default=5)
+    parser.add_option("-w","--workers", dest="workers",help="comma separated worker counts to compare, default: 1,8,32", metavar="N",default="1,8,32")
+    parser.add_option("--validate", dest="validate",type="int",help="number of ip addresses for the validation benchmark, default: 200000", metavar="N",default=200000)
+    parser.add_option("--aggregate", dest="aggregate",type="int",help="number of rows for the aggregation benchmark, default: 200000", metavar="N",default=200000)
+    parser.add_option("--join-sizes", dest="join_sizes",help="comma separated row counts for the join benchmark, default: 1000,2000,4000,8000", metavar="N",default="1000,2000,4000,8000")
+    parser.add_option("--server-rps", dest="server_rps",type="int",help="requests per second the stub geo api allows in the throttling benchmark, default: 200", metavar="N",default=200)
+    parser.add_option("--max-rps", dest="max_rps",help="comma separated --max-rps values to compare in the throttling benchmark, default: 0,100,190", metavar="N",default="0,100,190")
+    parser.add_option("--errors", dest="errors",type="int",help="every Nth request of the stub geo api fails (503) in the error benchmark, default: 10", metavar="N",default=10)
+    parser.add_option("--rows", dest="rows",type="int",help="number of rows of the generated csv for the read, extract, uniq and pipeline benchmarks, default: 100000", metavar="N",default=100000)
+    parser.add_option("--dup-ratio", dest="dup_ratio",type="float",help="share of the rows repeating an earlier ip, default: 0.3", metavar="R",default=0.3)
+    parser.add_option("--ipv6-ratio", dest="ipv6_ratio",type="float",help="share of IPv6 addresses, default: 0.1", metavar="R",default=0.1)
+    parser.add_option("--extra-columns", dest="extra_columns",type="int",help="number of columns next to the ip, default: 2", metavar="N",default=2)
+    parser.add_option("--stages", dest="stages",help="comma separated benchmarks to run, default: all of %s" % ",".join(STAGES), metavar="NAMES",default=",".join(STAGES))
+    parser.add_option("--generate", dest="generate",help="only write the generated csv to FILE, eg: for a run of ip2map.py", metavar="FILE",default="")
+    parser.add_option("-o","--output", dest="output",help="write the results to FILE as well", metavar="FILE",default="")
+    parser.add_option("--compare", dest="compare",help="add the seconds of the same benchmarks in an earlier --output and the change to the results", metavar="FILE",default="")
+    (options, args) = parser.parse_args()
+
+    if options.generate:
+        write_workload(options.generate, options.rows, options.dup_ratio, options.ipv6_ratio, options.extra_columns)
+        return
+    stages = options.stages.split(",")
+    for stage in stages:
+        if stage not in STAGES:
+            parser.error("unknown stage %s, use some of %s" % (stage, ",".join(STAGES)))
+
+    results = [{"stage": "meta", "python": platform.python_version(), "machine": platform.machine(),
+                "cpus": multiprocessing.cpu_count(), "numpy": getattr(ip2map.numpy, "__version__", None),
+                "time": time.strftime("%Y-%m-%d %H:%M:%S")}]
+    ips = random_ips(options.ips)
+    if "ip2loc" in stages or "provider" in stages:
+        server = StubGeoServer(options.latency / 1000.0).start()
+        if "ip2loc" in stages:
+            results += bench_ip2loc(ips, [int(w) for w in options.workers.split(",")], server)
+        if "provider" in stages:
+            results += bench_providers(ips, 8, server)
+        server.shutdown()
+    if "throttled" in stages:
+        server = StubGeoServer(options.latency / 1000.0, max_rps=options.server_rps, spike_every=50, spike=0.5).start()
+        results += bench_throttled(ips[:options.server_rps * 3], 16, server, [float(r) for r in options.max_rps.split(",")])
+        server.shutdown()
+    if "errors" in stages:
+        server = StubGeoServer(options.latency / 1000.0, error_every=options.errors).start()
+        results += bench_errors(ips, 8, server)
+        server.shutdown()
+    if "validate" in stages:
+        results += bench_validate(options.validate)
+    if "aggregate" in stages:
+        results += bench_aggregate(options.aggregate)
+    if "join" in stages:
+        results += bench_join([int(n) for n in options.join_sizes.split(",")])
+    if "read" in stages or "uniq" in stages or "pipeline" in stages:
+        workload_params = {"rows": options.rows, "dup_ratio": options.dup_ratio, "ipv6_ratio": options.ipv6_ratio,
+                           "extra_columns": options.extra_columns}
+        fn = "bench_%d.csv" % os.getpid()
+        write_workload(fn, options.rows, options.dup_ratio, options.ipv6_ratio, options.extra_columns)
+        try:
+            if "read" in stages:
+                results += bench_read(fn, workload_params)
+            if "uniq" in stages:
+                results += bench_uniq(fn, workload_params)
+            if "pipeline" in stages:
+                results += bench_pipeline(fn, workload_params)
+        finally:
+            os.remove(fn)
+    if "extract" in stages:
+        workload_params = {"rows": options.rows, "dup_ratio": options.dup_ratio, "ipv6_ratio": options.ipv6_ratio}
+        fn = "bench_%d.log" % os.getpid()
+        write_log(fn, options.rows, options.dup_ratio, options.ipv6_ratio)
+        try:
+            results += bench_extract(fn, workload_params)
+        finally:
+            os.remove(fn)
+    if options.compare:
+        compare(results, options.compare)
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -14,19 +14,25 @@ Description:
 Requirements:
     1) requests (pip install requests OR sudo easy_install requests)
 
-    2) PhantomJS (if you desire to convert the resulting html to SVG/PNG/PDF)
+    2) Pillow (pip install Pillow), optional: the built-in renderer needs it for the PNG map,
+        without it only the SVG map is generated
+
+    3) PhantomJS (only with --renderer phantomjs, to convert the resulting html to PNG)
         for Mac: brew update && brew install phantomjs
         for Windows: https://bitbucket.org/ariya/phantomjs/downloads/phantomjs-1.9.7-windows.zip
         for Linux: sudo yum install fontconfig freetype libfreetype.so.6 libfontconfig.so.1 libstdc++.so.6
                 and then download: https://bitbucket.org/ariya/phantomjs/downloads/phantomjs-1.9.7-linux-x86_64.tar.bz2
                         or 32bit: https://bitbucket.org/ariya/phantomjs/downloads/phantomjs-1.9.7-linux-i686.tar.bz2
 
-    3) AmMaps - provided by http://www.amcharts.com/javascript-maps/
+    4) AmMaps - provided by http://www.amcharts.com/javascript-maps/
         They have both free and paid versions, choose which one you want. The script very well works on free version
-        We just need the ammaps.js, ammaps.css and the worldHigh.svg
+        We just need the ammaps.js, ammaps.css (only with --renderer phantomjs) and the worldHigh.svg
+        The native renderer compiles worldHigh.svg once into worldHigh.svg.geo next to it (rebuilt
+        when the svg changes), so later runs load the country shapes without parsing the svg
 
 Usage:
     ip2map.py <ip_address|file> [options]
+    ip2map.py serve [options]
 
     Options:
       --version             show program's version number and exit
@@ -39,6 +45,76 @@ Usage:
       --sub-heading=SUB HEADING
                             Sub Heading for the Map
       -u UA, --ua=UA        define a specific user agent you choose to use
+      -w N, --workers=N     number of concurrent lookups, default: 8
+      --provider=NAME       geo api to look the ip's up at: telize (one ip per
+                            request), ip-api (100 ip's per request) or fake (made
+                            up locations, no requests), default: telize
+      --api-url=URL         url of the geo api instead of the provider's own, for
+                            telize %s is replaced by the ip address
+      --max-rps=N           at most N requests per second to the geo api, lowered
+                            while it throttles, default: unlimited
+      --timeout=SECS        seconds to wait for an answer of the geo api, default: 10
+      --retries=N           retries of a request the geo api throttled (429) or
+                            failed (5xx), default: 3
+      --cache-path=FILE     sqlite file caching the ip details, default: ~/.ip2map_cache.sqlite
+      --cache-ttl=DAYS      days before a cached ip is looked up again, default: 30
+      --cache-size=N        maximum number of cached ip's, default: 1000000
+      --no-cache            do not use the ip details cache
+      --coalesce-prefix=N   look up one ip per IPv4 subnet of this prefix length and
+                            copy its location to the others, eg: --coalesce-prefix 24
+      --coalesce-prefix6=N  prefix length of the IPv6 subnets when coalescing, default: 48
+      --chunk-size=N        number of ip's looked up and written at a time, default: 1000
+      --cluster=DEG         merge the bubbles on a grid of this many degrees, eg: --cluster 1
+      --max-bubbles=N       make the bubble grid coarser until at most N bubbles are left
+      --renderer=native|phantomjs
+                            draw the map in-process (native, png needs Pillow) or
+                            with phantomjs and amMaps, default: native
+      --geodb=FILE          resolve the ip's offline from a geo database csv
+                            (compiled once to FILE.idx) or a compiled .idx file
+      --resume=FILE         write the data to FILE; if an earlier run left it
+                            unfinished, keep its rows and only look up the
+                            remaining ip's
+      --incremental=FILE    take the locations of the ip's in a previous
+                            _data.CSV from it and only look up the new ip's
+      --processes=N         shard the ip's of the input file by hash over N
+                            processes, each validating, looking up and counting
+                            its own shard, default: 1
+      --html                also write the amMaps page of the map to <data
+                            file>_map.html
+      --html-data=inline|external
+                            inline: the page carries its data, external: the page
+                            loads it from <data file>_map.json, default: inline
+      --gzip                also write a .gz of the page and its data, for web
+                            servers that serve them compressed
+      --extract             pull the ip's out of a text file of any format, eg:
+                            web server logs or syslog, also gzip compressed,
+                            instead of reading a csv
+      --field=N             with --extract only take the ip's in the Nth field of
+                            the lines, eg: --field 1 for the clients of a nginx
+                            log
+      --delimiter=C         with --field split the lines at C instead of at white
+                            space, eg: --delimiter ,
+      --follow              keep reading the lines appended to the file, eg: a
+                            log, and refresh the map as new ip's come in, until
+                            Ctrl-C
+      --refresh=SECS        seconds between the map refreshes of --follow,
+                            default: 10
+      --window=SECS         with --follow only map the ip's seen in the last SECS
+                            seconds, default: all of them
+      --group-by=COL        also draw a map per value of this column of the
+                            generated data, by name or number, eg: --group-by
+                            customer or --group-by col13
+      --output-format=FORMATS
+                            also write the data as jsonl (one json object per
+                            row), npz (numpy arrays) and/or parquet (needs
+                            pyarrow), comma separated, eg: --output-format npz,jsonl
+      --metrics=FILE        write the time of the stages, the counters and the api
+                            latencies to FILE, as prometheus text if FILE ends
+                            with .prom, as json otherwise
+      --profile=DIR         profile every stage with cProfile, written to
+                            DIR/<stage>.prof
+      --host=HOST           address ip2map.py serve listens on, default: 127.0.0.1
+      --port=PORT           port ip2map.py serve listens on, default: 8080
 
 CSV File format example:
 [1] ip,label
@@ -63,11 +139,103 @@ Examples:
     $ ./ip2map.py ips.txt --heading "" --sub-heading "" -l col13
         gets the labels from col13. In this case, col13 will be an extra column that is read from a file.
         There are only 12 columns, if its just IP address in the CSV.
+
+    $ ./ip2map.py ips.txt --resume ips_data.CSV
+        writes the data to ips_data.CSV as the ip's are looked up. If the run is interrupted
+        or some lookups fail, the same command carries on with only the ip's that are missing
+
+    $ ./ip2map.py today.txt --incremental 20140731_01_data.CSV
+        only looks up the ip's that are not in yesterday's data file
+
+    $ ./ip2map.py big.txt --provider fake --processes 4
+        splits the ip's of big.txt over 4 processes by a hash of the ip, each validates, looks up
+        and counts its own shard; the data file has the rows of shard 1, then shard 2, ...
+        --max-rps is shared by the processes, --resume cannot be used with it
+
+    $ ./ip2map.py connections.csv --group-by customer
+        looks every ip up once and draws, next to the map of all of them, a map per customer:
+        20140731_01_<customer>_map.svg and .png, with "customer: <customer>" as sub heading.
+        the maps are drawn in parallel, one process per cpu
+
+    $ ./ip2map.py ips.txt --output-format npz,jsonl
+        next to the _data.CSV writes _data.jsonl (streamed, one json object per row) with
+        _countries.jsonl, and _data.npz: latitude/longitude as float64 arrays, the other
+        columns as int32 codes into <column>_values, the country statistics as
+        countries_code/countries_count. parquet writes _data.parquet and _countries.parquet
+        eg: d = numpy.load("20140731_01_data.npz"); d["country_values"][d["country"]]
+
+    $ ./ip2map.py ips.txt --metrics run.prom --profile prof
+        writes the wall and cpu seconds of the stages (parse, enrich, aggregate, write,
+        render_svg, render_png, phantomjs, ...), the counters (rows read, invalid ip's,
+        duplicates, cache hits, api requests, retries, ...) and the api latency histogram
+        to run.prom, and a cProfile of every stage to prof/, eg: python -m pstats prof/enrich.prof
+
+    $ ./ip2map.py ips.txt --html --html-data external --gzip
+        next to the png writes the amMaps page 20140731_01_map.html, its data (the locations,
+        bubbles and country values, once each) in 20140731_01_map.json and a .gz of both.
+        the page reads the json over http, so serve the directory, eg: python -m SimpleHTTPServer;
+        with the default --html-data inline the json is in the page and it also opens from disk
+
+    $ ./ip2map.py access.log.gz --field 1 --processes 4
+        no preprocessing of the logs: the IPv4 and IPv6 addresses are pulled straight out of the
+        bytes of the file (mmap, or decompressed a block at a time for gzip), here only the ones in
+        the first field of the lines, and go on to the lookups once each. without --field every
+        ip on the line counts. --processes splits the scan of an uncompressed file over 4
+        processes, a block of 64MB each; the lookups stay in this process
+
+    $ ./ip2map.py attacks.log --follow --refresh 5 --window 3600 --html
+        reads attacks.log (a csv with an ip column, one ip per line, or any text with --extract
+        or --field) and keeps reading the lines appended to it, also after the log is rotated
+        or truncated. only the ip's that are not on the map yet are looked up; they are appended
+        to the data file and every 5 seconds the map and the page are drawn again (renamed into
+        place, never half written) if something changed. the map has the ip's of the last hour,
+        give or take --refresh; the data file has every ip once and gets its country statistics
+        on Ctrl-C or SIGTERM
+
+    $ ./ip2map.py serve --port 8080
+        keeps the cache, the api sessions and the world map loaded and answers over http:
+            POST /enrich?format=json|csv    ip's (one per line, or a csv with an ip column) with their details
+            POST /map?format=html|svg|png|payload
+                                            the map of the ip's (payload: the data of the html page
+                                            as json), also takes heading, sub_heading,
+                                            label=colN, cluster=DEG and max_bubbles=N
+            GET /health                     counters of the lookups
+            GET /metrics                    the timers and counters as prometheus text
+        eg: curl --data-binary @ips.txt "http://127.0.0.1:8080/map?format=png" > map.png
+        answers bigger than 1kB are gzipped for clients sending Accept-Encoding: gzip
+
+As a library (nothing is written to disk, safe to call from many threads):
+    import ip2map
+    outputs = ip2map.make_map("ips.txt", ("csv", "png"), label="col13")
+        outputs["csv"] and outputs["png"] hold the data file and the map
+    or stage by stage:
+    data = ip2map.parse(["8.8.8.8", "1.1.1.1"])     # a list of ip's, csv file name / file object / text
+    stats = ip2map.aggregate(ip2map.enrich(data, ip2map.Enricher()))
+    svg = ip2map.render(stats, "svg", heading="HEAT MAP")
 """
 from optparse import OptionParser
 from operator import itemgetter
-import os, sys, socket, logging, re, csv
+import os, sys, socket, logging, re, csv, math, errno
 import requests, json, subprocess, datetime
+import threading, Queue, multiprocessing, sqlite3, time, mmap, struct, bisect, array, random, zlib, tempfile, shutil, urllib, copy
+import contextlib, cProfile, itertools, collections, signal
+from cStringIO import StringIO
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from multiprocessing.pool import ThreadPool
+import urlparse
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    from PIL import Image, ImageDraw
+except ImportError:
+    Image = None
+try:
+    import pyarrow, pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
 __author__ = 'Sriram G'
 __version__ = '1'
@@ -77,18 +245,208 @@ __license__ = 'GPLv3'
 Global variables
 """
 UA = "Mozilla/5.0 (Windows NT 6.3; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/37.0.2049.0 Safari/537.36"
+API_URL = "http://www.telize.com/geoip/%s"
+WORKERS = 8
+MAX_RPS = 0             # requests per second to the api, 0 is unlimited
+TIMEOUT = 10            # seconds per request
+RETRIES = 3             # retries of a throttled or failed request
+BACKOFF = 0.5           # seconds before the first retry, doubled for every next one
+BACKOFF_MAX = 30        # seconds
+BREAKER_FAILURES = 10   # failures in a row that stop the lookups
+BREAKER_RESET = 30      # seconds before the api is tried again
+CACHE_PATH = os.path.join(os.path.expanduser("~"), ".ip2map_cache.sqlite")
+CACHE_TTL = 30          # days
+CACHE_SIZE = 1000000    # entries
+CHUNK_SIZE = 1000       # ip's looked up and written at a time
+AGGREGATE_SIZE = 20000  # rows counted at a time for the map
+SUBNET_LIMIT = 1000000  # subnets an Enricher keeps the looked up row of, when coalescing
+ROW_GROUP_SIZE = 100000 # rows per parquet row group
+REFRESH = 10            # seconds between the map refreshes of --follow
+POLL = 1                # seconds between the reads of a followed file
+EXTRACT_BLOCK = 1 << 26 # bytes of a text file scanned at a time by --extract
+CLUSTER_CELL = 0.1      # degrees, finest grid when clustering bubbles
+MAP_SIZE = (1200, 700)  # pixels, as the map div of the html
+MAP_COLORS = {'background': '#EEEEEE', 'unlisted': '#DDDDDD', 'low': '#FFDE00', 'high': '#CC9933',
+              'outline': '#FFFFFF', 'bubble': '#6C00FF', 'bubble_outline': '#CECCCC', 'text': '#000000'}
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)    # seconds, of the api latency histogram
+GEO_FIELDS = ['latitude', 'longitude', 'country_code2', 'country_code3', 'country', 'region_code', 'region', 'city', 'postal_code', 'asn', 'isp']
+GEO_API_FIELDS = ['latitude', 'longitude', 'country_code', 'country_code3', 'country', 'region_code', 'region', 'city', 'postal_code', 'asn', 'isp']
 quiet_mode = False
 logger = logging.getLogger('ip2map')
 logger.setLevel(logging.DEBUG)
 logging.basicConfig(format='[%(levelname)-7s] %(asctime)s | %(message)s', datefmt='%I:%M:%S %p') #%m/%d/%Y
 
 
+class Metrics(object):
+    """
+    instrumentation of a run: wall and cpu seconds of the stages, counters
+    and histograms, as a json summary or as prometheus text. a stage
+    entered within another one pauses it, eg: the rows read while a chunk
+    is looked up count as parse time, not as enrich time. with profile
+    set, every stage also runs under a cProfile of its own. the cpu
+    seconds are the ones of the whole process, its threads included
+    """
+    def __init__(self):
+        self.stages = {}        # name -> [wall seconds, cpu seconds, calls]
+        self.counters = {}
+        self.histograms = {}    # name -> [bucket bounds, counts per bucket and +Inf, sum]
+        self.profile = False
+        self.profiles = {}      # stage -> cProfile.Profile
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @staticmethod
+    def _clock():
+        t = os.times()
+        return time.time(), t[0] + t[1]
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS):
+        with self.lock:
+            hist = self.histograms.get(name)
+            if hist is None:
+                hist = self.histograms[name] = [buckets, [0] * (len(buckets) + 1), 0.0]
+            hist[1][bisect.bisect_left(hist[0], value)] += 1
+            hist[2] += value
+
+    def _pause(self, entry, now, calls=0):
+        name, wall, cpu = entry
+        if self.profile:
+            self.profiles[name].disable()
+        with self.lock:
+            totals = self.stages.setdefault(name, [0.0, 0.0, 0])
+            totals[0] += now[0] - wall
+            totals[1] += now[1] - cpu
+            totals[2] += calls
+
+    def _resume(self, entry, now):
+        entry[1:] = now
+        if self.profile:
+            if entry[0] not in self.profiles:
+                self.profiles[entry[0]] = cProfile.Profile()
+            self.profiles[entry[0]].enable()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        time the block as the stage name
+        """
+        stack = self.local.__dict__.setdefault("stack", [])
+        now = self._clock()
+        if stack:
+            self._pause(stack[-1], now)
+        entry = [name, 0, 0]
+        stack.append(entry)
+        self._resume(entry, now)
+        try:
+            yield
+        finally:
+            now = self._clock()
+            self._pause(stack.pop(), now, 1)
+            if stack:
+                self._resume(stack[-1], now)
+
+    def timed_iter(self, name, iterable, size=CHUNK_SIZE):
+        """
+        time the reading of an iterable as the stage name, size items at a time
+        returns: the items (as generator)
+        """
+        it = iter(iterable)
+        while True:
+            with self.stage(name):
+                batch = list(itertools.islice(it, size))
+            if not batch:
+                return
+            for item in batch:
+                yield item
+
+    def snapshot(self):
+        """
+        returns: the stages, counters and histograms (as dict, for json)
+        """
+        with self.lock:
+            return {"stages": dict((name, {"wall_seconds": round(wall, 6), "cpu_seconds": round(cpu, 6), "calls": calls})
+                                   for name, (wall, cpu, calls) in self.stages.iteritems()),
+                    "counters": dict(self.counters),
+                    "histograms": dict((name, {"buckets": list(buckets), "counts": list(counts), "sum": round(total, 6),
+                                               "count": sum(counts)})
+                                       for name, (buckets, counts, total) in self.histograms.iteritems())}
+
+    def merge(self, snapshot):
+        """
+        add a snapshot of another process, eg: a shard of --processes
+        returns: none
+        """
+        with self.lock:
+            for name, stage in snapshot["stages"].iteritems():
+                totals = self.stages.setdefault(name, [0.0, 0.0, 0])
+                totals[0] += stage["wall_seconds"]
+                totals[1] += stage["cpu_seconds"]
+                totals[2] += stage["calls"]
+            for name, n in snapshot["counters"].iteritems():
+                self.counters[name] = self.counters.get(name, 0) + n
+            for name, hist in snapshot["histograms"].iteritems():
+                mine = self.histograms.setdefault(name, [tuple(hist["buckets"]), [0] * len(hist["counts"]), 0.0])
+                mine[1] = [a + b for a, b in zip(mine[1], hist["counts"])]
+                mine[2] += hist["sum"]
+
+    def prometheus(self):
+        """
+        returns: the stages, counters and histograms in the prometheus text format (as str)
+        """
+        snap = self.snapshot()
+        lines = []
+        for metric, key in (("ip2map_stage_wall_seconds_total", "wall_seconds"), ("ip2map_stage_cpu_seconds_total", "cpu_seconds"),
+                            ("ip2map_stage_calls_total", "calls")):
+            lines.append("# TYPE %s counter" % metric)
+            lines.extend('%s{stage="%s"} %s' % (metric, name, stage[key]) for name, stage in sorted(snap["stages"].iteritems()))
+        for name, n in sorted(snap["counters"].iteritems()):
+            lines.append("# TYPE ip2map_%s_total counter" % name)
+            lines.append("ip2map_%s_total %d" % (name, n))
+        for name, hist in sorted(snap["histograms"].iteritems()):
+            lines.append("# TYPE ip2map_%s histogram" % name)
+            cumulative = 0
+            for bound, n in zip([str(b) for b in hist["buckets"]] + ["+Inf"], hist["counts"]):
+                cumulative += n
+                lines.append('ip2map_%s_bucket{le="%s"} %d' % (name, bound, cumulative))
+            lines.append("ip2map_%s_sum %s" % (name, hist["sum"]))
+            lines.append("ip2map_%s_count %d" % (name, hist["count"]))
+        return "\n".join(lines) + "\n"
+
+    def dump_profiles(self, directory, suffix=""):
+        """
+        write the cProfile of every stage to directory/<stage><suffix>.prof,
+        to be read with python -m pstats
+        returns: the files written (as list)
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        files = []
+        for name, profile in sorted(self.profiles.iteritems()):
+            fn = os.path.join(directory, "%s%s.prof" % (name, suffix))
+            profile.dump_stats(fn)
+            files.append(fn)
+        return files
+
+    def log_stages(self):
+        for name, stage in sorted(self.snapshot()["stages"].iteritems(), key=lambda s: -s[1]["wall_seconds"]):
+            logger.debug("Stage %s: %.3fs wall, %.3fs cpu, %d calls" % (name, stage["wall_seconds"], stage["cpu_seconds"], stage["calls"]))
+
+
+metrics = Metrics()
+
+
 def uniq(_1colList):
     """
     Uniquify a list that has a single column
     returns: list of unique col (as a list)
     """
-    return [l for i,l in enumerate(_1colList) if l not in _1colList[i+1:]]
+    seen = set()
+    seen_add = seen.add
+    return [l for l in reversed([l for l in reversed(_1colList) if l not in seen and not seen_add(l)])]
 
 
 def uniq_list(list_dict, key):
@@ -101,135 +459,816 @@ def uniq_list(list_dict, key):
     return [x for x in list_dict if x[key] not in seen and not seen_add(x[key])]
 
 
+def uniq_stream(rows, key):
+    """
+    pass an iterable of dictionaries and the key you want to unique them
+    returns: generator of the dictionaries that are unique based on the key column passed
+    """
+    seen = set()
+    seen_add = seen.add
+    duplicates = 0
+    try:
+        for x in rows:
+            if x[key] not in seen:
+                seen_add(x[key])
+                yield x
+            else:
+                duplicates += 1
+    finally:
+        metrics.count("duplicate_rows", duplicates)
+
+
+def _ip_ranges(family, ranges):
+    """
+    turn a list of (network, prefix length, class) into a table sorted by
+    the integer start of the networks, for bisection
+    returns: starts (as list), (start, end, class) (as list)
+    """
+    table = []
+    bits = 32 if family == socket.AF_INET else 128
+    for net, prefix, kind in ranges:
+        start = _ip_int(socket.inet_pton(family, net))
+        table.append((start, start + (1 << (bits - prefix)) - 1, kind))
+    table.sort()
+    return [t[0] for t in table], table
+
+
+def _ip_int(packed):
+    """
+    returns: the packed ip address as an integer (as int or long)
+    """
+    if len(packed) == 4:
+        return struct.unpack(">I", packed)[0]
+    hi, lo = struct.unpack(">QQ", packed)
+    return (hi << 64) | lo
+
+
+IP_VALID = 'valid'
+IP_INVALID = 'invalid'
+IP_PRIVATE = 'private'
+IP_RESERVED = 'reserved'
+# ip's that are not looked up: not routed on the internet, or special purpose.
+# IPv4-mapped IPv6 addresses (::ffff:0:0/96) are not listed, they are read as their IPv4 address
+IP_RANGES = {
+    4: _ip_ranges(socket.AF_INET, [
+        ('0.0.0.0', 8, IP_RESERVED), ('10.0.0.0', 8, IP_PRIVATE), ('100.64.0.0', 10, IP_PRIVATE),
+        ('127.0.0.0', 8, IP_PRIVATE), ('169.254.0.0', 16, IP_PRIVATE), ('172.16.0.0', 12, IP_PRIVATE),
+        ('192.0.0.0', 24, IP_RESERVED), ('192.0.2.0', 24, IP_RESERVED), ('192.168.0.0', 16, IP_PRIVATE),
+        ('198.18.0.0', 15, IP_RESERVED), ('198.51.100.0', 24, IP_RESERVED), ('203.0.113.0', 24, IP_RESERVED),
+        ('224.0.0.0', 4, IP_RESERVED), ('240.0.0.0', 4, IP_RESERVED)]),
+    6: _ip_ranges(socket.AF_INET6, [
+        ('::', 128, IP_RESERVED), ('::1', 128, IP_PRIVATE),
+        ('100::', 64, IP_RESERVED), ('2001:db8::', 32, IP_RESERVED), ('fc00::', 7, IP_PRIVATE),
+        ('fe80::', 10, IP_PRIVATE), ('ff00::', 8, IP_RESERVED)]),
+}
+# the legacy IPv4 forms inet_aton understands: hex, octal, and less than 4 parts
+LEGACY_IPV4 = re.compile(r"^(?:0x[0-9a-f]+|[0-9]+)(?:\.(?:0x[0-9a-f]+|[0-9]+)){0,3}$", re.IGNORECASE)
+# ip's in free text, for --extract. the scans start at a literal '.' or ':' so that re skips
+# ahead to the next one instead of trying every byte, a lookahead rules most of those out
+# before the part in front of it is checked by the lookbehinds
+_HEX = "[0-9A-Fa-f]"
+IPV4_SCAN = re.compile(r"\.(?=\d{1,3}\.\d{1,3}\.\d{1,3}(?!\.?\d))(?:" +
+                       "|".join(r"(?<=(?<![\d.])(%s)\.)" % (r"\d" * n) for n in (3, 2, 1)) + r")(\d{1,3}\.\d{1,3}\.\d{1,3})")
+IPV6_SCAN = re.compile(r":(?=:|%s*::|(?:%s{1,4}:){6}%s)(?:" % ("[0-9A-Fa-f:]", _HEX, _HEX) +
+                       "|".join(r"(?<=(?<![\w:.])(%s):)" % (_HEX * n) for n in (4, 3, 2, 1, 0)) +
+                       r")((?:%s{0,4}:){1,7}%s{0,4})(?![\w:]|\.\d)" % (_HEX, _HEX))
+IP_TEXT = r"(?<![\d.])(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})(?!\.?\d)|(?<![\w:.])(%s{0,4}(?::%s{0,4}){2,7})(?![\w:]|\.\d)" % (_HEX, _HEX)
+
+
+def normalize_ips(ip_list):
+    """
+    validates and normalizes a batch of ip addresses: IPv4 (including the
+    octal, hex and shortened forms) and IPv6 addresses are accepted, an
+    IPv4-mapped IPv6 address (eg: ::ffff:8.8.8.8) becomes its IPv4 address
+    returns: (canonical ip, version, ip as integer, class) for every ip (as list of tuples),
+             the class is one of IP_VALID, IP_INVALID, IP_PRIVATE or IP_RESERVED
+    """
+    pton, aton = socket.inet_pton, socket.inet_aton
+    ntoa, ntop = socket.inet_ntoa, socket.inet_ntop
+    af_inet, af_inet6 = socket.AF_INET, socket.AF_INET6
+    unpack, legacy = struct.unpack, LEGACY_IPV4.match
+    bisect_right = bisect.bisect_right
+    starts4, table4 = IP_RANGES[4]
+    starts6, table6 = IP_RANGES[6]
+    normalized = []
+    append = normalized.append
+    for ip in ip_list:
+        ip = ip.strip()
+        try:
+            if ':' in ip:
+                packed = pton(af_inet6, ip)
+                hi, lo = unpack(">QQ", packed)
+                if hi == 0 and lo >> 32 == 0xffff:     # IPv4-mapped, eg: from a dual stack server
+                    n = lo & 0xffffffff
+                    i = bisect_right(starts4, n) - 1
+                    append((ntoa(packed[12:]), 4, n, table4[i][2] if i >= 0 and n <= table4[i][1] else IP_VALID))
+                    continue
+                n = (hi << 64) | lo
+                i = bisect_right(starts6, n) - 1
+                kind = table6[i][2] if i >= 0 and n <= table6[i][1] else IP_VALID
+                append((ntop(af_inet6, packed), 6, n, kind))
+                continue
+            try:
+                n = unpack(">I", pton(af_inet, ip))[0]  # dotted quad, already canonical
+            except socket.error:
+                if not legacy(ip):
+                    raise
+                packed = aton(ip)
+                ip = ntoa(packed)
+                n = unpack(">I", packed)[0]
+            i = bisect_right(starts4, n) - 1
+            kind = table4[i][2] if i >= 0 and n <= table4[i][1] else IP_VALID
+            append((ip, 4, n, kind))
+        except (socket.error, ValueError, TypeError):
+            append((ip, 0, 0, IP_INVALID))
+    return normalized
+
+
+def normalize_ip(ip):
+    """
+    validates and normalizes a single ip address, see normalize_ips()
+    returns: canonical ip (as str), version (as int), ip as integer (as int or long), class (as str)
+    """
+    return normalize_ips([ip])[0]
+
+
 def is_valid_ip(ip):
     """
     validates the given IP addresses
     ip v4 or ipv6 can be passed
     returns: True if IP detected or False (bool)
     """
-    def is_valid_ipv4(ip):
-        """
-        validates IPv4 addresses.
-        """
-        pattern = re.compile(r"""
-            ^
-            (?:
-              # Dotted variants:
-              (?:
-                # Decimal 1-255 (no leading 0's)
-                [3-9]\d?|2(?:5[0-5]|[0-4]?\d)?|1\d{0,2}
-              |
-                0x0*[0-9a-f]{1,2}  # Hexadecimal 0x0 - 0xFF (possible leading 0's)
-              |
-                0+[1-3]?[0-7]{0,2} # Octal 0 - 0377 (possible leading 0's)
-              )
-              (?:                  # Repeat 0-3 times, separated by a dot
-                \.
-                (?:
-                  [3-9]\d?|2(?:5[0-5]|[0-4]?\d)?|1\d{0,2}
-                |
-                  0x0*[0-9a-f]{1,2}
-                |
-                  0+[1-3]?[0-7]{0,2}
-                )
-              ){0,3}
-            |
-              0x0*[0-9a-f]{1,8}    # Hexadecimal notation, 0x0 - 0xffffffff
-            |
-              0+[0-3]?[0-7]{0,10}  # Octal notation, 0 - 037777777777
-            |
-              # Decimal notation, 1-4294967295:
-              429496729[0-5]|42949672[0-8]\d|4294967[01]\d\d|429496[0-6]\d{3}|
-              42949[0-5]\d{4}|4294[0-8]\d{5}|429[0-3]\d{6}|42[0-8]\d{7}|
-              4[01]\d{8}|[1-3]\d{0,9}|[4-9]\d{0,8}
-            )
-            $
-        """, re.VERBOSE | re.IGNORECASE)
-        return pattern.match(ip) is not None
-
-
-    def is_valid_ipv6(ip):
-        """
-        validates IPv6 addresses.
-        """
-        pattern = re.compile(r"""
-            ^
-            \s*                         # Leading whitespace
-            (?!.*::.*::)                # Only a single wildcard allowed
-            (?:(?!:)|:(?=:))            # Colon if it would be part of a wildcard
-            (?:                         # Repeat 6 times:
-                [0-9a-f]{0,4}           #   A group of at most four hexadecimal digits
-                (?:(?<=::)|(?<!::):)    #   Colon unless preceded by wildcard
-            ){6}                        #
-            (?:                         # Either
-                [0-9a-f]{0,4}           #   Another group
-                (?:(?<=::)|(?<!::):)    #   Colon unless preceded by wildcard
-                [0-9a-f]{0,4}           #   Last group
-                (?: (?<=::)             #   Colon iff preceded by exactly one colon
-                 |  (?<!:)              #
-                 |  (?<=:) (?<!::) :    #
-                 )                      # OR
-             |                          #   A v4 address with NO leading zeros
-                (?:25[0-4]|2[0-4]\d|1\d\d|[1-9]?\d)
-                (?: \.
-                    (?:25[0-4]|2[0-4]\d|1\d\d|[1-9]?\d)
-                ){3}
-            )
-            \s*                         # Trailing whitespace
-            $
-        """, re.VERBOSE | re.IGNORECASE | re.DOTALL)
-        return pattern.match(ip) is not None
-
-
-    return is_valid_ipv4(ip) or is_valid_ipv6(ip)
-
-
-def ip2loc(ip_list=[]):
+    return normalize_ip(ip)[3] != IP_INVALID
+
+
+def geo_session(workers=1, ua=None):
+    """
+    create a requests session with a connection pool large enough for
+    the given number of workers, so that keep-alive connections get reused
+    returns: session (as requests.Session)
     """
-    accepts a single ip or list of ip's as a list
-    and get the extra information of the ip address from telize.com api
-    returns: details of the ip with 12 columns (as a list)
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['User-Agent'] = ua or UA
+    return session
+
+
+class GeoAPIError(Exception):
+    """
+    a lookup the geo api did not answer, even after the retries
     """
-    logger.debug("ip2loc().ip2map.py...starts getting ip info for %s ips"%str(len(ip_list)))
-    api_url = "http://www.telize.com/geoip/%s"
+    pass
 
-    headers = {'User-Agent': UA}
-    ip2loc_list = []
-    for ip in ip_list:
-        """ip, country_code, country_code3, country, region_code, region, city,
-	    postal_code, continent_code, latitude, longitude, dma_code, area_code, asn, isp, timezone
+
+class RateLimiter(object):
+    """
+    token bucket shared by the workers, at most `rate` requests per second.
+    the rate adapts to the api: it is halved when the api throttles (429)
+    and grows back by a hundredth of the maximum with every answered request
+    """
+    def __init__(self, rate, burst=1):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.stamp = time.time()
+        self.slowed = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        wait until a request may be sent
+        returns: none
+        """
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def slow_down(self):
+        with self.lock:
+            now = time.time()
+            if now - self.slowed >= 1.0 / self.rate:  # the 429's of one burst count once
+                self.slowed = now
+                self.rate = max(self.max_rate / 64, self.rate / 2)
+                logger.debug("api throttles, down to %.1f requests/s" % self.rate)
+
+    def speed_up(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
+
+
+class CircuitBreaker(object):
+    """
+    stop calling the api after `threshold` failures in a row: while open,
+    every lookup fails at once, and after `reset` seconds a single request
+    is let through to find out if the api is back
+    """
+    def __init__(self, threshold=BREAKER_FAILURES, reset=BREAKER_RESET):
+        self.threshold = threshold
+        self.reset = reset
+        self.failures = 0
+        self.opened = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened is None:
+                return True
+            if time.time() - self.opened >= self.reset:
+                self.opened = time.time()   # one probe per reset period
+                return True
+            return False
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self.opened is None:
+                    logger.error("geo api failed %d times in a row, pausing the lookups for %ds" % (self.failures, self.reset))
+                self.opened = time.time()
+
+
+class GeoClient(object):
+    """
+    the requests to the geo api: every request waits for the rate limiter,
+    has a timeout, and is retried with jittered exponential backoff when
+    the api throttles (429), fails (5xx) or cannot be reached. failures go
+    through a circuit breaker, so that an api that is down fails fast.
+    what is requested and how the answer is read is up to the GeoProvider
+    """
+    def __init__(self, session=None, workers=1, max_rps=MAX_RPS, timeout=TIMEOUT, retries=RETRIES, breaker=None, provider=None):
+        self.provider = provider if provider is not None else TelizeProvider()
+        self.session = session if session is not None else geo_session(workers)
+        self.limiter = RateLimiter(max_rps) if max_rps > 0 else None
+        self.timeout = timeout
+        self.retries = max(0, retries)  # one request at least, a negative count would make none
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.retried = 0
+        self.throttled = 0
+
+    def lookup(self, ip_list):
+        """
+        look up at most provider.batch_size ip's with one request, raises
+        ValueError when the answer cannot be read and GeoAPIError when there is no answer
+        returns: details of the ip's with 12 columns (as a list)
         """
+        if self.provider.local:
+            return self.provider.rows(ip_list, None)
+        method, url, body = self.provider.request(ip_list)
+        for attempt in xrange(self.retries + 1):
+            if not self.breaker.allow():
+                raise GeoAPIError("geo api is down, %s not looked up" % ip_list[0])
+            if self.limiter is not None:
+                self.limiter.acquire()
+            wait = None
+            metrics.count("api_requests")
+            start = time.time()
+            try:
+                response = self.session.request(method, url, data=body, timeout=self.timeout)
+            except requests.exceptions.RequestException as e:     # not reached, timed out, a broken answer, ...
+                error = e
+                self.breaker.failure()
+                metrics.count("api_errors")
+            else:
+                metrics.observe("api_latency_seconds", time.time() - start)
+                if response.status_code == 429:
+                    error = "HTTP 429"
+                    self.throttled += 1
+                    metrics.count("api_throttled")
+                    if self.limiter is not None:
+                        self.limiter.slow_down()
+                    retry_after = response.headers.get("Retry-After", "")
+                    if retry_after.isdigit():
+                        wait = min(BACKOFF_MAX, int(retry_after))
+                elif response.status_code >= 500:
+                    error = "HTTP %d" % response.status_code
+                    self.breaker.failure()
+                    metrics.count("api_errors")
+                else:
+                    try:
+                        rows = self.provider.rows(ip_list, json.loads(response.text))
+                    except ValueError:
+                        self.breaker.failure()
+                        raise
+                    self.breaker.success()
+                    if self.limiter is not None:
+                        self.limiter.speed_up()
+                    return rows
+            if attempt < self.retries:
+                self.retried += 1
+                metrics.count("api_retries")
+                if wait is None:
+                    wait = min(BACKOFF_MAX, BACKOFF * 2 ** attempt) * random.uniform(0.5, 1.5)
+                time.sleep(wait)
+        raise GeoAPIError("%s not looked up: %s" % (ip_list[0], error))
+
+
+class GeoRecord(tuple):
+    """
+    the columns of a looked up ip: the 12 of geo_row(), followed by the
+    extra columns of its input row once joined. a tuple, so a row costs
+    its pointers and no more, and every value but the ip is interned:
+    the coordinates, country, region, city, asn and isp of a location
+    are one string each, shared by all the ip's there. indexing,
+    slicing, iterating and + (to append columns) work as on the list
+    of strings it replaces, so the data file does not change
+    """
+    __slots__ = ()
+
+    def __new__(cls, values):
         try:
-            response = requests.get(api_url % ip, headers=headers)
-            json_data = json.loads(response.text)
-        except ValueError:
-            break
+            return tuple.__new__(cls, [values[0]] + map(intern, values[1:]))
+        except TypeError:
+            return tuple.__new__(cls, [values[0]] + _interned(values[1:]))
+
+    def __add__(self, columns):
+        return tuple.__new__(GeoRecord, tuple.__add__(self, tuple(_interned(columns))))
+
+    def with_ip(self, ip):
+        """
+        returns: the same location for another ip (as GeoRecord)
+        """
+        return tuple.__new__(GeoRecord, (ip,) + self[1:])
+
+
+def _interned(values):
+    """
+    returns: the values, the strings among them interned (as list)
+    """
+    try:
+        return map(intern, values)
+    except TypeError:   # not all of them are str
+        return [intern(v) if type(v) is str else v for v in values]
+
+
+_encode_text = json.encoder.encode_basestring_ascii
+
+
+def geo_text(value):
+    """
+    the text of a value of a geo api answer, as the data files always had
+    it: json.dumps(value) without the quotes
+    returns: text (as str)
+    """
+    if isinstance(value, basestring):
+        return _encode_text(value).replace('"', "").strip()
+    if type(value) is float and not (math.isinf(value) or math.isnan(value)):
+        return repr(value)
+    if type(value) in (int, long):
+        return str(value)
+    return json.dumps(value).replace('"', "").strip()
+
+
+def geo_row(ip, json_data):
+    """
+    map the json answer of the geo api to the default 12 columns
+    returns: details of the ip with 12 columns (as GeoRecord)
+    """
+    """ip, country_code, country_code3, country, region_code, region, city,
+    postal_code, continent_code, latitude, longitude, dma_code, area_code, asn, isp, timezone
+    """
+    get = json_data.get
+    return GeoRecord([ip] + [geo_text(get(key)) if key in json_data else 'N/A' for key in GEO_API_FIELDS])
+
+
+def fake_geo(ip):
+    """
+    build a deterministic telize style answer for the given ip,
+    the answers of the fake provider
+    returns: geo details (as dict)
+    """
+    h = zlib.crc32(ip) & 0xffffffff
+    countries = [('US', 'USA', 'United States'), ('DE', 'DEU', 'Germany'), ('IN', 'IND', 'India'),
+                 ('BR', 'BRA', 'Brazil'), ('JP', 'JPN', 'Japan'), ('AU', 'AUS', 'Australia')]
+    cc2, cc3, country = countries[h % len(countries)]
+    return {
+        "ip": ip,
+        "country_code": cc2, "country_code3": cc3, "country": country,
+        "region_code": "%02d" % (h % 50), "region": "Region %d" % (h % 50),
+        "city": "City %d" % (h % 500), "postal_code": "%05d" % (h % 100000),
+        "latitude": round((h % 14000) / 100.0 - 60, 4), "longitude": round((h % 36000) / 100.0 - 180, 4),
+        "asn": "AS%d" % (h % 65535), "isp": "ISP %d" % (h % 300),
+    }
+
+
+class GeoProvider(object):
+    """
+    a geo api backend: how the ip's are requested (batch_size ip's per
+    request) and how the answer is mapped to the 12 columns of geo_row().
+    local providers answer in-process and make no requests
+    """
+    name = ""
+    batch_size = 1
+    local = False
+
+    def __init__(self, url=None):
+        self.url = url
+
+    def request(self, ip_list):
+        """
+        returns: http method, url, body (as str, or None)
+        """
+        raise NotImplementedError
+
+    def rows(self, ip_list, answer):
+        """
+        map the json answer (None for local providers) to rows, ip's without an answer are left out
+        returns: details of the ip's with 12 columns (as a list)
+        """
+        raise NotImplementedError
+
+
+class TelizeProvider(GeoProvider):
+    """
+    telize.com style api, one GET per ip, the url has %s for the ip (API_URL by default)
+    """
+    name = "telize"
+
+    def request(self, ip_list):
+        return "GET", (self.url or API_URL) % ip_list[0], None
+
+    def rows(self, ip_list, answer):
+        return [geo_row(ip_list[0], answer)]
+
+
+class IpApiProvider(GeoProvider):
+    """
+    ip-api.com batch endpoint, one POST of up to 100 ip's answered with a list.
+    the free service allows 15 of those a minute (--max-rps 0.25)
+    """
+    name = "ip-api"
+    batch_size = 100
+    URL = "http://ip-api.com/batch?fields=status,query,country,countryCode,region,regionName,city,zip,lat,lon,isp,as"
+
+    def request(self, ip_list):
+        return "POST", self.url or IpApiProvider.URL, json.dumps(ip_list)
+
+    def rows(self, ip_list, answer):
+        if not isinstance(answer, list):
+            raise ValueError("ip-api answered with %s" % type(answer).__name__)
+        rows = []
+        for a in answer:
+            if not isinstance(a, dict) or 'query' not in a:
+                continue
+            telize = {}
+            if a.get('status') == 'success':     # nothing is known of the ip's that 'fail'
+                telize = {'country_code': a.get('countryCode'), 'country': a.get('country'),
+                          'region_code': a.get('region'), 'region': a.get('regionName'), 'city': a.get('city'),
+                          'postal_code': a.get('zip'), 'latitude': a.get('lat'), 'longitude': a.get('lon'),
+                          'asn': (a.get('as') or '').split(' ')[0], 'isp': a.get('isp')}
+            rows.append(geo_row(str(a['query']), telize))
+        return rows
+
+
+class FakeProvider(GeoProvider):
+    """
+    deterministic made up locations (fake_geo()) without any requests,
+    for tests and benchmarks
+    """
+    name = "fake"
+    batch_size = 1000
+    local = True
+
+    def rows(self, ip_list, answer):
+        return [geo_row(ip, fake_geo(ip)) for ip in ip_list]
+
+
+PROVIDERS = dict((p.name, p) for p in (TelizeProvider, IpApiProvider, FakeProvider))
+
+
+class GeoCache(object):
+    """
+    persistent cache of the 12 column results of ip2loc(), kept in a
+    single sqlite file and keyed by ip address.
+    entries older than `ttl` days are not used, and once the cache holds
+    more than `max_entries` ip's the oldest ones are evicted
+    """
+    def __init__(self, path=CACHE_PATH, ttl=CACHE_TTL, max_entries=CACHE_SIZE):
+        self.path = path
+        self.ttl = ttl * 86400.0
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()    # the connection is shared by the requests of serve
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)   # --processes share the file
+        self.db.execute("CREATE TABLE IF NOT EXISTS geo (ip TEXT PRIMARY KEY, row TEXT, updated REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS geo_updated ON geo (updated)")
+        self.db.commit()
+
+    def get_many(self, ip_list):
+        """
+        look up the given ip's in the cache
+        returns: fresh cached rows (as dict of ip -> list)
+        """
+        found = {}
+        oldest = time.time() - self.ttl
+        ip_list = list(set(ip_list))
+        with self.lock:
+            for i in xrange(0, len(ip_list), 500):
+                chunk = ip_list[i:i+500]
+                query = "SELECT ip, row FROM geo WHERE updated >= ? AND ip IN (%s)" % ",".join("?" * len(chunk))
+                for ip, row in self.db.execute(query, [oldest] + chunk):
+                    found[str(ip)] = GeoRecord([str(v) for v in json.loads(row)])
+            self.hits += len(found)
+            self.misses += len(ip_list) - len(found)
+        metrics.count("cache_hits", len(found))
+        metrics.count("cache_misses", len(ip_list) - len(found))
+        return found
+
+    def put_many(self, rows):
+        """
+        store ip2loc() rows in the cache, then evict what is expired
+        or over the size limit
+        returns: none
+        """
+        now = time.time()
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO geo (ip, row, updated) VALUES (?, ?, ?)",
+                                ((row[0], json.dumps(row), now) for row in rows))
+            self.db.execute("DELETE FROM geo WHERE updated < ?", (now - self.ttl,))
+            count = self.db.execute("SELECT COUNT(*) FROM geo").fetchone()[0]
+            if count > self.max_entries:
+                self.db.execute("DELETE FROM geo WHERE ip IN (SELECT ip FROM geo ORDER BY updated LIMIT ?)",
+                                (count - self.max_entries,))
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+class _RangeKeys(object):
+    """
+    read only sequence over the fixed width big endian keys of a
+    compiled geo database, so that bisect can search the mmap directly
+    """
+    def __init__(self, buf, offset, width, count):
+        self.buf = buf
+        self.offset = offset
+        self.width = width
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        start = self.offset + i * self.width
+        return self.buf[start:start + self.width]
+
+
+class GeoDB(object):
+    """
+    offline geo database: a sorted range index of ip addresses compiled
+    from a csv file with the columns
+        start, end, latitude, longitude, country_code2, country_code3, country,
+        region_code, region, city, postal_code, asn, isp
+    start and end are ip addresses (or integers) and both IPv4 and IPv6
+    ranges are supported. the integers of a file are all of one family:
+    IPv6 if any of them is 2**32 or more, IPv4 otherwise. IPv4-mapped
+    IPv6 ranges (::ffff:0:0/96) are kept as IPv4 ranges, the way the ip's
+    are looked up. ranges must not overlap: a range overlapping one that
+    starts before it (or at the same address and ends first) is left out
+    and logged. The compiled file is loaded with mmap and searched
+    with bisection.
+
+    compiled file layout (all integers are big endian uint32):
+        magic, count of IPv4 ranges, count of IPv6 ranges, count of records
+        IPv4 range starts (4 bytes each), ends, record index
+        IPv6 range starts (16 bytes each), ends, record index
+        record offsets (count of records + 1), record blob (fields joined by \x1f)
+    """
+    MAGIC = "IP2MGEO2"
+    SEP = "\x1f"
+
+    def __init__(self, path):
+        if not path.lower().endswith(".idx"):
+            idx_path = path + ".idx"
+            if not os.path.isfile(idx_path) or os.path.getmtime(idx_path) < os.path.getmtime(path) or not GeoDB.compiled(idx_path):
+                GeoDB.compile(path, idx_path)
+            path = idx_path
+        self.path = path
+        self.f = open(path, "rb")
+        self.buf = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.buf[:8] != self.MAGIC:
+            raise ValueError("%s is not a compiled geo database" % path)
+        n4, n6, nrec = struct.unpack_from(">III", self.buf, 8)
+        offset = 20
+        self.tables = {}
+        for family, width, count in ((socket.AF_INET, 4, n4), (socket.AF_INET6, 16, n6)):
+            starts = _RangeKeys(self.buf, offset, width, count)
+            ends = _RangeKeys(self.buf, offset + width * count, width, count)
+            records = offset + 2 * width * count
+            self.tables[family] = (starts, ends, records)
+            offset = records + 4 * count
+        self.rec_offsets = offset
+        self.rec_blob = offset + 4 * (nrec + 1)
+        self.locations = {}     # record index -> GeoRecord of the record, shared by the ip's in its ranges
+
+    @staticmethod
+    def compiled(idx_path):
+        """
+        returns: True if idx_path is compiled by this version and can be read (as bool)
+        """
+        try:
+            with open(idx_path, "rb") as f:
+                return f.read(len(GeoDB.MAGIC)) == GeoDB.MAGIC
+        except (IOError, OSError):
+            return False
+
+    @staticmethod
+    def compile(csv_path, idx_path):
+        """
+        compile a geo database csv file to the sorted range index
+        returns: none
+        """
+        logger.info("Compiling geo database %s to %s" % (csv_path, idx_path))
+        rows = []
+        records = []
+        record_idx = {}
+        int_family = socket.AF_INET
+        with open(csv_path, "rU") as f:
+            for row in csv.reader(f):
+                if len(row) < 2 + len(GEO_FIELDS) or row[0].lower() == "start":
+                    continue
+                start, end = row[0].strip(), row[1].strip()
+                if end.isdigit() and int(end) >= 1 << 32:
+                    int_family = socket.AF_INET6
+                rec = GeoDB.SEP.join(v.strip() or 'N/A' for v in row[2:2 + len(GEO_FIELDS)])
+                if rec not in record_idx:
+                    record_idx[rec] = len(records)
+                    records.append(rec)
+                rows.append((start, end, record_idx[rec]))
+
+        ranges = {socket.AF_INET: [], socket.AF_INET6: []}
+        mapped = struct.pack(">QI", 0, 0xffff)     # the first 12 bytes of an IPv4-mapped address
+        for row in rows:
+            start, end = GeoDB.packed(row[0], int_family), GeoDB.packed(row[1], int_family)
+            if start is None or end is None or len(start) != len(end) or start > end:
+                logger.error("invalid range %s - %s in %s, ignoring this range..." % (row[0], row[1], csv_path))
+                continue
+            if len(start) == 16 and start[:12] == mapped and end[:12] == mapped:
+                start, end = start[12:], end[12:]
+            ranges[socket.AF_INET if len(start) == 4 else socket.AF_INET6].append((start, end, row[2]))
+        del rows
+
+        for family in (socket.AF_INET, socket.AF_INET6):
+            table = sorted(ranges[family])
+            kept = []
+            for r in table:
+                if kept and r[0] <= kept[-1][1]:
+                    logger.error("range %s - %s in %s overlaps %s - %s, ignoring this range..." % (GeoDB.text(r[0]),
+                                 GeoDB.text(r[1]), csv_path, GeoDB.text(kept[-1][0]), GeoDB.text(kept[-1][1])))
+                    continue
+                kept.append(r)
+            ranges[family] = kept
+
+        fd, tmp_path = tempfile.mkstemp(".tmp", os.path.basename(idx_path), os.path.dirname(os.path.abspath(idx_path)))
+        os.fchmod(fd, file_mode())  # mkstemp creates it 0600, the index is shared like the csv
+        with os.fdopen(fd, "wb") as out:
+            out.write(GeoDB.MAGIC)
+            out.write(struct.pack(">III", len(ranges[socket.AF_INET]), len(ranges[socket.AF_INET6]), len(records)))
+            for family in (socket.AF_INET, socket.AF_INET6):
+                table = ranges[family]
+                out.write("".join(r[0] for r in table))
+                out.write("".join(r[1] for r in table))
+                out.write(struct.pack(">%dI" % len(table), *[r[2] for r in table]))
+            offset = 0
+            offsets = [0]
+            for rec in records:
+                offset += len(rec)
+                offsets.append(offset)
+            out.write(struct.pack(">%dI" % len(offsets), *offsets))
+            out.write("".join(records))
+        os.rename(tmp_path, idx_path)   # concurrent runs never see a half written index
+
+    @staticmethod
+    def packed(ip, int_family=socket.AF_INET):
+        """
+        convert an ip address (or an integer of the int_family) to its big endian bytes
+        returns: 4 or 16 bytes (as str) or None if not an ip
+        """
+        ip = ip.strip()
+        try:
+            if ip.isdigit():
+                n = int(ip)
+                if int_family == socket.AF_INET:
+                    return struct.pack(">I", n)
+                return struct.pack(">QQ", n >> 64, n & 0xffffffffffffffff)
+            if ':' in ip:
+                return socket.inet_pton(socket.AF_INET6, ip)
+            return socket.inet_pton(socket.AF_INET, ip)
+        except (socket.error, struct.error, ValueError):
+            return None
+
+    @staticmethod
+    def text(packed):
+        """
+        returns: the ip address of the big endian bytes (as str)
+        """
+        return socket.inet_ntop(socket.AF_INET if len(packed) == 4 else socket.AF_INET6, packed)
 
-        try: country_code2= json.dumps(json_data["country_code"]).replace('"',"").strip()
-        except KeyError: country_code2= 'N/A'
-        try: country_code3= json.dumps(json_data["country_code3"]).replace('"',"").strip()
-        except KeyError: country_code3= 'N/A'
-        try: country= json.dumps(json_data["country"]).replace('"',"").strip()
-        except KeyError: country= 'N/A'
-        try: city= json.dumps(json_data["city"]).replace('"',"").strip()
-        except KeyError: city= 'N/A'
-        try: region= json.dumps(json_data["region"]).replace('"',"").strip()
-        except KeyError: region= 'N/A'
-        try: region_code= json.dumps(json_data["region_code"]).replace('"',"").strip()
-        except KeyError: region_code= 'N/A'
-        try: lat= json.dumps(json_data["latitude"]).replace('"',"").strip()
-        except KeyError: lat= 'N/A'
-        try: lng= json.dumps(json_data["longitude"]).replace('"',"").strip()
-        except KeyError: lng= 'N/A'
-        try: zip= json.dumps(json_data["postal_code"]).replace('"',"").strip()
-        except KeyError: zip= 'N/A'
-        try: isp= json.dumps(json_data["isp"]).replace('"',"").strip()
-        except KeyError: isp= 'N/A'
-        try: asn= json.dumps(json_data["asn"]).replace('"',"").strip()
-        except KeyError: asn= 'N/A'
-
-        t = [ip, lat, lng, country_code2, country_code3, country, region_code, region,city, zip, asn, isp]
-        ip2loc_list.append(t)
+    def lookup(self, ip):
+        """
+        find the range holding the given ip
+        returns: details of the ip with 12 columns (as GeoRecord)
+        """
+        key = GeoDB.packed(ip)
+        if key is not None:
+            starts, ends, records = self.tables[socket.AF_INET if len(key) == 4 else socket.AF_INET6]
+            i = bisect.bisect_right(starts, key) - 1
+            if i >= 0 and key <= ends[i]:
+                rec = struct.unpack_from(">I", self.buf, records + 4 * i)[0]
+                location = self.locations.get(rec)
+                if location is None:
+                    start, end = struct.unpack_from(">II", self.buf, self.rec_offsets + 4 * rec)
+                    location = GeoRecord([ip] + self.buf[self.rec_blob + start:self.rec_blob + end].split(self.SEP))
+                    self.locations[rec] = location
+                return location.with_ip(ip)
+        return GeoRecord([ip] + ['N/A'] * len(GEO_FIELDS))
+
+    def close(self):
+        self.buf.close()
+        self.f.close()
+
+
+def ip2loc(ip_list=[], workers=1, session=None, cache=None, geodb=None, client=None):
+    """
+    accepts a single ip or list of ip's as a list
+    and get the extra information of the ip address from the geo api
+    (telize.com unless the GeoClient has another provider).
+    the lookups are spread over `workers` threads sharing one pooled session,
+    each asking for as many ip's at once as the provider takes,
+    the order of the results is the order of ip_list.
+    if a GeoCache is passed, only the ip's missing in the cache reach the api.
+    if a GeoDB is passed, the ip's are resolved offline and the api is not used.
+    the requests go through `client` (a GeoClient, made from session if not given).
+    ip's the api does not answer (with json) are left out and not cached,
+    the lookups of the others go on
+    returns: details of the ip with 12 columns (as a list)
+    """
+    if geodb is not None:
+        logger.debug("ip2loc().ip2map.py...resolving %s ips from %s" % (str(len(ip_list)), geodb.path))
+        return [geodb.lookup(ip) for ip in ip_list]
+    logger.debug("ip2loc().ip2map.py...starts getting ip info for %s ips with %d workers" % (str(len(ip_list)), workers))
+    cached = cache.get_many(ip_list) if cache is not None else {}
+    misses = [ip for ip in ip_list if ip not in cached]
+    if misses and client is None:
+        client = GeoClient(session, workers)
+
+    batch_size = client.provider.batch_size if misses else 1
+    batches = [misses[i:i + batch_size] for i in xrange(0, len(misses), batch_size)]
+    results = [None] * len(batches)
+    errors = []     # any other exception, re-raised in the calling thread
+    pending = Queue.Queue()
+    for idx in xrange(len(batches)):
+        pending.put(idx)
+
+    def worker():
+        while not errors:
+            try:
+                idx = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[idx] = client.lookup(batches[idx])
+            except (ValueError, GeoAPIError):
+                pass    # the ip's of the batch are left out
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=worker) for i in xrange(min(workers, len(batches)))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+    fetched = dict((row[0], row) for rows in results if rows is not None for row in rows)
+    if cache is not None and fetched:
+        cache.put_many(fetched.values())
+
+    if len(fetched) < len(misses):
+        logger.error("%d ip's were not answered (first: %s), they are left out" % (len(misses) - len(fetched),
+                     next(ip for ip in misses if ip not in fetched)))
+    ip2loc_list = []
+    for ip in ip_list:
+        row = cached.get(ip) or fetched.get(ip)
+        if row is not None:
+            ip2loc_list.append(row)
     logger.debug("ip2loc().ip2map.py...finished")
     """
     returns:
@@ -237,6 +1276,59 @@ def ip2loc(ip_list=[]):
     """
     return ip2loc_list
 
+def subnet_key(ip, prefix=24, prefix6=48):
+    """
+    the network an ip address belongs to, with the given prefix
+    length for IPv4 and IPv6 addresses
+    returns: network (as str of packed bytes) or the ip itself if it cannot be parsed
+    """
+    try:
+        if ':' in ip:
+            packed, bits = socket.inet_pton(socket.AF_INET6, ip), prefix6
+        else:
+            packed, bits = socket.inet_pton(socket.AF_INET, ip), prefix
+    except socket.error:
+        return ip
+    full, rest = divmod(min(bits, 8 * len(packed)), 8)
+    if rest:
+        return packed[:full] + chr(ord(packed[full]) & (0xff << (8 - rest)) & 0xff)
+    return packed[:full]
+
+
+def coalesce(ip_list, prefix=24, prefix6=48):
+    """
+    group the ip's by subnet so that only one ip per subnet
+    has to be looked up
+    returns: representative ip's (as list), representative of each ip (as dict)
+    """
+    reps = []
+    rep_of = {}
+    by_net = {}
+    for ip in ip_list:
+        net = subnet_key(ip, prefix, prefix6)
+        if net not in by_net:
+            by_net[net] = ip
+            reps.append(ip)
+        rep_of[ip] = by_net[net]
+    return reps, rep_of
+
+
+def uncoalesce(subnets, ip_list, nets):
+    """
+    copy the location columns of the looked up representative of every
+    subnet (subnets: subnet key -> its row) to the ip's in it (nets: the
+    subnet key of every ip), the ipaddress column stays per ip.
+    ip's whose subnet was not found are left out
+    returns: details of the ip's with 12 columns (as a list)
+    """
+    ip2loc_list = []
+    for ip, net in zip(ip_list, nets):
+        row = subnets.get(net)
+        if row is not None:
+            ip2loc_list.append(row.with_ip(ip))
+    return ip2loc_list
+
+
 def print_csv(csv_content, csv_mode=True):
     """
     Prints CSV file to standard output.
@@ -256,269 +1348,1260 @@ def print_csv(csv_content, csv_mode=True):
         print(120*'-')
 
 
-def read_csv_file(fn):
+def read_csv_stream(fn):
     """
-    read the given file:
+    read the given file lazily, one row at a time:
     the given input file MUST have a header
-    returns: headers (as list), number of columns (as int), data (as list of dictionaries)
+    returns: headers (as list), data (as generator of dictionaries)
     """
     logger.debug("Reading from file %s" % fn)
-    infile = fn
-    infile = open(infile, "rU")
+    infile = open(fn, "rU")
     reader = csv.reader(infile)
     headers = reader.next()
-    num_columns = len(headers)
 
-    # Read the column names from the first line of the file
-    csv_lst = []
-    for row in reader:
-        items = dict(zip(headers, row))
-        csv_lst.append(items)
+    def rows():
+        with infile:
+            for row in reader:
+                yield dict(zip(headers, row))
 
-    return headers, num_columns, csv_lst
+    return headers, rows()
 
 
-def file_name(fn):
+def read_csv_file(fn):
     """
-    check to see if given file exists, if it does, return
-    incremented file name
-    returns: as file name format (as string)
+    read the given file:
+    the given input file MUST have a header
+    returns: headers (as list), number of columns (as int), data (as list of dictionaries)
     """
-    _of = ""
-    files = [f for f in os.listdir(".") if re.match(fn,f)]
-    if files:
-        _of = fn + "_%02d" % (len(files)+1)
-    else:
-        _of = fn + "_01"
+    headers, rows = read_csv_stream(fn)
+    return headers, len(headers), list(rows)
 
-    return _of
 
-def touchCSV(fn, csvList, append=False):
+def read_checkpoint(fn):
     """
-    function to write a list as csv to a file
-    returns: none
+    read back the rows of a _data.CSV written by an earlier run, which may
+    have been interrupted: the rows end at the country statistics or at
+    the first row that was cut off
+    returns: header (as list), offset of the end of the header (as int),
+             generator of (row (as list), offset of the end of the row (as int))
     """
-    mode = ("a+b" if append else "wb")
-    with open(fn, mode) as f:
-        writer = csv.writer(f)
-        writer.writerows(csvList)
-
-
-def touch(fn, contents, append=False):
+    logger.debug("Reading checkpoint %s" % fn)
+    infile = open(fn, "rb")
+    line = infile.readline()
+    header = csv.reader([line]).next() if line.endswith("\n") else []
+    start = len(line) if header else 0
+
+    def rows():
+        with infile:
+            offset = start
+            while header:
+                row_line = infile.readline()
+                if not row_line.endswith("\n"):
+                    return  # end of file, or a row cut off by a crash
+                row = csv.reader([row_line]).next()
+                if len(row) != len(header):
+                    return  # the country statistics follow the rows
+                offset += len(row_line)
+                yield row, offset
+
+    return header, start, rows()
+
+
+class FileTail(object):
     """
-    generic function to write to a file with
-    given contents
-    returns: none
+    the lines appended to a growing file, eg: the log of a web server or a
+    firewall. a line is handed out once it is complete; a file that was
+    rotated (another file under the same name) or truncated is read again
+    from its start, after the rest of the old file
     """
-    mode = ("a" if append else "w")
-    f = open(fn, mode)
-    f.write(contents)
-    f.close()
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, "rb")
+        self.inode = os.fstat(self.f.fileno()).st_ino
+        self.offset = 0
+        self.header = None      # the columns of the lines
+        self.has_header = False # the file starts with them, or is one ip per line
+
+    def read_header(self):
+        """
+        wait for the first line of the file and take it as the header if
+        it names the columns, a file of one ip per line has none
+        returns: header (as list)
+        """
+        lines = self.lines(1)
+        while not lines:
+            time.sleep(POLL)
+            lines = self.lines(1)
+        self.has_header = not is_valid_ip(lines[0].strip())
+        if self.has_header:
+            self.header = csv.reader(lines).next()
+        else:
+            self.header = ['ip']
+            self.offset = 0
+        return self.header
 
-def rm(fn):
+    def lines(self, limit=CHUNK_SIZE):
+        """
+        read at most limit of the lines written since the last call
+        returns: the lines, without their line end (as list)
+        """
+        lines = []
+        self.f.seek(self.offset)    # also forgets the end of file seen last time
+        while len(lines) < limit:
+            line = self.f.readline()
+            if not line.endswith("\n"):
+                break   # the end of the file, or a line still being written
+            self.offset += len(line)
+            lines.append(line.rstrip("\r\n"))
+        if not lines:
+            try:
+                st = os.stat(self.path)
+            except OSError:
+                return lines    # rotated, the new file is not there yet
+            if st.st_ino != self.inode:
+                logger.info("%s was rotated, reading the new file" % self.path)
+                self.close()
+                self.f = open(self.path, "rb")
+                self.inode = os.fstat(self.f.fileno()).st_ino
+                self.offset = 0
+            elif st.st_size < self.offset:
+                logger.info("%s was truncated, reading it from the start" % self.path)
+                self.offset = 0
+        return lines
+
+    def close(self):
+        self.f.close()
+
+
+def field_pattern(field, delimiter=None):
     """
-    generic function to remove a file
-    returns: none
+    the regex of an ip in the field-th field (from 1) of a line, the fields
+    split at delimiter or at white space. a match starts at the line end
+    before the line, so re only tries it once per line
+    returns: compiled regex, the ip is its first (IPv4) or second (IPv6) group
     """
-    os.remove(fn)
+    if delimiter is None:
+        skip = r"[ \t]*(?:\S+[ \t]+){%d}\S*?" % (field - 1)
+    else:
+        d = re.escape(delimiter)
+        skip = r"(?:[^%s\n]*%s){%d}[^%s\n]*?" % (d, d, field - 1, d)
+    return re.compile(r"\n%s(?:%s)" % (skip, IP_TEXT))
 
-def main():
+
+def scan_ips(text, pos=0, endpos=None, pattern=None):
     """
-    main function
+    find the ip addresses in text[pos:endpos] (a str or an mmap): all of
+    them, or with a pattern of field_pattern() the ones of that field.
+    candidates that are no ip address (eg: times, version numbers) are
+    left out silently
+    returns: the ip's, once each, IPv4 before IPv6 (as list)
     """
-    all_ips = []
-    processed = []
-    final_processed = []
-    parser = OptionParser()
-    mapHeading = ""
-    mapSubHeading = ""
-    label = ""
-    label_col = 9
-    cols = 0
-    data = 0
-    ip_col_idx=0
-    ip_col_key = 0
-    found_ip_header = False
-    new_csv_header = []
-    csvHeader = ['ipaddress', 'latitude', 'longitude', 'country_code2', 'country_code3', 'country', 'region_code', 'region', 'city', 'postal_code', 'asn', 'isp']
-    file_format = datetime.date.today().strftime("%Y%m%d")
-    parser = OptionParser(usage="usage: %prog <ip_address|file> [options] ", version="%prog v1")
-    parser.add_option("-q","--quiet",action="store_true",dest="quiet_mode",help="execute the program silently",default=False)
-    parser.add_option("--heading", dest="mapHeading",help="Heading for the Map", metavar="HEADING",default="HEAT MAP")
-    parser.add_option("-l","--label", dest="label",help="column name from generated data to label the bubbles, eg: -l col10", metavar="<col_name>",default="")
-    parser.add_option("--sub-heading", dest="mapSubHeading",help="Sub Heading for the Map", metavar="SUB HEADING",default="-- locations this month --")
-    parser.add_option("-u","--ua", dest="UA",help="define a specific user agent you want to use", metavar="UA",default="Mozilla/5.0 (Windows NT 6.3; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/37.0.2049.0 Safari/537.36")
-
-    (options, args) = parser.parse_args()
-    quiet_mode = options.quiet_mode
-    mapHeading = options.mapHeading
-    mapSubHeading = options.mapSubHeading
-    label = options.label
-    UA = options.UA
-    if quiet_mode: logger.setLevel(logging.INFO)
-
-    # check to see if we got a IP Address or a File with batch ip's
-    if len(args) == 1:
-        #1 argument found, check to see if its a IP address
+    if endpos is None:
+        endpos = len(text)
+    if pattern is not None:
+        scans = [(pattern, lambda g: g[0] or g[1])]
+    else:
+        scans = [(IPV4_SCAN, lambda g: "".join(g[:3]) + "." + g[3]), (IPV6_SCAN, lambda g: "".join(g[:5]) + ":" + g[5])]
+    pton, af_inet, af_inet6 = socket.inet_pton, socket.AF_INET, socket.AF_INET6
+    ips = []
+    for scan, ip_of in scans:
+        seen = set()    # of the groups, the ip is only put together for the first one
+        seen_add = seen.add
+        for g in scan.findall(text, pos, endpos):
+            if g not in seen:
+                seen_add(g)
+                ip = ip_of(g)
+                try:
+                    pton(af_inet6 if ":" in ip else af_inet, ip)
+                except socket.error:
+                    continue
+                ips.append(ip)
+    return ips
+
+
+def _scan_block(args):
+    """
+    scan one block of a file for --extract, in a process of its own
+    returns: the ip's of the block (as list)
+    """
+    fn, start, end, field, delimiter = args
+    pattern = field_pattern(field, delimiter) if field else None
+    with open(fn, "rb") as f:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
         try:
-            socket.inet_aton(args[0])
-            all_ips.append(args[0])
-        except socket.error:
-            # not a ip address, but check to see if its a valid file
-            if os.path.isfile(args[0]):
-                # Read from File (mostly batch)
-                logger.debug("Loading file...")
-                # read the ip addresses
-                header, cols, data = read_csv_file(args[0])
-                """
-                get the index of "ip address" field
-                also get the key name @ index
-                """
-                ip_col_idx = 0
-                found_ip_header = False
-                for h in header:
-                    if 'ip' in str(h).lower():
-                        found_ip_header = True
-                        break
-                    ip_col_idx += 1
-                if not found_ip_header:
-                    logger.error("Did not find a header label with 'ip' or 'ip address', etc. Make sure, your file has a header and IP column has label that starts with 'ip'")
-                    sys.exit(1)
-
-                ip_col_key = header[ip_col_idx] # get the column name as in csv file
-                logger.debug("ip address column @ col%d:'%s'" % (ip_col_idx, ip_col_key))
-                data = uniq_list(data, ip_col_key) # make this list of dicts unique based on IP addresses
+            if start == 0 and pattern is not None:
+                # the first line has no line end before it
+                first = m.find("\n", 0, end)
+                first = end if first < 0 else first
+                return scan_ips("\n" + m[:first], pattern=pattern) + scan_ips(m, first, end, pattern)
+            return scan_ips(m, start, end, pattern)
+        finally:
+            m.close()
 
-                # get the ip's from list
-                for i in data:
-                    if is_valid_ip(i[ip_col_key]):
-                        all_ips.append(i[ip_col_key])
-                    else:
-                        logger.error("%s not a valid ip address, ignoring this ip..." % i[ip_col_key])
-                # Got all the ip's from the file
-                logger.debug("Total unique ip's to process: %s" % str(len(all_ips)))
-            else:
-                print "%s is not valid..." % args[0]
-                parser.print_help()
-                sys.exit(0)
-    else:
-        print "No valid ip address or file provided"
-        parser.print_help()
-        sys.exit(0)
 
+def _gzip_blocks(fn):
     """
-    confirm if the ammap.js, ammap.css, worldHigh.svg are present
-    to generate the map
+    decompress a gzip file (also of several members, eg: cat a.gz b.gz)
+    a block of whole lines at a time
+    returns: the blocks, each starting with a line end (as generator of str)
     """
-    # ammap.js
-    if not os.path.isfile("ammap.js"):
-        logger.error("ammap.js not available, cannot generate map.")
-        sys.exit(1)
-
-    # ammap.css
-    if not os.path.isfile("ammap.css"):
-        logger.error("ammap.css not available, cannot generate map.")
-        sys.exit(1)
+    with open(fn, "rb") as f:
+        z = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        rest = ""
+        while True:
+            compressed = f.read(1 << 20)
+            if not compressed:
+                break
+            while compressed:
+                rest += z.decompress(compressed)
+                compressed = z.unused_data
+                if compressed:      # the next member
+                    z = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            if len(rest) >= EXTRACT_BLOCK:
+                end = rest.rfind("\n")
+                if end > 0:
+                    yield "\n" + rest[:end]
+                    rest = rest[end + 1:]
+        rest += z.flush()
+        if rest:
+            yield "\n" + rest
+
+
+def extract_ips(fn, field=0, delimiter=None, processes=1):
+    """
+    pull the ip addresses out of a text file of any format, eg: the logs
+    of nginx, syslog or netflow: all of them or, with field (from 1), the
+    ones in that field of the lines, split at delimiter (white space by
+    default). the bytes of the file are scanned through mmap a block at a
+    time, by processes processes side by side; gzip files are decompressed
+    a block at a time
+    returns: the valid ip's, once each, in the order of the blocks (as generator)
+    """
+    with open(fn, "rb") as f:
+        magic = f.read(2)
+        size = os.fstat(f.fileno()).st_size
+    seen = set()
+    pool = None
+    if magic == "\x1f\x8b":
+        pattern = field_pattern(field, delimiter) if field else None
+        blocks = (scan_ips(block, pattern=pattern) for block in _gzip_blocks(fn))
+    elif size:
+        # blocks of whole lines, every block but the first starts at a line end
+        bounds = []
+        with open(fn, "rb") as f:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            start = 0
+            while start < size:
+                end = m.find("\n", start + EXTRACT_BLOCK) if start + EXTRACT_BLOCK < size else -1
+                end = size if end < 0 else end
+                bounds.append((fn, start, end, field, delimiter))
+                start = end
+            m.close()
+        if processes > 1 and len(bounds) > 1:
+            pool = multiprocessing.Pool(min(processes, len(bounds)))
+            blocks = pool.imap(_scan_block, bounds)
+        else:
+            blocks = itertools.imap(_scan_block, bounds)
+    else:
+        return
+    try:
+        for ips in blocks:
+            metrics.count("ips_extracted", len(ips))
+            for ip in ips:
+                if ip not in seen:
+                    seen.add(ip)
+                    yield ip
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+def extra_columns(header, ip_col_key):
+    """
+    the columns of the input file that get appended to the default 12,
+    in the same order as the keys of the row dictionaries (so that -l colN
+    keeps pointing at the same column)
+    returns: column names (as list)
+    """
+    if len(header) < 2:
+        return []
+    return [h for h in dict.fromkeys(header) if h not in ip_col_key]
 
-    # worldHigh.svg
-    if not os.path.isfile("worldHigh.svg"):
-        logger.error("worldHigh.svg not available, cannot generate map.")
-        sys.exit(1)
 
-    logger.info("Gathering ip\'s information...")
-    processed += ip2loc(all_ips)
-
-    """
-    add the new columns to the corresponding ip's from the dict
-    which was taken from the file
-    """
-    final_processed.append(csvHeader)   # add the csv header
-    if cols > 1:
-        for ip in processed:
-            found = filter(lambda x: x[ip_col_key] == ip[0], data)
-            tmp=[]
-            for dicts in found:
-                for k,v in dicts.iteritems():
-                    if k not in ip_col_key:
-                        tmp.append(v)
-                        # append csv_headers
-                        if k not in new_csv_header: new_csv_header.append(k)
-                final_processed.append(ip + tmp)
-        final_processed[0] += new_csv_header # add the new csv header
-    else:
-        final_processed += processed
+def join_columns(processed, data, ip_col_key, new_csv_header):
+    """
+    add the extra columns of the input rows to the looked up ip's,
+    joined on the ip address through a dictionary index
+    returns: rows with the 12 columns followed by new_csv_header (as list)
+    """
+    index = {}
+    for row in data:
+        index.setdefault(row[ip_col_key], row)
+    joined = []
+    for ip in processed:
+        row = index.get(ip[0])
+        if row is not None:
+            joined.append(ip + [row.get(k, '') for k in new_csv_header])
+    return joined
+
+
+def chunked(iterable, size):
+    """
+    split an iterable into lists of at most size items
+    returns: generator of lists
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
-    del processed   # free processed
-    del data        # free data
 
-    logger.debug("New headers found: %s" % new_csv_header)
+class MapStats(object):
     """
-    understand the bubble labels
-    if user has passed a column number to print as label on map, check and add it
+    the aggregates of the enriched rows that the map needs, so the rows
+    themselves do not have to be kept in memory:
+    ip's per country (heat map), ip's per latitude (bubbles) with the code and
+    label of the first row at that latitude, and the location of each code.
+    rows are counted a chunk at a time; with numpy the per latitude aggregates
+    are kept as columns and merged with vectorized passes
     """
-    if label=="":
-        label_col = 9
-        label = "//label:dataItem.name"
-    else:
-        label_col = int(re.findall(r'\d+',label)[0])
-        if label_col > len(csvHeader):
-            logger.error("Label is using invalid col #: %s. There are only %d columns. Labels are disabled" % (label,len(csvHeader)))
-            label_col = 0
-            label = "//label:dataItem.name"
+    NA = ['', 'N', 'A', '/', 'N/', '/A', 'N/A']    # the keys `key in 'N/A'` leaves out
+
+    def __init__(self, label_col=9):
+        self.label_col = label_col
+        self._countries = {}    # country code -> count
+        self._latlong = {}      # code -> (latitude, longitude)
+        self._lats = {}         # latitude -> count, without numpy
+        self._bubbles = {}      # latitude -> (code, label), without numpy
+        self._lat_cols = None   # latitude, count, country, region code, label columns, with numpy
+        self._bubble_dict = None    # bubbles built from the columns, until the next flush
+        self._pending = []      # rows waiting to be counted together, with numpy
+        self._columns = numpy is not None
+        self.first_seen = None  # latitude -> input row number of its first row, see add_order()
+        self.last_seen = None   # code -> input row number of its last located row
+
+    @property
+    def countries(self):
+        """
+        returns: ip's per country code (as dict)
+        """
+        self.flush()
+        return self._countries
+
+    @property
+    def latlong(self):
+        """
+        returns: latitude and longitude of every bubble code (as dict)
+        """
+        self.flush()
+        return self._latlong
+
+    @property
+    def lats(self):
+        """
+        returns: ip's per latitude (as dict)
+        """
+        self.flush()
+        if self._lat_cols is None:
+            return self._lats
+        return dict(zip(self._lat_cols[0].tolist(), self._lat_cols[1].tolist()))
+
+    @property
+    def bubbles(self):
+        """
+        returns: code and label of the first row of every latitude (as dict)
+        """
+        self.flush()
+        if self._lat_cols is None:
+            return self._bubbles
+        if self._bubble_dict is None:
+            keys, counts, cc, region, label = [c.tolist() for c in self._lat_cols]
+            self._bubble_dict = dict((k, ("%s-%s" % (c, str(r).replace("/","")), l)) for k, c, r, l in zip(keys, cc, region, label))
+        return self._bubble_dict
+
+    def add(self, row):
+        """
+        count an enriched row
+        returns: none
+        """
+        self.add_rows([row])
+
+    def add_rows(self, rows):
+        """
+        count a chunk of enriched rows, with numpy small chunks are
+        collected until AGGREGATE_SIZE rows can be counted at once
+        returns: none
+        """
+        if not rows:
+            return
+        if self._columns:
+            self._pending.extend(rows)
+            if len(self._pending) >= AGGREGATE_SIZE:
+                self.flush()
+            return
+        for row in rows:
+            self._countries[row[3]] = self._countries.get(row[3], 0) + 1
+            self._lats[row[1]] = self._lats.get(row[1], 0) + 1
+            code = "%s-%s" % (row[3], str(row[6]).replace("/",""))
+            if row[1] not in self._bubbles:
+                self._bubbles[row[1]] = (code, row[self.label_col])
+            if row[3] not in 'N/A':
+                self._latlong[code] = (row[1], row[2])
+
+    def add_order(self, rows, positions):
+        """
+        note where the rows counted were in the input (a row number per row,
+        increasing), so that merge() picks the bubble of a latitude and the
+        location of a code that a single process counting the whole input
+        in order would have picked
+        returns: none
+        """
+        if self.first_seen is None:
+            self.first_seen, self.last_seen = {}, {}
+        first, last = self.first_seen, self.last_seen
+        for row, pos in zip(rows, positions):
+            if row[1] not in first:
+                first[row[1]] = pos
+            if row[3] not in 'N/A':
+                last["%s-%s" % (row[3], str(row[6]).replace("/",""))] = pos
+
+    def flush(self):
+        """
+        count the collected rows in vectorized passes
+        returns: none
+        """
+        rows, self._pending = self._pending, []
+        if not rows:
+            return
+        self._bubble_dict = None
+        cc_col, lat_col, region_col = map(itemgetter(3), rows), map(itemgetter(1), rows), map(itemgetter(6), rows)
+        cc = numpy.array(cc_col)
+        regions = numpy.array(region_col)
+
+        keys, cc_idx, counts = numpy.unique(cc, return_inverse=True, return_counts=True)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            self._countries[key] = self._countries.get(key, 0) + count
+
+        # merge the latitudes of the chunk into the sorted columns, the first row of a latitude stays
+        keys, first, counts = numpy.unique(numpy.array(lat_col), return_index=True, return_counts=True)
+        labels = numpy.array([rows[i][self.label_col] for i in first.tolist()])
+        chunk = [keys, counts.astype(numpy.int64), cc[first], regions[first], labels]
+        if self._lat_cols is None:
+            self._lat_cols = chunk
         else:
-            label = "label:dataItem.name"
-            label_col = label_col - 1
-
-    """
-    pivot some statistics with the collected results to prepare
-    for mapping
-    """
-    logger.debug("pivoting of data begins...")
-    # pivot countries
-    countries = [row[3] for row in final_processed[1:]]
-    countryStats=[]
-    b = {}
-    for item in countries:
-        b[item] = b.get(item, 0) + 1
-    for key, value in b.iteritems():
-        temp = [key,value]
-        if not key in 'N/A':  countryStats.append(temp)
-    countryStats = sorted(countryStats, key=itemgetter(1),reverse=True)
-    countryStatsJson = json.dumps([dict(id=cc, value=v) for cc,v in countryStats])
-    areas_heatmap = "areas: " + countryStatsJson
-
-    # pivot latitude's
-    lats = [row[1] for row in final_processed[1:]]
-    latsStats=[]
-    b = {}
-    for item in lats:
-        b[item] = b.get(item, 0) + 1
-    for key, value in b.iteritems():
-        temp = [key,value]
-        if not key in 'N/A':  latsStats.append(temp)
-    latsStats =  sorted(latsStats, key=itemgetter(1),reverse=True)
-
-    latlonData = []
-    for i in final_processed[1:]:
-        if i[3] not in 'N/A':
-            latlonData.append("latlong['%s-%s'] = {'latitude':%s, 'longitude':%s};\n" % (i[3], str(i[6]).replace("/",""), i[1], i[2]))
-
-    """
-    generate the data for displaying bubbles
+            cols = self._lat_cols
+            pos = numpy.searchsorted(cols[0], keys)
+            known = numpy.zeros(len(keys), dtype=bool)
+            inside = pos < len(cols[0])
+            known[inside] = cols[0][pos[inside]] == keys[inside]
+            numpy.add.at(cols[1], pos[known], chunk[1][known])
+            new = ~known
+            if new.any():
+                self._lat_cols = [numpy.insert(old.astype(numpy.promote_types(old.dtype, c.dtype)), pos[new], c[new])
+                                  for old, c in zip(cols, chunk)]
+
+        # the last location of every code wins, as it did in the html:
+        # find the last row of every (country, region) pair, then build the codes of those only
+        located = numpy.nonzero(~numpy.in1d(cc, self.NA))[0]
+        if len(located):
+            keys, region_idx = numpy.unique(regions[located], return_inverse=True)
+            pairs = cc_idx[located] * len(keys) + region_idx
+            pairs, last = numpy.unique(pairs[::-1], return_index=True)
+            for i in sorted(located[len(located) - 1 - last].tolist()):
+                self._latlong["%s-%s" % (cc_col[i], str(region_col[i]).replace("/",""))] = (lat_col[i], rows[i][2])
+
+    def merge(self, other):
+        """
+        add the counts of another MapStats, eg: of a shard of the rows.
+        when both know the input order of their rows (see add_order()), a
+        latitude seen by both gets the code and label of the earlier row and
+        a code seen by both the location of the later one, as if the rows
+        were counted in input order. otherwise a latitude keeps the code and
+        label of self and a code gets the location of other. the merged
+        aggregates are kept as dictionaries from then on
+        returns: none
+        """
+        lats, bubbles = dict(self.lats), dict(self.bubbles)
+        ordered = other.first_seen is not None and (self.first_seen is not None or not lats)
+        first, last = (self.first_seen or {}, self.last_seen or {}) if ordered else (None, None)
+        self._lat_cols = self._bubble_dict = None
+        self._columns = False
+        for key, count in other.countries.iteritems():
+            self._countries[key] = self._countries.get(key, 0) + count
+        other_bubbles = other.bubbles
+        for key, count in other.lats.iteritems():
+            lats[key] = lats.get(key, 0) + count
+            if key not in bubbles or ordered and other.first_seen[key] < first[key]:
+                bubbles[key] = other_bubbles[key]
+                if ordered:
+                    first[key] = other.first_seen[key]
+        self._lats, self._bubbles = lats, bubbles
+        if ordered:
+            for code, location in other.latlong.iteritems():
+                if code not in last or other.last_seen[code] > last[code]:
+                    self._latlong[code] = location
+                    last[code] = other.last_seen[code]
+        else:
+            self._latlong.update(other.latlong)
+        self.first_seen, self.last_seen = first, last
+
+    def country_stats(self):
+        """
+        returns: ip's per country, most first, ties by code (as list of [country_code, count])
+        """
+        stats = [[key, value] for key, value in self.countries.iteritems() if not key in 'N/A']
+        return sorted(sorted(stats), key=itemgetter(1), reverse=True)
+
+    def lats_stats(self):
+        """
+        returns: ip's per latitude, most first, ties by latitude (as list of [latitude, count])
+        """
+        stats = [[key, value] for key, value in self.lats.iteritems() if not key in 'N/A']
+        return sorted(sorted(stats), key=itemgetter(1), reverse=True)
+
+    def map_data(self):
+        """
+        the bubbles of the map, as the mapData entries of the html
+        returns: code, name and number of ip's of every bubble, biggest first (as list of lists)
+        """
+        mapData = []
+        bubbles = self.bubbles
+        for lat, count in self.lats_stats():
+            code, name = bubbles[lat]
+            mapData.append([code, name, int(count)]) # row[5] - label col default
+        return mapData
+
+    def locations(self):
+        """
+        the bubbles with the location they are drawn at (the location of their code),
+        bubbles without a known location are left out
+        returns: (latitude, longitude, count, name) of every bubble, biggest first (as list)
+        """
+        locations = []
+        bubbles, latlong = self.bubbles, self.latlong
+        for lat, count in self.lats_stats():
+            code, name = bubbles[lat]
+            try:
+                lat, lng = latlong[code]
+                locations.append((float(lat), float(lng), count, name))
+            except (KeyError, ValueError):
+                continue
+        return locations
+
+    def latlon_data(self):
+        """
+        the location of every bubble code, once per code, as the latlong of
+        the html. codes without a known location are left out
+        returns: latitude and longitude per code (as dict of code -> [float, float])
+        """
+        latlong = {}
+        for code, (lat, lng) in self.latlong.iteritems():
+            try:
+                latlong[code] = [float(lat), float(lng)]
+            except ValueError:
+                continue
+        return latlong
+
+
+class LiveStats(object):
+    """
+    the aggregates of a followed file, kept up to date as the ip's come
+    in: total counts every ip once, for the data file. with a window of
+    seconds the map only has the ip's seen in that window: they are counted
+    into slices of slice_time seconds and a slice is dropped once all of it
+    is older than the window. an ip is counted once while its slice is in
+    the window, seen again after that it is counted again
+    """
+    def __init__(self, label_col=9, window=0, slice_time=REFRESH):
+        self.label_col = label_col
+        self.window = window
+        self.slice_time = slice_time
+        self.total = MapStats(label_col)
+        self.known = set()                  # ip's in total
+        self.slices = collections.deque()   # (start, MapStats, ip's) in the window, oldest first
+        self.counted = {}                   # ip -> start of the slice it is counted in
+        self.merged = None                  # MapStats of the slices, until they change
+        self.added = 0                      # ip's added to the map since the last draw
+        self.dropped = 0                    # ip's dropped from it since the last draw
+
+    def fresh(self, rows, ip_col_key):
+        """
+        the rows of ip's that are not on the map, once each
+        returns: rows (as list of dictionaries)
+        """
+        on_map = self.counted if self.window else self.known
+        seen = set()
+        fresh = []
+        for row in rows:
+            ip = row[ip_col_key]
+            if ip not in on_map and ip not in seen:
+                seen.add(ip)
+                fresh.append(row)
+        metrics.count("duplicate_rows", len(rows) - len(fresh))
+        return fresh
+
+    def add_rows(self, rows, now):
+        """
+        count the enriched rows of fresh ip's, seen at time now
+        returns: the rows of the ip's that were never counted before (as list)
+        """
+        new = [row for row in rows if row[0] not in self.known]
+        self.known.update(row[0] for row in new)
+        self.total.add_rows(new)
+        self.added += len(rows)
+        if self.window and rows:
+            if not self.slices or now >= self.slices[-1][0] + self.slice_time:
+                self.slices.append((now, MapStats(self.label_col), []))
+            start, stats, ips = self.slices[-1]
+            stats.add_rows(rows)
+            for row in rows:
+                self.counted[row[0]] = start
+                ips.append(row[0])
+            self.merged = None
+        return new
+
+    def expire(self, now):
+        """
+        drop the slices that left the window
+        returns: none
+        """
+        while self.slices and self.slices[0][0] + self.slice_time <= now - self.window:
+            start, stats, ips = self.slices.popleft()
+            for ip in ips:
+                if self.counted.get(ip) == start:
+                    del self.counted[ip]
+            self.dropped += len(ips)
+            self.merged = None
+
+    @property
+    def changed(self):
+        return bool(self.added or self.dropped)
+
+    def map_stats(self):
+        """
+        returns: the aggregates of the map, of the window or of all the ip's (as MapStats)
+        """
+        if not self.window:
+            return self.total
+        if self.merged is None:
+            self.merged = MapStats(self.label_col)
+            for start, stats, ips in self.slices:
+                self.merged.merge(stats)
+        return self.merged
+
+    def on_map(self):
+        """
+        returns: number of ip's on the map (as int)
+        """
+        return len(self.counted) if self.window else len(self.known)
+
+
+def cluster_bubbles(locations, cell=CLUSTER_CELL, max_bubbles=0):
+    """
+    merge the bubbles that fall in the same cell of a latitude/longitude grid
+    of `cell` degrees into one bubble at their weighted center, named after the
+    biggest of them. while more than max_bubbles (if given) are left, the grid is
+    made twice as coarse and the merged bubbles are merged again
+    locations: (latitude, longitude, count, name) of the bubbles
+    returns: merged bubbles, biggest first (as list of (latitude, longitude, count, name))
+    """
+    merged = list(locations)
+    cell = float(cell or CLUSTER_CELL)
+    while True:
+        cells = {}
+        for lat, lng, count, name in merged:
+            key = (math.floor(lat / cell), math.floor(lng / cell))
+            c = cells.get(key)
+            if c is None:
+                cells[key] = [lat * count, lng * count, count, name, count]
+            else:
+                c[0] += lat * count
+                c[1] += lng * count
+                c[2] += count
+                if count > c[4]:
+                    c[3], c[4] = name, count
+        merged = [(cl[0] / cl[2], cl[1] / cl[2], cl[2], cl[3]) for cl in cells.itervalues()]
+        if not max_bubbles or len(merged) <= max_bubbles or cell >= 360:
+            break
+        cell *= 2
+    logger.debug("%d bubbles clustered into %d with a grid of %g degrees" % (len(locations), len(merged), cell))
+    return sorted(merged, key=itemgetter(2), reverse=True)
+
+
+def cluster_map_data(clusters):
     """
+    the mapData entries and latlong of the html for clustered bubbles
+    returns: latitude and longitude per code (as dict), map data (as list of [code, name, count])
+    """
+    latlonData = {}
     mapData = []
-    for i in latsStats:
-        found = filter(lambda x:x[1]==i[0],final_processed)
-        found = '{"code":"%s-%s" , "name":"%s", "value":%d, "color":"#6c00ff"}' %(found[0][3],str(found[0][6]).replace("/",""),
-                                        found[0][label_col],i[1]) # found[0][5] - label col default
-        mapData.append(found)
+    for i, (lat, lng, count, name) in enumerate(clusters):
+        latlonData["C%d" % i] = [round(lat, 4), round(lng, 4)]
+        mapData.append(["C%d" % i, name, int(count)])
+    return latlonData, mapData
 
 
-    logger.debug("amMaps generation")
+def bubble_scale(counts, min_size=10, max_size=40):
+    """
+    scale bubbles between min_size and max_size by their number of ip's,
+    the same way the html does it. with numpy the min/max and the scaling
+    are vectorized passes over the counts
+    returns: sizes (as list of float)
     """
-    AmMaps:: begin
+    if not len(counts):
+        return []
+    if numpy is not None:
+        counts = numpy.asarray(counts, dtype=numpy.float64)
+        low, high = counts.min(), counts.max()
+        return ((counts - low) / (high - low or 1.0) * (max_size - min_size) + min_size).tolist()
+    low, high = min(counts), max(counts)
+    return [(v - low) / float(high - low or 1) * (max_size - min_size) + min_size for v in counts]
+
+
+class WorldMap(object):
     """
-    am_maps_html = """
+    the country shapes of worldHigh.svg and the mercator projection
+    the map is drawn with, read from its amcharts:ammap element.
+    the svg is compiled once into a binary geometry file (SVG_FILE.geo,
+    recompiled when the svg is newer) that is loaded with mmap.
+
+    compiled file layout (little endian):
+        magic, mercator bounds (left, top, right, bottom longitude/latitude as doubles),
+        bounding box of all shapes (x0, y0, x1, y1 as doubles),
+        count of countries, polygons and points (uint32)
+        countries: id offset, id length, title offset, title length,
+                   first polygon, count of polygons (uint32), bounding box (4 float32)
+        polygons: first point, count of points (uint32)
+        points: x, y (float32)
+        strings: the ids and titles
+    """
+    MAGIC = "IP2MSHP1"
+    HEADER = struct.Struct("<8s8d3I")
+    COUNTRY = struct.Struct("<6I4f")
+    PATH = re.compile(r'<path\s[^>]*?id="([^"]+)"[^>]*?title="([^"]*)"[^>]*?\sd="([^"]+)"')
+    PATH_TOKEN = re.compile(r'([MLHVZmlhvz])|(-?(?:\d+\.?\d*|\.\d+)(?:e[-+]?\d+)?)')
+
+    def __init__(self, svg_file="worldHigh.svg"):
+        geo_file = svg_file + ".geo"
+        if not os.path.isfile(geo_file) or os.path.getmtime(geo_file) < os.path.getmtime(svg_file) or not WorldMap.compiled(geo_file):
+            WorldMap.compile(svg_file, geo_file)
+        self.path = geo_file
+        with open(geo_file, "rb") as f:
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header = WorldMap.HEADER.unpack_from(self.buf, 0)
+        if header[0] != WorldMap.MAGIC:
+            raise ValueError("%s is not a compiled world map" % geo_file)
+        self.left, self.top, self.right, self.bottom = header[1:5]
+        self.bbox = header[5:9]
+        n_countries, n_polys, n_points = header[9:12]
+        offset = WorldMap.HEADER.size
+        table = [WorldMap.COUNTRY.unpack_from(self.buf, offset + i * WorldMap.COUNTRY.size) for i in xrange(n_countries)]
+        offset += n_countries * WorldMap.COUNTRY.size
+        self.poly_table = offset
+        self.points_at = offset + n_polys * 8
+        strings = self.points_at + n_points * 8
+        self.countries = {}     # id -> (title, first polygon, count of polygons, bounding box)
+        for id_off, id_len, t_off, t_len, first, count, bx0, by0, bx1, by1 in table:
+            cid = self.buf[strings + id_off:strings + id_off + id_len]
+            title = self.buf[strings + t_off:strings + t_off + t_len]
+            self.countries[cid] = (title, first, count, (bx0, by0, bx1, by1))
+
+    @staticmethod
+    def compiled(geo_file):
+        """
+        returns: True if geo_file is compiled by this version and can be read (as bool)
+        """
+        try:
+            with open(geo_file, "rb") as f:
+                return f.read(len(WorldMap.MAGIC)) == WorldMap.MAGIC
+        except (IOError, OSError):
+            return False
+
+    @staticmethod
+    def compile(svg_file, geo_file):
+        """
+        compile the country shapes of a amMaps svg into the binary geometry file
+        returns: none
+        """
+        logger.info("Compiling world map %s to %s" % (svg_file, geo_file))
+        with open(svg_file, "rb") as f:
+            svg = f.read()
+        bounds = dict(re.findall(r'(leftLongitude|topLatitude|rightLongitude|bottomLatitude)="([-\d.]+)"', svg))
+        countries, polys, points, strings = [], [], array.array('f'), []
+        strings_len = 0
+        for cid, title, d in WorldMap.PATH.findall(svg):
+            shapes = WorldMap.parse_path(d)
+            xs = [x for poly in shapes for x in poly[0::2]]
+            ys = [y for poly in shapes for y in poly[1::2]]
+            countries.append((strings_len, len(cid), strings_len + len(cid), len(title), len(polys), len(shapes),
+                              min(xs), min(ys), max(xs), max(ys)))
+            strings += [cid, title]
+            strings_len += len(cid) + len(title)
+            for poly in shapes:
+                polys.append((len(points) / 2, len(poly) / 2))
+                points.extend(poly)
+        xs, ys = points[0::2], points[1::2]
+        fd, tmp_file = tempfile.mkstemp(".tmp", os.path.basename(geo_file), os.path.dirname(os.path.abspath(geo_file)))
+        os.fchmod(fd, file_mode())  # mkstemp creates it 0600, the geometry is shared like the svg
+        with os.fdopen(fd, "wb") as out:
+            out.write(WorldMap.HEADER.pack(WorldMap.MAGIC, float(bounds['leftLongitude']), float(bounds['topLatitude']),
+                                           float(bounds['rightLongitude']), float(bounds['bottomLatitude']),
+                                           min(xs), min(ys), max(xs), max(ys), len(countries), len(polys), len(points) / 2))
+            for c in countries:
+                out.write(WorldMap.COUNTRY.pack(*c))
+            for p in polys:
+                out.write(struct.pack("<2I", *p))
+            if sys.byteorder != "little":
+                points.byteswap()
+            out.write(points.tostring())
+            out.write("".join(strings))
+        os.rename(tmp_file, geo_file)   # never leave a half written file behind
+
+    @staticmethod
+    def parse_path(d):
+        """
+        turn a svg path made of M, L, H, V, Z commands (absolute or relative)
+        into polygons
+        returns: polygons (as list of flat [x0, y0, x1, y1, ...] lists)
+        """
+        polys = []
+        poly = []
+        x = y = 0.0
+        cmd = 'M'
+        args = []
+        for op, num in WorldMap.PATH_TOKEN.findall(d):
+            if op:
+                cmd = op
+                if op in 'Zz':
+                    if poly:
+                        polys.append(poly)
+                        x, y = poly[0], poly[1]
+                    poly = []
+                continue
+            args.append(float(num))
+            need = 1 if cmd in 'HVhv' else 2
+            if len(args) < need:
+                continue
+            if cmd in 'Mm':
+                if poly:
+                    polys.append(poly)
+                x, y = (x + args[0], y + args[1]) if cmd == 'm' else (args[0], args[1])
+                poly = [x, y]
+                cmd = 'l' if cmd == 'm' else 'L'   # more pairs after a move are lines
+            else:
+                if cmd == 'L': x, y = args
+                elif cmd == 'l': x, y = x + args[0], y + args[1]
+                elif cmd == 'H': x = args[0]
+                elif cmd == 'h': x += args[0]
+                elif cmd == 'V': y = args[0]
+                elif cmd == 'v': y += args[0]
+                if not poly:
+                    poly = [x, y]   # drawing on after a close
+                else:
+                    poly += [x, y]
+            args = []
+        if poly:
+            polys.append(poly)
+        return polys
+
+    def polygons(self, cid):
+        """
+        the polygons of a country, in svg coordinates
+        returns: polygons (as list of flat float32 arrays [x0, y0, x1, y1, ...])
+        """
+        title, first, count, bbox = self.countries[cid]
+        shapes = []
+        for i in xrange(first, first + count):
+            start, n = struct.unpack_from("<2I", self.buf, self.poly_table + 8 * i)
+            poly = array.array('f')
+            poly.fromstring(self.buf[self.points_at + 8 * start:self.points_at + 8 * (start + n)])
+            if sys.byteorder != "little":
+                poly.byteswap()
+            shapes.append(poly)
+        return shapes
+
+    def svg_path(self, cid):
+        """
+        returns: the svg path of a country (as str)
+        """
+        return "".join("M" + "L".join("%.2f,%.2f" % xy for xy in zip(poly[0::2], poly[1::2])) + "z"
+                       for poly in self.polygons(cid))
+
+    def country_at(self, lat, lng):
+        """
+        find the country a latitude/longitude falls in, with an even-odd
+        test over the polygons of the countries whose bounding box holds the point
+        returns: country id (as str) or None
+        """
+        x, y = self.project(lat, lng)
+        for cid, (title, first, count, (x0, y0, x1, y1)) in self.countries.iteritems():
+            if not (x0 <= x <= x1 and y0 <= y <= y1):
+                continue
+            inside = False
+            for poly in self.polygons(cid):
+                px, py = poly[0::2], poly[1::2]
+                j = len(px) - 1
+                for i in xrange(len(px)):
+                    if (py[i] > y) != (py[j] > y) and x < (px[j] - px[i]) * (y - py[i]) / (py[j] - py[i]) + px[i]:
+                        inside = not inside
+                    j = i
+            if inside:
+                return cid
+        return None
+
+    @staticmethod
+    def mercator(lat):
+        lat = max(-89.9, min(89.9, lat))
+        return math.log(math.tan(math.pi / 4 + math.radians(lat) / 2))
+
+    def project(self, lat, lng):
+        """
+        project a latitude/longitude to the coordinates of the svg
+        returns: x, y (as floats)
+        """
+        x0, y0, x1, y1 = self.bbox
+        if lng < self.left:
+            lng += 360  # the map goes past 180 degrees east
+        x = x0 + (lng - self.left) / (self.right - self.left) * (x1 - x0)
+        top, bottom = WorldMap.mercator(self.top), WorldMap.mercator(self.bottom)
+        y = y0 + (top - WorldMap.mercator(lat)) / (top - bottom) * (y1 - y0)
+        return x, y
+
+    def fit(self, width, height, margin=40):
+        """
+        the scale and offset that fit the map into width x height pixels,
+        leaving room for the headings on top
+        returns: scale, dx, dy (as floats)
+        """
+        x0, y0, x1, y1 = self.bbox
+        scale = min((width - 20) / (x1 - x0), (height - margin - 10) / (y1 - y0))
+        return scale, (width - (x1 - x0) * scale) / 2 - x0 * scale, margin - y0 * scale
+
+
+def heat_colors(countryStats, steps=3):
+    """
+    color the countries between the low and high map color by their
+    number of ip's, in `steps` steps like the html does
+    returns: color of every country code (as dict)
+    """
+    if not countryStats:
+        return {}
+    low, high = min(v for cc, v in countryStats), max(v for cc, v in countryStats)
+    c0 = [int(MAP_COLORS['low'][i:i + 2], 16) for i in (1, 3, 5)]
+    c1 = [int(MAP_COLORS['high'][i:i + 2], 16) for i in (1, 3, 5)]
+    colors = {}
+    for cc, v in countryStats:
+        step = min(steps - 1, int((v - low) / float(high - low or 1) * steps))
+        t = step / float(steps - 1) if steps > 1 else 1.0
+        colors[cc] = "#%02X%02X%02X" % tuple(int(a + (b - a) * t) for a, b in zip(c0, c1))
+    return colors
+
+
+def render_svg(world, countryStats, bubbles, heading="", sub_heading="", labels=False, size=MAP_SIZE):
+    """
+    draw the heat map of the countries and the bubbles as a standalone svg
+    bubbles: (latitude, longitude, count, name) of the bubbles
+    returns: svg document (as str)
+    """
+    width, height = size
+    scale, dx, dy = world.fit(width, height)
+    colors = heat_colors(countryStats)
+    esc = lambda t: str(t).replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;")
+    out = ['<?xml version="1.0" encoding="utf-8"?>\n',
+           '<svg xmlns="http://www.w3.org/2000/svg" version="1.1" width="%d" height="%d">\n' % (width, height),
+           '<rect width="100%%" height="100%%" fill="%s"/>\n' % MAP_COLORS['background'],
+           '<text x="%d" y="22" font-family="Verdana" font-size="20" text-anchor="middle">%s</text>\n' % (width / 2, esc(heading)),
+           '<text x="%d" y="36" font-family="Verdana" font-size="10" text-anchor="middle">%s</text>\n' % (width / 2, esc(sub_heading)),
+           '<g transform="matrix(%f,0,0,%f,%f,%f)" stroke="%s" stroke-width="%f">\n' % (scale, scale, dx, dy, MAP_COLORS['outline'], 0.5 / scale)]
+    for cid in sorted(world.countries):
+        title = world.countries[cid][0]
+        out.append('<path id="%s" fill="%s" d="%s"><title>%s</title></path>\n' % (cid, colors.get(cid, MAP_COLORS['unlisted']), world.svg_path(cid), esc(title)))
+    out.append('</g>\n<g fill="%s" fill-opacity="0.4" stroke="%s">\n' % (MAP_COLORS['bubble'], MAP_COLORS['bubble_outline']))
+    for (lat, lng, count, name), r in zip(bubbles, bubble_scale([b[2] for b in bubbles])):
+        x, y = world.project(lat, lng)
+        out.append('<circle cx="%.1f" cy="%.1f" r="%.1f"><title>%s: %d</title></circle>\n' % (x * scale + dx, y * scale + dy, r / 2, esc(name), count))
+        if labels:
+            out.append('<text x="%.1f" y="%.1f" font-family="Verdana" font-size="10" fill="%s" stroke="none">%s</text>\n' % (
+                       x * scale + dx + r / 2 + 2, y * scale + dy + 3, MAP_COLORS['text'], esc(name)))
+    out.append('</g>\n</svg>\n')
+    return ''.join(out)
+
+
+def render_png(world, countryStats, bubbles, heading="", sub_heading="", labels=False, size=MAP_SIZE):
+    """
+    draw the heat map of the countries and the bubbles as a png image,
+    needs the Python Imaging Library (pip install Pillow)
+    bubbles: (latitude, longitude, count, name) of the bubbles
+    returns: png image (as str)
+    """
+    width, height = size
+    scale, dx, dy = world.fit(width, height)
+    colors = heat_colors(countryStats)
+    img = Image.new("RGB", size, MAP_COLORS['background'])
+    draw = ImageDraw.Draw(img)
+    for cid in world.countries:
+        fill = colors.get(cid, MAP_COLORS['unlisted'])
+        for poly in world.polygons(cid):
+            if len(poly) >= 6:
+                draw.polygon([(x * scale + dx, y * scale + dy) for x, y in zip(poly[0::2], poly[1::2])], fill=fill, outline=MAP_COLORS['outline'])
+    overlay = Image.new("RGBA", size, (0, 0, 0, 0))
+    odraw = ImageDraw.Draw(overlay)
+    bubble = tuple(int(MAP_COLORS['bubble'][i:i + 2], 16) for i in (1, 3, 5))
+    outline = tuple(int(MAP_COLORS['bubble_outline'][i:i + 2], 16) for i in (1, 3, 5))
+    for (lat, lng, count, name), r in zip(bubbles, bubble_scale([b[2] for b in bubbles])):
+        x, y = world.project(lat, lng)
+        x, y, r = x * scale + dx, y * scale + dy, r / 2
+        odraw.ellipse((x - r, y - r, x + r, y + r), fill=bubble + (102,), outline=outline + (255,))
+        if labels:
+            odraw.text((x + r + 2, y - 5), str(name), fill=(0, 0, 0, 255))
+    img = Image.alpha_composite(img.convert("RGBA"), overlay)
+    draw = ImageDraw.Draw(img)
+    for text, y in ((heading, 8), (sub_heading, 26)):
+        if text:
+            w = draw.textsize(text)[0]
+            draw.text(((width - w) / 2, y), text, fill=(0, 0, 0, 255))
+    buf = StringIO()
+    img.convert("RGB").save(buf, "PNG")
+    return buf.getvalue()
+
+
+def find_ip_column(header):
+    """
+    get the index of the "ip address" field: the first column
+    that has 'ip' in its name
+    returns: index (as int), -1 if there is none
+    """
+    for idx, h in enumerate(header):
+        if 'ip' in str(h).lower():
+            return idx
+    return -1
+
+
+def valid_rows(rows, ip_col_key, chunk_size=CHUNK_SIZE):
+    """
+    validate and normalize the ip's in batches and leave out the invalid
+    ones, every invalid ip is logged once. private and reserved ip's are
+    kept, the Enricher gives them N/A locations without looking them up
+    returns: the rows with a valid ip, normalized (as generator of dictionaries)
+    """
+    ignored = set()
+    unrouted = set()
+    for batch in chunked(rows, chunk_size):
+        kinds = normalize_ips([i[ip_col_key] for i in batch])
+        metrics.count("rows_read", len(batch))
+        metrics.count("invalid_ips", sum(1 for r in kinds if r[3] == IP_INVALID))
+        metrics.count("ignored_ips", sum(1 for r in kinds if r[3] != IP_INVALID and r[3] != IP_VALID))
+        for i, (ip, version, n, kind) in zip(batch, kinds):
+            if kind != IP_INVALID:
+                if kind != IP_VALID:
+                    unrouted.add(ip)
+                i[ip_col_key] = ip
+                yield i
+            elif ip not in ignored:
+                ignored.add(ip)
+                logger.error("%s not a valid ip address, ignoring this ip..." % ip)
+    if unrouted:
+        logger.info("%d private or reserved ip's, kept without a location" % len(unrouted))
+
+
+def parse_label(label, n_columns):
+    """
+    understand the bubble labels: a column number of the generated
+    data, eg: col10. an empty label names the bubbles after the city
+    returns: index of the label column (as int), amMaps label setting (as str)
+    """
+    if label == "":
+        return 9, "//label:dataItem.name"
+    label_col = int(re.findall(r'\d+', label)[0])
+    if label_col > n_columns:
+        logger.error("Label is using invalid col #: %s. There are only %d columns. Labels are disabled" % (label, n_columns))
+        return 0, "//label:dataItem.name"
+    return label_col - 1, "label:dataItem.name"
+
+
+def find_column(name, header):
+    """
+    a column of the generated data by its name (eg: customer) or number (eg: col13)
+    returns: index of the column (as int), -1 if there is no such column
+    """
+    if name in header:
+        return header.index(name)
+    number = re.match(r'col(\d+)$', name)
+    if number and 0 < int(number.group(1)) <= len(header):
+        return int(number.group(1)) - 1
+    return -1
+
+
+def group_rows(groups, rows, group_col, label_col, positions=None):
+    """
+    count the rows into the MapStats of their group, the value of column
+    group_col, the groups are added to as they show up. positions are the
+    input row numbers of the rows, for MapStats.add_order()
+    returns: none
+    """
+    by_value = {}
+    for i, row in enumerate(rows):
+        by_value.setdefault(row[group_col], []).append(i)
+    for value, idx in by_value.iteritems():
+        if value not in groups:
+            groups[value] = MapStats(label_col)
+        groups[value].add_rows([rows[i] for i in idx])
+        if positions is not None:
+            groups[value].add_order([rows[i] for i in idx], [positions[i] for i in idx])
+
+
+def group_files(base, values):
+    """
+    a file name prefix per group: base_<value>, with what cannot be in a
+    file name replaced, unique also when two values look the same that way
+    returns: prefix per group (as dict of value -> str)
+    """
+    names = {}
+    used = set()
+    for value in sorted(values):
+        name = "%s_%s" % (base, re.sub(r'[^\w.-]+', '_', value).strip('.') or "_")
+        unique, n = name, 1
+        while unique.lower() in used:
+            n += 1
+            unique = "%s_%d" % (name, n)
+        used.add(unique.lower())
+        names[value] = unique
+    return names
+
+
+class Enricher(object):
+    """
+    the lookups of the ip's, kept between runs: an offline GeoDB, or the
+    GeoClient with its GeoCache, the optional subnet coalescing and the
+    locations already known from a previous run (as dict of ip -> row).
+    one Enricher can be shared by threads
+    """
+    def __init__(self, workers=WORKERS, client=None, cache=None, geodb=None, coalesce_prefix=0, coalesce_prefix6=48, known=None):
+        self.workers = workers
+        self.client = client if client is not None else GeoClient(workers=workers)
+        self.cache = cache
+        self.geodb = geodb
+        self.coalesce_prefix = coalesce_prefix
+        self.coalesce_prefix6 = coalesce_prefix6
+        self.known = known or {}
+        self.subnets = {}   # subnet key -> row of the ip looked up for it, when coalescing
+        self.total = 0      # ip's asked for
+        self.new = 0        # of those, not known before
+        self.lookups = 0    # ip's looked up after coalescing
+        self.failed = 0     # ip's without a location
+        self.lock = threading.Lock()
+
+    def lookup(self, ip_list):
+        """
+        look up a chunk of ip's
+        returns: details of the ip's that were found with 12 columns, in the order of ip_list (as a list)
+        """
+        known = self.known
+        new_ips = [ip for ip in ip_list if ip not in known] if known else ip_list
+        # private and reserved ip's get N/A without a lookup, the geo api has nothing on them
+        unrouted = [ip for ip, r in zip(new_ips, normalize_ips(new_ips)) if r[3] == IP_PRIVATE or r[3] == IP_RESERVED]
+        if unrouted:
+            skip = set(unrouted)
+            routed = [ip for ip in new_ips if ip not in skip]
+        else:
+            routed = new_ips
+        if not routed:
+            lookup_ips, processed = [], []
+        elif self.coalesce_prefix:
+            # a subnet is looked up once per Enricher, not once per chunk
+            nets = [subnet_key(ip, self.coalesce_prefix, self.coalesce_prefix6) for ip in routed]
+            net_of = dict(zip(routed, nets))
+            found = {}
+            for net in set(nets):
+                row = self.subnets.get(net)
+                if row is not None:
+                    found[net] = row
+            lookup_ips = coalesce([ip for ip, net in zip(routed, nets) if net not in found],
+                                  self.coalesce_prefix, self.coalesce_prefix6)[0]
+            if lookup_ips:
+                fresh = {}
+                for row in ip2loc(lookup_ips, self.workers, None, self.cache, self.geodb, self.client):
+                    fresh.setdefault(net_of[row[0]], row)
+                with self.lock:
+                    if len(self.subnets) + len(fresh) > SUBNET_LIMIT:
+                        self.subnets.clear()    # a long running serve starts over rather than grow without end
+                    self.subnets.update(fresh)
+                found.update(fresh)
+            processed = uncoalesce(found, routed, nets)
+        else:
+            lookup_ips = routed
+            processed = ip2loc(routed, self.workers, None, self.cache, self.geodb, self.client)
+        if known or unrouted:
+            found = dict((row[0], row) for row in processed)
+            for ip in unrouted:
+                found[ip] = GeoRecord([ip] + ['N/A'] * len(GEO_FIELDS))
+            processed = [known.get(ip) or found[ip] for ip in ip_list if ip in known or ip in found]
+        with self.lock:
+            self.total += len(ip_list)
+            self.new += len(new_ips)
+            self.lookups += len(lookup_ips)
+            self.failed += len(ip_list) - len(processed)
+        metrics.count("ips_looked_up", len(lookup_ips))
+        metrics.count("ips_failed", len(ip_list) - len(processed))
+        return processed
+
+    def log_counters(self):
+        if self.coalesce_prefix:
+            logger.info("Coalescing /%d (IPv6 /%d): %d lookups for %d ips, %d lookups saved" % (self.coalesce_prefix,
+                        self.coalesce_prefix6, self.lookups, self.new, self.new - self.lookups))
+        if self.client.retried:
+            logger.info("Geo api: %d requests retried, %d throttled (429)" % (self.client.retried, self.client.throttled))
+        if self.cache is not None:
+            logger.info("Cache %s: %d hits, %d misses" % (self.cache.path, self.cache.hits, self.cache.misses))
+
+    def close(self):
+        if self.cache is not None:
+            self.cache.close()
+        if self.geodb is not None:
+            self.geodb.close()
+
+
+def make_enricher(options, known=None):
+    """
+    set up the lookups the way the command line options ask for
+    returns: Enricher
+    """
+    cache = None
+    geodb = None
+    workers = max(1, options.workers)
+    provider = PROVIDERS[options.provider](options.api_url or None)
+    if options.geodb:
+        if not os.path.isfile(options.geodb):
+            logger.error("geo database %s not available" % options.geodb)
+            sys.exit(1)
+        geodb = GeoDB(options.geodb)
+    elif not options.no_cache and not provider.local:   # made up locations are not cached
+        cache = GeoCache(options.cache_path, options.cache_ttl, options.cache_size)
+    client = GeoClient(geo_session(workers, options.UA), workers, options.max_rps, options.timeout,
+                       max(0, options.retries), provider=provider)
+    return Enricher(workers, client, cache, geodb, options.coalesce_prefix, options.coalesce_prefix6, known)
+
+
+def map_bubbles(stats, cluster=0, max_bubbles=0):
+    """
+    generate the data for displaying bubbles, merged on a grid
+    if clustering was asked for. bubbles without a known location are left out
+    returns: bubbles (as list of lat, lng, count, name), latlong (as dict of code -> [lat, lng])
+             and map data (as list of [code, name, count]) for amMaps
+    """
+    if cluster or max_bubbles:
+        bubbles = cluster_bubbles(stats.locations(), cluster, max_bubbles)
+        latlonData, mapData = cluster_map_data(bubbles)
+        return bubbles, latlonData, mapData
+    latlonData = stats.latlon_data()
+    return stats.locations(), latlonData, [bubble for bubble in stats.map_data() if bubble[0] in latlonData]
+
+
+AMMAP_HTML = """
         <html>
         <link rel="stylesheet" href="ammap.css" type="text/css">
         <script src="ammap.js" type="text/javascript"></script>
@@ -531,16 +2614,21 @@ def main():
         var min = Infinity;
         var max = -Infinity;
 
-        var latlong = {};
-        %s
+        function loadPayload(url) {
+            var request = new XMLHttpRequest();
+            request.open("GET", url, false);
+            request.send(null);
+            return JSON.parse(request.responseText);
+        }
 
-        var mapData = [
-        %s
-        ]
+        // latlong: code -> [latitude, longitude], mapData: [code, name, value], areas: the heat map
+        var payload = %s;
+        var latlong = payload.latlong;
+        var mapData = payload.bubbles;
 
         // get min and max values
         for (var i = 0; i < mapData.length; i++) {
-            var value = mapData[i].value;
+            var value = mapData[i][2];
             if (value < min) {
                 min = value;
             }
@@ -554,8 +2642,8 @@ def main():
                 function() {
                     map = new AmCharts.AmMap();
 
-                    map.addTitle("%s", 20);
-                    map.addTitle("%s", 10);
+                    map.addTitle(payload.heading, 20);
+                    map.addTitle(payload.sub_heading, 10);
                     map.colorSteps =  3;
 
                     map.areasSettings = {
@@ -587,13 +2675,12 @@ def main():
                     var dataProvider = {
                         mapURL: "worldHigh.svg",
                         images: [],
-
-                        %s
+                        areas: payload.areas
                     }
 
                     // create circle for each country
                     for (var i = 0; i < mapData.length; i++) {
-                        var dataItem = mapData[i];
+                        var dataItem = {code: mapData[i][0], name: mapData[i][1], value: mapData[i][2], color: "#6c00ff"};
                         var value = dataItem.value;
                         // calculate size of a bubble
                         var size = (value - min) / (max - min) * (maxBulletSize - minBulletSize) + minBulletSize;
@@ -607,8 +2694,8 @@ def main():
                             width: size,
                             height: size,
                             color: dataItem.color,
-                            longitude: latlong[id].longitude,
-                            latitude: latlong[id].latitude,
+                            longitude: latlong[id][1],
+                            latitude: latlong[id][0],
                             %s,
                             //scale:0.5,
                             //size:8,
@@ -661,39 +2748,1261 @@ def main():
         </body>
         </html>
     """
-    am_maps_html = am_maps_html % (''.join(latlonData), ','.join(mapData), mapHeading, mapSubHeading, areas_heatmap, label )
-    file_format = file_name("%s" % file_format)
-    logger.debug(file_format)
-    csv_file = "%s_data.CSV" % file_format
-    html_file = "%s_html.html" % file_format
-    png_file = "%s_map.png" % file_format
+
+
+def dump_json(value, **kwargs):
+    """
+    json.dumps(value), the text of an input that is not utf-8 is read as latin-1
+    returns: json (as str)
+    """
+    try:
+        return json.dumps(value, **kwargs)
+    except UnicodeDecodeError:  # extra columns or labels of an input that is not utf-8
+        return json.dumps(value, encoding="latin-1", **kwargs)
+
+
+def map_payload(latlonData, mapData, countryStats, heading="", sub_heading=""):
+    """
+    the data of the amMaps page as one compact json: the location of every
+    bubble code once, the bubbles as [code, name, count], the headings and
+    the heat map of the countries. its size grows with the locations, not the ip's
+    returns: json (as str)
+    """
+    payload = {"latlong": latlonData, "bubbles": mapData, "heading": heading, "sub_heading": sub_heading,
+               "areas": [{"id": cc, "value": int(v)} for cc, v in countryStats]}
+    return dump_json(payload, separators=(",", ":"))
+
+
+def map_html(latlonData, mapData, countryStats, heading="", sub_heading="", label="//label:dataItem.name", data_url=None):
+    """
+    fill in the amMaps page: the bubbles, the headings and the heat map of
+    the countries, as a json the page parses once. with data_url the page
+    loads that json (see map_payload) from there instead of carrying it
+    returns: html (as str)
+    """
+    if data_url:
+        payload = "loadPayload(%s)" % json.dumps(data_url)
+    else:
+        payload = "JSON.parse(%s)" % json.dumps(map_payload(latlonData, mapData, countryStats, heading, sub_heading)).replace("</", "<\\/")
+    return AMMAP_HTML % (payload, label)
+
+
+def gzip_bytes(data, level=6):
+    """
+    returns: data in the gzip format (as str)
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def read_ip_input(text):
+    """
+    read the ip's posted to serve: a csv with a header, like the input
+    files, or just one ip per line
+    returns: headers (as list), data (as generator of dictionaries)
+    """
+    lines = text.splitlines()
+    if not lines or is_valid_ip(lines[0].strip()):
+        return ['ip'], ({'ip': line.strip()} for line in lines if line.strip())
+    reader = csv.reader(lines)
+    headers = reader.next()
+    return headers, (dict(zip(headers, row)) for row in reader)
+
+
+class MapService(ThreadingMixIn, HTTPServer):
+    """
+    ip2map.py serve: answers the requests of a dashboard with the lookups
+    (cache, api sessions or offline database) and the world map kept loaded.
+        POST /enrich?format=json|csv    the ip's (one per line, or a csv with an ip column) with their details
+        POST /map?format=html|svg|png|payload
+                                        the map of the ip's, more parameters:
+                                        heading, sub_heading, label=colN, cluster=DEG, max_bubbles=N
+        GET /health                     counters of the lookups
+    ammap.js, ammap.css and worldHigh.svg are served too, for the html maps
+    answers over 1kB are gzipped when the client accepts it
+    """
+    daemon_threads = True
+    request_queue_size = 64
+
+    def __init__(self, address, enricher, chunk_size=CHUNK_SIZE, world_file="worldHigh.svg"):
+        HTTPServer.__init__(self, address, MapServiceHandler)
+        self.enricher = enricher
+        self.chunk_size = chunk_size
+        self.world_file = world_file if os.path.isfile(world_file) else None
+        if self.world_file:
+            world_map(world_file)   # loaded before the first request
+        self.started = time.time()
+        self.requests = 0
+        self.lock = threading.Lock()    # for requests, counted from the threads of the handlers
+
+    def process(self, text, label=""):
+        """
+        look up the ip's of a request
+        returns: csv header (as list), rows (as list), map statistics (as MapStats), amMaps label setting (as str)
+        """
+        header, rows = read_ip_input(text)   # never parse(), a posted file name must not be opened
+        data = IpData(header, rows, self.chunk_size)
+        label_col, label = parse_label(label, len(data.header))
+        rows = []
+        stats = aggregate((rows.extend(chunk) or chunk for chunk in enrich(data, self.enricher, self.chunk_size)), label_col)
+        return data.header, rows, stats, label
+
+
+class MapServiceHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # keep-alive
+    CONTENT_TYPES = {"json": "application/json", "csv": "text/csv", "html": "text/html",
+                     "svg": "image/svg+xml", "png": "image/png", "js": "application/javascript", "css": "text/css",
+                     "prom": "text/plain; version=0.0.4", "payload": "application/json"}
+    STATIC = ("/ammap.js", "/ammap.css", "/worldHigh.svg")
+
+    def do_GET(self):
+        path = urlparse.urlparse(self.path).path
+        if path == "/health":
+            enricher = self.server.enricher
+            health = {"uptime": round(time.time() - self.server.started, 1), "requests": self.server.requests,
+                      "ips": enricher.total, "lookups": enricher.lookups, "failed": enricher.failed}
+            if enricher.cache is not None:
+                health.update(cache_hits=enricher.cache.hits, cache_misses=enricher.cache.misses)
+            self.reply(200, json.dumps(health), "json")
+        elif path == "/metrics":
+            self.reply(200, metrics.prometheus(), "prom")
+        elif path in self.STATIC and os.path.isfile(path[1:]):
+            with open(path[1:], "rb") as f:
+                self.reply(200, f.read(), path.rsplit(".", 1)[-1])
+        else:
+            self.reply(404, "not found\n", "csv")
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        text = self.rfile.read(int(self.headers.getheader("Content-Length") or 0))
+        with self.server.lock:
+            self.server.requests += 1
+        formats = {"/enrich": ("json", "csv"), "/map": ("html", "svg", "png", "payload")}
+        if url.path not in formats:
+            return self.reply(404, "not found\n", "csv")
+        # all of the request is checked before the ip's are looked up
+        fmt = query.get("format", formats[url.path][0])
+        if fmt not in formats[url.path]:
+            return self.reply(400, "format is one of %s\n" % ", ".join(formats[url.path]), "csv")
+        if fmt in ("svg", "png") and (self.server.world_file is None or (fmt == "png" and Image is None)):
+            return self.reply(503, "%s maps need worldHigh.svg%s\n" % (fmt, " and Pillow" if fmt == "png" else ""), "csv")
+        try:
+            cluster, max_bubbles = float(query.get("cluster", 0)), int(query.get("max_bubbles", 0))
+            if not cluster >= 0 or max_bubbles < 0:     # also a nan cluster
+                raise ValueError("cluster and max_bubbles are at least 0")
+            if query.get("label") and not re.search(r'\d', query["label"]):
+                raise ValueError("label is a column number, eg: col13")
+            header, rows, stats, label = self.server.process(text, query.get("label", ""))
+        except (ValueError, IndexError, csv.Error) as e:
+            return self.reply(400, "%s\n" % e, "csv")
+
+        if fmt == "json":
+            body = dump_json([dict(zip(header, row)) for row in rows])
+        elif fmt == "csv":
+            body = data_csv(header, rows, stats)
+        else:
+            body = render(stats, fmt, query.get("heading", "HEAT MAP"), query.get("sub_heading", ""),
+                          not label.startswith("//"), cluster, max_bubbles, self.server.world_file or "worldHigh.svg")
+        self.reply(200, body, fmt)
+
+    def reply(self, code, body, fmt):
+        self.send_response(code)
+        self.send_header("Content-Type", self.CONTENT_TYPES.get(fmt, "text/plain"))
+        if fmt != "png" and len(body) > 1024 and "gzip" in self.headers.getheader("Accept-Encoding", ""):
+            body = gzip_bytes(body)
+            self.send_header("Content-Encoding", "gzip")
+            self.send_header("Vary", "Accept-Encoding")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("serve: " + format % args)
+
+
+def serve(options):
+    """
+    run ip2map.py as a http service until it is interrupted
+    returns: none
+    """
+    enricher = make_enricher(options)
+    server = MapService((options.host, options.port), enricher, max(1, options.chunk_size))
+    logger.info("Serving on http://%s:%d/ (POST /enrich, POST /map, GET /health)" % server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        enricher.log_counters()
+        enricher.close()
+
+
+class IpData(object):
+    """
+    the ip's of an input on their way through the stages: the column with
+    the ip, the header of the results (the 12 columns of the lookups and
+    the extra columns of the input) and the valid, unique rows as
+    dictionaries (a generator, it can be read once)
+    """
+    def __init__(self, header, rows, chunk_size=CHUNK_SIZE):
+        ip_col_idx = find_ip_column(header)
+        if ip_col_idx < 0:
+            raise ValueError("Did not find a header label with 'ip' or 'ip address', etc. Make sure, your file has a header and IP column has label that starts with 'ip'")
+        self.ip_col_key = header[ip_col_idx]
+        self.new_csv_header = extra_columns(header, self.ip_col_key)
+        self.header = ['ipaddress'] + GEO_FIELDS + self.new_csv_header
+        self.rows = metrics.timed_iter("parse", uniq_stream(valid_rows(rows, self.ip_col_key, chunk_size), self.ip_col_key), chunk_size)
+
+
+def parse(source, chunk_size=CHUNK_SIZE):
+    """
+    the parse stage: read the ip's from a list of ip's, a csv file (file
+    name or file object) with a header, or the text of such a csv or of
+    one ip per line. a single line that is neither a file nor an ip is
+    taken for a file name that does not exist and raises IOError
+    returns: IpData
+    """
+    if isinstance(source, (list, tuple)):
+        return IpData(['ip'], ({'ip': ip} for ip in source), chunk_size)
+    if hasattr(source, "read"):
+        reader = csv.reader(source)
+        header = reader.next()
+        return IpData(header, (dict(zip(header, row)) for row in reader), chunk_size)
+    if "\n" not in source:
+        if os.path.isfile(source):
+            header, rows = read_csv_stream(source)
+            return IpData(header, rows, chunk_size)
+        if not is_valid_ip(source.strip()):
+            raise IOError(errno.ENOENT, "No such file or directory", source)
+    header, rows = read_ip_input(source)
+    return IpData(header, rows, chunk_size)
+
+
+def enrich(data, enricher=None, chunk_size=CHUNK_SIZE):
+    """
+    the enrich stage: look up the ip's of the IpData in chunks and add the
+    extra input columns, through enricher (the telize api by default)
+    returns: generator of chunks of the rows with the columns of data.header (as lists)
+    """
+    if enricher is None:
+        enricher = Enricher()
+    for rows in chunked(data.rows, chunk_size):
+        with metrics.stage("enrich"):
+            processed = enricher.lookup([i[data.ip_col_key] for i in rows])
+            joined = join_columns(processed, rows, data.ip_col_key, data.new_csv_header)
+        yield joined
+
+
+def aggregate(chunks, label_col=9, stats=None):
+    """
+    the aggregate stage: count the chunks of enriched rows for the map,
+    label_col is the column the bubbles are named after
+    returns: MapStats
+    """
+    if stats is None:
+        stats = MapStats(label_col)
+    with metrics.stage("aggregate"):
+        for rows in chunks:     # reading the chunks pauses the stage
+            stats.add_rows(rows)
+        stats.flush()
+    return stats
+
+
+_worlds = {}
+_worlds_lock = threading.Lock()
+
+def world_map(svg_file="worldHigh.svg"):
+    """
+    the WorldMap of svg_file, loaded once per process
+    returns: WorldMap
+    """
+    with _worlds_lock:
+        if svg_file not in _worlds:
+            _worlds[svg_file] = WorldMap(svg_file)
+        return _worlds[svg_file]
+
+
+def render(stats, fmt="svg", heading="HEAT MAP", sub_heading="", labels=False, cluster=0, max_bubbles=0, svg_file="worldHigh.svg",
+           data_url=None):
+    """
+    the render stage: draw the map of the MapStats as svg, png (needs
+    Pillow) or the amMaps html page, which loads its data from data_url if
+    given (the json of the payload format). labels puts the names on the bubbles
+    returns: the map (as str)
+    """
+    with metrics.stage("render_%s" % fmt):
+        bubbles, latlonData, mapData = map_bubbles(stats, cluster, max_bubbles)
+        if fmt == "html":
+            return map_html(latlonData, mapData, stats.country_stats(), heading, sub_heading,
+                            "label:dataItem.name" if labels else "//label:dataItem.name", data_url)
+        if fmt == "payload":
+            return map_payload(latlonData, mapData, stats.country_stats(), heading, sub_heading)
+        if fmt == "svg":
+            return render_svg(world_map(svg_file), stats.country_stats(), bubbles, heading, sub_heading, labels)
+        if fmt == "png":
+            if Image is None:
+                raise ValueError("png maps need the Python Imaging Library (pip install Pillow)")
+            return render_png(world_map(svg_file), stats.country_stats(), bubbles, heading, sub_heading, labels)
+        raise ValueError("Unknown map format %s, use svg, png, html or payload" % fmt)
+
+
+def data_csv(header, rows, stats):
+    """
+    the data file: the header, the enriched rows and the country statistics
+    returns: csv (as str)
+    """
+    buf = StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(header)
+    writer.writerows(rows)
+    writer.writerows(stats.country_stats())
+    return buf.getvalue()
+
+
+class DataWriter(object):
+    """
+    a copy of the data file in another format, written alongside the csv:
+    write() takes the rows as they are looked up, close() the country
+    statistics. the rows go to <base>_data.<ext>, the country statistics
+    to a table of their own
+    """
+    ext = ""
+
+    def __init__(self, base, header):
+        self.header = header
+        self.files = ["%s_data.%s" % (base, self.ext)]
+
+    def write(self, rows):
+        raise NotImplementedError
+
+    def close(self, countryStats):
+        raise NotImplementedError
+
+
+def _float(value):
+    try:
+        return float(value)
+    except ValueError:
+        return float("nan")     # N/A or null of the geo api
+
+
+class JsonlWriter(DataWriter):
+    """
+    one json object per row, streamed; the country statistics go to
+    <base>_countries.jsonl
+    """
+    ext = "jsonl"
+
+    def __init__(self, base, header):
+        DataWriter.__init__(self, base, header)
+        self.files.append("%s_countries.jsonl" % base)
+        self.f = open(self.files[0], "wb")
+
+    def write(self, rows):
+        header = self.header
+        self.f.write("".join(dump_json(dict(zip(header, row))) + "\n" for row in rows))
+
+    def close(self, countryStats):
+        self.f.close()
+        with open(self.files[1], "wb") as f:
+            f.write("".join(json.dumps({"country_code": cc, "count": n}) + "\n" for cc, n in countryStats))
+
+
+class NpzWriter(DataWriter):
+    """
+    numpy arrays in a compressed .npz: latitude and longitude as float64
+    (nan where unknown), ipaddress as bytes, every other column
+    dictionary-encoded as int32 codes in <column> and the distinct values
+    in <column>_values. columns holds the order of the columns and the
+    country statistics are countries_code and countries_count
+    """
+    ext = "npz"
+
+    def __init__(self, base, header):
+        DataWriter.__init__(self, base, header)
+        self.floats = dict((i, array.array('d')) for i, name in enumerate(header) if name in ('latitude', 'longitude'))
+        self.codes = dict((i, (array.array('i'), {})) for i, name in enumerate(header)
+                          if i and i not in self.floats)
+        self.ips = []   # arrays of a chunk each
+
+    def write(self, rows):
+        if not rows:
+            return
+        self.ips.append(numpy.array([row[0] for row in rows], dtype=str))
+        for i, column in self.floats.iteritems():
+            column.extend(_float(row[i]) for row in rows)
+        for i, (codes, values) in self.codes.iteritems():
+            setdefault = values.setdefault
+            codes.extend(setdefault(row[i], len(values)) for row in rows)
+
+    def close(self, countryStats):
+        header = self.header
+        arrays = {"columns": numpy.array(header, dtype=str),
+                  header[0]: numpy.concatenate(self.ips) if self.ips else numpy.array([], dtype=str),
+                  "countries_code": numpy.array([cc for cc, n in countryStats], dtype=str),
+                  "countries_count": numpy.array([n for cc, n in countryStats], dtype=numpy.int64)}
+        for i, column in self.floats.iteritems():
+            arrays[header[i]] = numpy.frombuffer(column, dtype=numpy.float64)
+        for i, (codes, values) in self.codes.iteritems():
+            arrays[header[i]] = numpy.frombuffer(codes, dtype=numpy.int32)
+            arrays[header[i] + "_values"] = numpy.array(sorted(values, key=values.get), dtype=str)
+        with open(self.files[0], "wb") as f:
+            numpy.savez_compressed(f, **arrays)
+
+
+class ParquetWriter(DataWriter):
+    """
+    parquet files through pyarrow: latitude and longitude as double, the
+    other columns as dictionary-encoded strings, written in row groups of
+    ROW_GROUP_SIZE rows. the country statistics go to <base>_countries.parquet
+    """
+    ext = "parquet"
+
+    def __init__(self, base, header):
+        DataWriter.__init__(self, base, header)
+        self.files.append("%s_countries.parquet" % base)
+        self.schema = pyarrow.schema([pyarrow.field(name, pyarrow.float64() if name in ('latitude', 'longitude')
+                                                    else pyarrow.string()) for name in header])
+        self.writer = pyarrow.parquet.ParquetWriter(self.files[0], self.schema, use_dictionary=True)
+        self.pending = []
+
+    def write(self, rows):
+        self.pending.extend(rows)
+        if len(self.pending) >= ROW_GROUP_SIZE:
+            self.flush()
+
+    def flush(self):
+        rows, self.pending = self.pending, []
+        if not rows:
+            return
+        columns = []
+        for i, field in enumerate(self.schema):
+            if field.name in ('latitude', 'longitude'):
+                columns.append(pyarrow.array([_float(row[i]) for row in rows], type=field.type))
+            else:
+                columns.append(pyarrow.array([row[i].decode("utf-8", "replace") for row in rows], type=field.type))
+        self.writer.write_table(pyarrow.Table.from_arrays(columns, schema=self.schema))
+
+    def close(self, countryStats):
+        self.flush()
+        self.writer.close()
+        countries = pyarrow.Table.from_arrays([pyarrow.array([cc.decode("utf-8", "replace") for cc, n in countryStats], type=pyarrow.string()),
+                                               pyarrow.array([n for cc, n in countryStats], type=pyarrow.int64())],
+                                              names=["country_code", "count"])
+        pyarrow.parquet.write_table(countries, self.files[1])
+
+
+OUTPUT_FORMATS = {"jsonl": JsonlWriter, "npz": NpzWriter, "parquet": ParquetWriter}
+
+
+def make_map(source, formats=("csv", "png"), enricher=None, heading="HEAT MAP", sub_heading="", label="",
+             cluster=0, max_bubbles=0, svg_file="worldHigh.svg", chunk_size=CHUNK_SIZE):
+    """
+    all the stages in memory: parse the source (see parse()), look it up,
+    count it and render it. formats can hold csv, json, svg, png and html,
+    label is a column of the results to name the bubbles after (eg: col13).
+    nothing is written to disk, so it can be called from many threads at once
+    returns: the outputs (as dict of format -> str)
+    """
+    data = parse(source, chunk_size)
+    label_col, label = parse_label(label, len(data.header))
+    rows = []
+    stats = aggregate((rows.extend(chunk) or chunk for chunk in enrich(data, enricher, chunk_size)), label_col)
+    outputs = {}
+    for fmt in formats:
+        if fmt == "csv":
+            outputs[fmt] = data_csv(data.header, rows, stats)
+        elif fmt == "json":
+            outputs[fmt] = dump_json([dict(zip(data.header, row)) for row in rows])
+        else:
+            outputs[fmt] = render(stats, fmt, heading, sub_heading, not label.startswith("//"),
+                                  cluster, max_bubbles, svg_file)
+    return outputs
+
+
+def shard_of(ip, n_shards):
+    """
+    the shard of an ip for --processes, the same for all the ways
+    the ip can be written
+    returns: shard number (as int)
+    """
+    ip = ip.strip()
+    try:
+        ip = socket.inet_pton(socket.AF_INET6, ip) if ':' in ip else socket.inet_aton(ip)
+    except (socket.error, ValueError):
+        pass    # not an ip, left out in validation anyway
+    return (zlib.crc32(ip) & 0xffffffff) % n_shards
+
+
+def is_data_header(header):
+    """
+    returns: whether the header is the one of a data file of ip2map.py (as bool)
+    """
+    return header[:len(GEO_FIELDS) + 1] == ['ipaddress'] + GEO_FIELDS
+
+
+def read_known(fn, shard=0, n_shards=1):
+    """
+    the locations of the ip's in a previous data file (of one shard)
+    returns: details of the ip's with 12 columns (as dict of ip -> GeoRecord)
+    """
+    header, start, rows = read_checkpoint(fn)
+    if not is_data_header(header):
+        raise ValueError("%s is not a data file of ip2map.py" % fn)
+    known = {}
+    for row, end in rows:
+        if n_shards == 1 or shard_of(row[0], n_shards) == shard:
+            known[row[0]] = GeoRecord(row[:len(GEO_FIELDS) + 1])
+    return known
+
+
+ROW_NUMBER = ("row",)   # key of the input row number in the rows of a shard, no header name can be it
+
+
+def split_shards(fn, shard_files):
+    """
+    --processes: read the input file once and write every row to the file
+    of its shard (by the hash of its ip), after the header, with the input
+    row number in front
+    returns: none
+    """
+    n_shards = len(shard_files)
+    with open(fn, "rU") as infile:
+        reader = csv.reader(infile)
+        header = reader.next()
+        ip_col_key = header[find_ip_column(header)]
+        ip_idx = len(header) - 1 - header[::-1].index(ip_col_key)   # the column dict(zip()) takes the ip from
+        outs = [open(shard_file, "wb") for shard_file in shard_files]
+        try:
+            writers = [csv.writer(out) for out in outs]
+            for writer in writers:
+                writer.writerow(header)
+            for pos, row in enumerate(reader):
+                ip = row[ip_idx] if len(row) > ip_idx else dict(zip(header, row)).get(ip_col_key)
+                row.insert(0, pos)
+                writers[shard_of(ip or "", n_shards)].writerow(row)
+        finally:
+            for out in outs:
+                out.close()
+
+
+def _read_shard(shard_file):
+    """
+    the rows of one shard written by split_shards(), numbered in the order
+    of the whole input
+    returns: header (as list), data (as generator of dictionaries)
+    """
+    infile = open(shard_file, "rb")
+    reader = csv.reader(infile)
+    header = reader.next()
+
+    def rows():
+        with infile:
+            for row in reader:
+                numbered = dict(zip(header, row[1:]))
+                numbered[ROW_NUMBER] = int(row[0])
+                yield numbered
+
+    return header, rows()
+
+
+def _chunk_positions(rows, ip_col_key, positions):
+    """
+    note the input row number of every (valid, normalized) ip in positions
+    as the rows go by, enrich() reads a chunk of them at a time
+    returns: generator of dictionaries
+    """
+    for row in rows:
+        positions[row[ip_col_key]] = row[ROW_NUMBER]
+        yield row
+
+
+def _run_shard(args):
+    """
+    one process of --processes: validate, look up and count the ip's of
+    one shard of the input file, split off to in_file (also per group of
+    column group_col), and write their rows to shard_file
+    returns: MapStats, counters of the lookups (as dict), Metrics snapshot (as dict), MapStats per group (as dict)
+    """
+    global metrics
+    in_file, shard, n_shards, options, label_col, group_col, shard_file = args
+    metrics = Metrics()     # of this shard only
+    metrics.profile = bool(options.profile)
+    header, rows = _read_shard(in_file)
+    ip_col_key = header[find_ip_column(header)]
+    data = IpData(header, rows, max(1, options.chunk_size))
+    positions = {}      # ip -> input row number, of the chunk being enriched
+    data.rows = _chunk_positions(data.rows, ip_col_key, positions)
+    known = None
+    if options.incremental:
+        with metrics.stage("incremental"):
+            known = read_known(options.incremental, shard, n_shards)
+    enricher = make_enricher(options, known)
+    stats = MapStats(label_col)
+    groups = {}
+    with open(shard_file, "wb") as f:
+        writer = csv.writer(f)
+        for final_processed in enrich(data, enricher, max(1, options.chunk_size)):
+            with metrics.stage("write"):
+                writer.writerows(final_processed)
+            with metrics.stage("aggregate"):
+                order = [positions[row[0]] for row in final_processed]
+                positions.clear()
+                stats.add_rows(final_processed)
+                stats.add_order(final_processed, order)
+                if group_col >= 0:
+                    group_rows(groups, final_processed, group_col, label_col, order)
+    enricher.log_counters()
+    enricher.close()
+    with metrics.stage("aggregate"):
+        stats.flush()
+        for group in groups.itervalues():
+            group.flush()
+    if options.profile:
+        metrics.dump_profiles(options.profile, ".%d" % shard)
+    counters = {"total": enricher.total, "new": enricher.new, "lookups": enricher.lookups, "failed": enricher.failed,
+                "retried": enricher.client.retried, "throttled": enricher.client.throttled}
+    return stats, counters, metrics.snapshot(), groups
+
+
+def run_shards(fn, n_shards, options, label_col, csv_file, csvHeader, writers=(), group_col=-1, groups=None):
+    """
+    --processes: shard the ip's of the input file by hash over n_shards
+    processes, the file is split once and each process takes only its own
+    shard through the stages, then concatenate the rows of the shards into csv_file (and the
+    DataWriters) and merge their statistics (into groups, when grouping
+    by group_col) and metrics. the rate limit is split over the processes
+    returns: MapStats, counters of the lookups (as dict)
+    """
+    shard_dir = tempfile.mkdtemp(prefix=os.path.basename(csv_file) + ".", dir=os.path.dirname(os.path.abspath(csv_file)))
+    shard_options = copy.copy(options)
+    shard_options.max_rps = options.max_rps / float(n_shards)
+    jobs = [(os.path.join(shard_dir, "%d.in.csv" % shard), shard, n_shards, shard_options, label_col, group_col,
+             os.path.join(shard_dir, "%d.csv" % shard)) for shard in xrange(n_shards)]
+    stats = MapStats(label_col)
+    counters = {}
+    try:
+        with metrics.stage("split"):
+            split_shards(fn, [job[0] for job in jobs])
+        pool = multiprocessing.Pool(n_shards)
+        try:
+            results = pool.map(_run_shard, jobs)
+        finally:
+            pool.terminate()
+        with open(csv_file, "wb") as f:
+            csv.writer(f).writerow(csvHeader)
+            for job, (shard_stats, shard_counters, shard_metrics, shard_groups) in zip(jobs, results):
+                with open(job[-1], "rb") as shard:
+                    shutil.copyfileobj(shard, f)
+                if writers:
+                    with open(job[-1], "rb") as shard:
+                        for rows in chunked(csv.reader(shard), max(1, options.chunk_size)):
+                            for writer in writers:
+                                writer.write(rows)
+                stats.merge(shard_stats)
+                metrics.merge(shard_metrics)
+                for value, group in shard_groups.iteritems():
+                    if value in groups:
+                        groups[value].merge(group)
+                    else:
+                        groups[value] = group
+                for key, value in shard_counters.iteritems():
+                    counters[key] = counters.get(key, 0) + value
+            csv.writer(f).writerows(stats.country_stats())
+        for writer in writers:
+            writer.close(stats.country_stats())
+    finally:
+        shutil.rmtree(shard_dir, True)
+    return stats, counters
+
+
+def phantomjs_png(html, png_file):
+    """
+    draw an amMaps page with phantomjs into png_file. the page and the
+    phantomjs script go to a directory of their own, the page finds
+    ammap.js, ammap.css and worldHigh.svg through its base url
+    returns: the png was drawn (as bool)
+    """
+    html = html.replace("<html>", '<html>\n        <base href="%s">' % urlparse.urljoin("file:", urllib.pathname2url(os.getcwd()) + "/"), 1)
+    tmp_dir = tempfile.mkdtemp(prefix="ip2map")
+    html_file = os.path.join(tmp_dir, "map.html")
+    js_file = os.path.join(tmp_dir, "map.js")
     phantom_js = """
         var page = require('webpage').create();
         page.open('%s', function() {
           page.render('%s');
           phantom.exit();
         });
-    """ % (html_file,png_file)
-    touch(html_file,am_maps_html)
-    touch(os.path.join("map.js"),phantom_js)
-    touchCSV(csv_file,final_processed)
-    touchCSV(csv_file,countryStats,True)
+    """ % (html_file, os.path.abspath(png_file))
+    touch(html_file, html)
+    touch(js_file, phantom_js)
     # bring phantomJS to do the png generation:
-    cmd = "phantomjs map.js"
+    cmd = 'phantomjs "%s"' % js_file
     phantom_process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    drawn = False
     try:
-        output, errors = phantom_process.communicate()
-        logger.info("MAP file generated @ %s" % png_file)
+        with metrics.stage("phantomjs"):
+            output, errors = phantom_process.communicate()
+        drawn = True
 
     except Exception as e:
         logger.error("Exception: %s" % e)
         logger.error("Map file could not be generated: Mostly no phantomJS")
         phantom_process.kill()
+    # clean up
+    shutil.rmtree(tmp_dir, True)
+    return drawn
+
+
+def _render_group(args):
+    """
+    draw the map of one group of --group-by: svg and png with the native
+    renderer, png through phantomjs with the other
+    returns: the files written (as list)
+    """
+    stats, base, heading, sub_heading, labels, cluster, max_bubbles, renderer = args
+    if renderer == "phantomjs":
+        phantomjs_png(render(stats, "html", heading, sub_heading, labels, cluster, max_bubbles), "%s_map.png" % base)
+        return ["%s_map.png" % base]
+    files = ["%s_map.svg" % base]
+    touch(files[0], render(stats, "svg", heading, sub_heading, labels, cluster, max_bubbles))
+    if Image is not None:
+        files.append("%s_map.png" % base)
+        with open(files[1], "wb") as f:
+            f.write(render(stats, "png", heading, sub_heading, labels, cluster, max_bubbles))
+    return files
+
+
+def render_groups(groups, names, heading, group_name, labels=False, cluster=0, max_bubbles=0, renderer="native"):
+    """
+    draw the maps of the groups (as dict of value -> MapStats) in parallel,
+    to the files names[value] + _map.svg / _map.png, with "group_name:
+    value" as sub heading. the native renderer runs in a process per cpu,
+    phantomjs, a process of its own, is started from threads
+    returns: the files written (as list)
+    """
+    jobs = [(groups[value], names[value], heading, "%s: %s" % (group_name, value), labels, cluster, max_bubbles, renderer)
+            for value in sorted(groups)]
+    if not jobs:
+        return []
+    if renderer == "phantomjs":
+        pool = ThreadPool(min(len(jobs), WORKERS))
+    else:
+        pool = multiprocessing.Pool(min(len(jobs), multiprocessing.cpu_count()))
+    try:
+        files = pool.map(_render_group, jobs)
+    finally:
+        pool.terminate()
+    return [fn for written in files for fn in written]
+
 
+def draw_maps(stats, base, options, heading, sub_heading, labels, log=logger.info):
+    """
+    draw the map of the MapStats the way the options ask for: base_map.svg
+    and base_map.png natively or base_map.png through phantomjs, and with
+    --html the amMaps page (with --html-data external its data, with --gzip
+    the .gz of both). every file is renamed into place once it is complete,
+    so a page or viewer reloading it never gets half a map
+    returns: none
+    """
+    png_file = "%s_map.png" % base
+    if options.renderer == "native":
+        # draw the map in-process from the worldHigh.svg shapes
+        svg_file = "%s_map.svg" % base
+        replace_file(svg_file, render(stats, "svg", heading, sub_heading, labels, options.cluster, options.max_bubbles))
+        log("SVG MAP file generated @ %s" % svg_file)
+        if Image is None:
+            logger.error("Python Imaging Library not available (pip install Pillow), png map not generated")
+        else:
+            replace_file(png_file, render(stats, "png", heading, sub_heading, labels, options.cluster, options.max_bubbles))
+            log("MAP file generated @ %s" % png_file)
+    else:
+        logger.debug("amMaps generation")
+        tmp_png = "%s_map.tmp.png" % base     # phantomjs picks the format by the extension
+        if phantomjs_png(render(stats, "html", heading, sub_heading, labels, options.cluster, options.max_bubbles), tmp_png):
+            if os.path.isfile(tmp_png):
+                os.rename(tmp_png, png_file)
+            log("MAP file generated @ %s" % png_file)
+
+    if options.html:
+        # the page itself, next to ammap.js, ammap.css and worldHigh.svg
+        files = ["%s_map.html" % base]
+        data_url = None
+        if options.html_data == "external":
+            files.append("%s_map.json" % base)
+            data_url = os.path.basename(files[1])
+            replace_file(files[1], render(stats, "payload", heading, sub_heading, labels, options.cluster, options.max_bubbles))
+        replace_file(files[0], render(stats, "html", heading, sub_heading, labels, options.cluster, options.max_bubbles, data_url=data_url))
+        if options.gzip:
+            for fn in list(files):
+                with open(fn, "rb") as f:
+                    replace_file(fn + ".gz", gzip_bytes(f.read(), 9))
+                files.append(fn + ".gz")
+        log("HTML MAP file generated @ %s" % ", ".join(files))
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def follow(tail, data, enricher, writer, f, writers, options, label_col, heading, sub_heading, labels, base):
+    """
+    --follow: read the lines appended to the FileTail as they come, look up
+    only the ip's that are not on the map yet, write the new ones to the
+    data file and count them into the aggregates. every --refresh seconds
+    the slices that left the --window are dropped and the maps are drawn
+    again if anything changed, until interrupted (Ctrl-C or SIGTERM)
+    returns: LiveStats
+    """
+    refresh = options.refresh
+    live = LiveStats(label_col, options.window, refresh)
+    extract = options.extract or options.field > 0
+    pattern = field_pattern(options.field, options.delimiter or None) if options.field else None
+    header = tail.header
+    ip_col_key = data.ip_col_key
+    chunk_size = max(1, options.chunk_size)
+    signal.signal(signal.SIGTERM, _interrupt)
+    logger.info("Following %s, the map is refreshed every %gs%s" % (tail.path, refresh,
+                ", with the ip's of the last %gs" % live.window if live.window else ""))
+    next_refresh = time.time() + refresh
+    try:
+        while True:
+            lines = tail.lines(chunk_size)
+            if lines:
+                with metrics.stage("parse"):
+                    if extract:
+                        rows = [{'ip': ip} for ip in scan_ips("\n" + "\n".join(lines), pattern=pattern)]
+                    elif tail.has_header:
+                        rows = [dict(zip(header, row)) for row in csv.reader(lines) if row and row != header]
+                    else:
+                        rows = [{'ip': line.strip()} for line in lines if line.strip()]
+                    rows = live.fresh(list(valid_rows(rows, ip_col_key, chunk_size)), ip_col_key)
+                if rows:
+                    with metrics.stage("enrich"):
+                        processed = enricher.lookup([i[ip_col_key] for i in rows])
+                        joined = join_columns(processed, rows, ip_col_key, data.new_csv_header)
+                    with metrics.stage("aggregate"):
+                        new = live.add_rows(joined, time.time())
+                    with metrics.stage("write"):
+                        writer.writerows(new)
+                        f.flush()
+                        for w in writers:
+                            w.write(new)
+            now = time.time()
+            if now >= next_refresh:
+                live.expire(now)
+                if live.changed:
+                    draw_maps(live.map_stats(), base, options, heading, sub_heading, labels, logger.debug)
+                    logger.info("Map refreshed: %d ip's on the map, %d added, %d dropped" % (live.on_map(), live.added, live.dropped))
+                    live.added = live.dropped = 0
+                next_refresh = now + refresh
+            if len(lines) < chunk_size:
+                time.sleep(max(0, min(POLL, next_refresh - time.time())))
+    except KeyboardInterrupt:
+        logger.info("Stopped following %s" % tail.path)
+    finally:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        tail.close()
+    return live
+
+
+def report_metrics(options):
+    """
+    log the time of the stages, write the --metrics file (prometheus text
+    for a .prom file, json otherwise) and the --profile files
+    returns: none
+    """
+    metrics.log_stages()
+    if options.metrics:
+        touch(options.metrics, metrics.prometheus() if options.metrics.endswith(".prom") else
+              json.dumps(metrics.snapshot(), indent=2, sort_keys=True))
+        logger.info("Metrics written @ %s" % options.metrics)
+    if options.profile:
+        for fn in metrics.dump_profiles(options.profile):
+            logger.info("Profile written @ %s" % fn)
+
+
+def file_name(fn, suffix="_data.CSV"):
+    """
+    claim the first free name fn_01, fn_02, ... by creating fn_NN + suffix
+    exclusively, so runs in the same directory never get the same name
+    and the directory does not have to be listed
+    returns: as file name format (as string)
+    """
+    n = 1
+    while True:
+        _of = fn + "_%02d" % n
+        try:
+            os.close(os.open(_of + suffix, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0644))
+            return _of
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        n += 1
+
+def touchCSV(fn, csvList, append=False):
+    """
+    function to write a list as csv to a file
+    returns: none
+    """
+    mode = ("a+b" if append else "wb")
+    with open(fn, mode) as f:
+        writer = csv.writer(f)
+        writer.writerows(csvList)
+
+
+def touch(fn, contents, append=False):
+    """
+    generic function to write to a file with
+    given contents
+    returns: none
+    """
+    mode = ("a" if append else "w")
+    f = open(fn, mode)
+    f.write(contents)
+    f.close()
+
+def file_mode():
+    """
+    returns: the mode open() gives a new file under the umask of the process (as int)
+    """
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+def replace_file(fn, contents):
+    """
+    write contents to a temporary file next to fn and rename it to fn,
+    which so always holds either the old or the new contents
+    returns: none
+    """
+    tmp = "%s.%d.tmp" % (fn, os.getpid())
+    with open(tmp, "wb") as f:
+        f.write(contents)
+    os.rename(tmp, fn)
+
+def rm(fn):
+    """
+    generic function to remove a file
+    returns: none
+    """
+    os.remove(fn)
+
+def main():
+    """
+    main function
+    """
+    parser = OptionParser()
+    mapHeading = ""
+    mapSubHeading = ""
+    label = ""
+    label_col = 9
+    data = 0
+    tail = None
+    ip_col_key = 0
+    file_format = datetime.date.today().strftime("%Y%m%d")
+    parser = OptionParser(usage="usage: %prog <ip_address|file|serve> [options] ", version="%prog v1")
+    parser.add_option("-q","--quiet",action="store_true",dest="quiet_mode",help="execute the program silently",default=False)
+    parser.add_option("--heading", dest="mapHeading",help="Heading for the Map", metavar="HEADING",default="HEAT MAP")
+    parser.add_option("-l","--label", dest="label",help="column name from generated data to label the bubbles, eg: -l col10", metavar="<col_name>",default="")
+    parser.add_option("--sub-heading", dest="mapSubHeading",help="Sub Heading for the Map", metavar="SUB HEADING",default="-- locations this month --")
+    parser.add_option("-u","--ua", dest="UA",help="define a specific user agent you want to use", metavar="UA",default="Mozilla/5.0 (Windows NT 6.3; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/37.0.2049.0 Safari/537.36")
+    parser.add_option("-w","--workers", dest="workers",type="int",help="number of concurrent lookups, default: %d" % WORKERS, metavar="N",default=WORKERS)
+    parser.add_option("--provider", dest="provider",help="geo api to look the ip's up at: telize (one ip per request), ip-api (100 ip's per request) or fake (made up locations, no requests), default: telize", metavar="NAME",default="telize")
+    parser.add_option("--api-url", dest="api_url",help="url of the geo api instead of the provider's own, for telize %s is replaced by the ip address", metavar="URL",default="")
+    parser.add_option("--max-rps", dest="max_rps",type="float",help="at most N requests per second to the geo api, lowered while it throttles, default: unlimited", metavar="N",default=MAX_RPS)
+    parser.add_option("--timeout", dest="timeout",type="float",help="seconds to wait for an answer of the geo api, default: %d" % TIMEOUT, metavar="SECS",default=TIMEOUT)
+    parser.add_option("--retries", dest="retries",type="int",help="retries of a request the geo api throttled (429) or failed (5xx), default: %d" % RETRIES, metavar="N",default=RETRIES)
+    parser.add_option("--cache-path", dest="cache_path",help="sqlite file caching the ip details, default: %s" % CACHE_PATH, metavar="FILE",default=CACHE_PATH)
+    parser.add_option("--cache-ttl", dest="cache_ttl",type="float",help="days before a cached ip is looked up again, default: %d" % CACHE_TTL, metavar="DAYS",default=CACHE_TTL)
+    parser.add_option("--cache-size", dest="cache_size",type="int",help="maximum number of cached ip's, default: %d" % CACHE_SIZE, metavar="N",default=CACHE_SIZE)
+    parser.add_option("--no-cache", action="store_true",dest="no_cache",help="do not use the ip details cache",default=False)
+    parser.add_option("--coalesce-prefix", dest="coalesce_prefix",type="int",help="look up one ip per IPv4 subnet of this prefix length and copy its location to the others, eg: --coalesce-prefix 24", metavar="N",default=0)
+    parser.add_option("--coalesce-prefix6", dest="coalesce_prefix6",type="int",help="prefix length of the IPv6 subnets when coalescing, default: 48", metavar="N",default=48)
+    parser.add_option("--chunk-size", dest="chunk_size",type="int",help="number of ip's looked up and written at a time, default: %d" % CHUNK_SIZE, metavar="N",default=CHUNK_SIZE)
+    parser.add_option("--cluster", dest="cluster",type="float",help="merge the bubbles on a grid of this many degrees, eg: --cluster 1", metavar="DEG",default=0)
+    parser.add_option("--max-bubbles", dest="max_bubbles",type="int",help="make the bubble grid coarser until at most N bubbles are left", metavar="N",default=0)
+    parser.add_option("--renderer", dest="renderer",help="draw the map in-process (native, png needs Pillow) or with phantomjs and amMaps, default: native", metavar="native|phantomjs",default="native")
+    parser.add_option("--geodb", dest="geodb",help="resolve the ip's offline from a geo database csv (compiled once to FILE.idx) or a compiled .idx file", metavar="FILE",default="")
+    parser.add_option("--resume", dest="resume",help="write the data to FILE; if an earlier run left it unfinished, keep its rows and only look up the remaining ip's", metavar="FILE",default="")
+    parser.add_option("--incremental", dest="incremental",help="take the locations of the ip's in a previous _data.CSV from it and only look up the new ip's", metavar="FILE",default="")
+    parser.add_option("--processes", dest="processes",type="int",help="shard the ip's of the input file by hash over N processes, each validating, looking up and counting its own shard, default: 1", metavar="N",default=1)
+    parser.add_option("--html", action="store_true",dest="html",help="also write the amMaps page of the map to <data file>_map.html",default=False)
+    parser.add_option("--html-data", dest="html_data",help="inline: the page carries its data, external: the page loads it from <data file>_map.json, default: inline", metavar="inline|external",default="inline")
+    parser.add_option("--gzip", action="store_true",dest="gzip",help="also write a .gz of the page and its data, for web servers that serve them compressed",default=False)
+    parser.add_option("--extract", action="store_true",dest="extract",help="pull the ip's out of a text file of any format, eg: web server logs or syslog, also gzip compressed, instead of reading a csv",default=False)
+    parser.add_option("--field", dest="field",type="int",help="with --extract only take the ip's in the Nth field of the lines, eg: --field 1 for the clients of a nginx log", metavar="N",default=0)
+    parser.add_option("--delimiter", dest="delimiter",help="with --field split the lines at C instead of at white space, eg: --delimiter ,", metavar="C",default="")
+    parser.add_option("--follow", action="store_true",dest="follow",help="keep reading the lines appended to the file, eg: a log, and refresh the map as new ip's come in, until Ctrl-C",default=False)
+    parser.add_option("--refresh", dest="refresh",type="float",help="seconds between the map refreshes of --follow, default: %d" % REFRESH, metavar="SECS",default=REFRESH)
+    parser.add_option("--window", dest="window",type="float",help="with --follow only map the ip's seen in the last SECS seconds, default: all of them", metavar="SECS",default=0)
+    parser.add_option("--group-by", dest="group_by",help="also draw a map per value of this column of the generated data, by name or number, eg: --group-by customer or --group-by col13", metavar="COL",default="")
+    parser.add_option("--output-format", dest="output_format",help="also write the data as jsonl (one json object per row), npz (numpy arrays) and/or parquet (needs pyarrow), comma separated, eg: --output-format npz,jsonl", metavar="FORMATS",default="")
+    parser.add_option("--metrics", dest="metrics",help="write the time of the stages, the counters and the api latencies to FILE, as prometheus text if FILE ends with .prom, as json otherwise", metavar="FILE",default="")
+    parser.add_option("--profile", dest="profile",help="profile every stage with cProfile, written to DIR/<stage>.prof", metavar="DIR",default="")
+    parser.add_option("--host", dest="host",help="address ip2map.py serve listens on, default: 127.0.0.1", metavar="HOST",default="127.0.0.1")
+    parser.add_option("--port", dest="port",type="int",help="port ip2map.py serve listens on, default: 8080", metavar="PORT",default=8080)
+
+    (options, args) = parser.parse_args()
+    quiet_mode = options.quiet_mode
+    mapHeading = options.mapHeading
+    mapSubHeading = options.mapSubHeading
+    label = options.label
+    UA = options.UA
+    chunk_size = max(1, options.chunk_size)
+    if options.provider not in PROVIDERS:
+        logger.error("Unknown provider %s, use one of %s" % (options.provider, ", ".join(sorted(PROVIDERS))))
+        sys.exit(1)
+    output_formats = [fmt for fmt in options.output_format.split(",") if fmt]
+    for fmt in output_formats:
+        if fmt not in OUTPUT_FORMATS:
+            logger.error("Unknown output format %s, use some of %s" % (fmt, ", ".join(sorted(OUTPUT_FORMATS))))
+            sys.exit(1)
+    if "npz" in output_formats and numpy is None:
+        logger.error("npz output needs numpy (pip install numpy)")
+        sys.exit(1)
+    if "parquet" in output_formats and pyarrow is None:
+        logger.error("parquet output needs pyarrow (pip install pyarrow)")
+        sys.exit(1)
+    extract = options.extract or options.field > 0
+    if options.field < 0 or len(options.delimiter) > 1:
+        logger.error("--field must be a field number from 1 and --delimiter a single character")
+        sys.exit(1)
+    if quiet_mode: logger.setLevel(logging.INFO)
+    metrics.profile = bool(options.profile)
+
+    if args == ["serve"]:
+        serve(options)
+        return
+
+    # check to see if we got a IP Address or a File with batch ip's
+    if len(args) == 1:
+        #1 argument found, check to see if its a IP address
+        if is_valid_ip(args[0]):
+            data = parse([args[0]], chunk_size)
+        else:
+            # not a ip address, but check to see if its a valid file
+            if os.path.isfile(args[0]):
+                # Read from File (mostly batch)
+                logger.debug("Loading file...")
+                try:
+                    if options.follow:
+                        tail = FileTail(args[0])
+                        if extract:
+                            tail.header = ['ip']
+                        data = IpData(tail.header or tail.read_header(), [], chunk_size)
+                    elif extract:
+                        ips = extract_ips(args[0], options.field, options.delimiter or None, max(1, options.processes))
+                        data = IpData(['ip'], ({'ip': ip} for ip in ips), chunk_size)
+                    else:
+                        data = parse(args[0], chunk_size)
+                except ValueError as e:
+                    logger.error(e)
+                    sys.exit(1)
+                logger.debug("ip address column: '%s'" % data.ip_col_key)
+            else:
+                print "%s is not valid..." % args[0]
+                parser.print_help()
+                sys.exit(0)
+    else:
+        print "No valid ip address or file provided"
+        parser.print_help()
+        sys.exit(0)
+    ip_col_key = data.ip_col_key
+    processes = max(1, options.processes) if os.path.isfile(args[0]) and not extract else 1
+    if processes > 1 and options.resume:
+        logger.error("--resume cannot be used with --processes")
+        sys.exit(1)
+    if options.follow:
+        if tail is None:
+            logger.error("--follow needs a file to follow")
+            sys.exit(1)
+        for name, used in (("--processes", processes > 1), ("--resume", options.resume), ("--group-by", options.group_by)):
+            if used:
+                logger.error("%s cannot be used with --follow" % name)
+                sys.exit(1)
+        if options.refresh <= 0 or options.window < 0:
+            logger.error("--refresh must be more than 0 seconds and --window at least 0")
+            sys.exit(1)
+
+    """
+    confirm if the ammap.js, ammap.css, worldHigh.svg are present
+    to generate the map
+    """
+    if options.renderer not in ("native", "phantomjs"):
+        logger.error("Unknown renderer %s, use native or phantomjs" % options.renderer)
+        sys.exit(1)
+    if options.html_data not in ("inline", "external"):
+        logger.error("Unknown --html-data %s, use inline or external" % options.html_data)
+        sys.exit(1)
+
+    # ammap.js
+    if options.renderer == "phantomjs" and not os.path.isfile("ammap.js"):
+        logger.error("ammap.js not available, cannot generate map.")
+        sys.exit(1)
+
+    # ammap.css
+    if options.renderer == "phantomjs" and not os.path.isfile("ammap.css"):
+        logger.error("ammap.css not available, cannot generate map.")
+        sys.exit(1)
+
+    # worldHigh.svg
+    if not os.path.isfile("worldHigh.svg"):
+        logger.error("worldHigh.svg not available, cannot generate map.")
+        sys.exit(1)
+
+    logger.debug("New headers found: %s" % data.new_csv_header)
+    csvHeader = data.header
+    label_col, label = parse_label(label, len(csvHeader))
+    group_col = -1
+    if options.group_by:
+        group_col = find_column(options.group_by, csvHeader)
+        if group_col < 0:
+            logger.error("No column %s to group by, the columns are %s" % (options.group_by, ", ".join(csvHeader)))
+            sys.exit(1)
+
+    if options.resume:
+        csv_file = options.resume
+        if csv_file.endswith("_data.CSV"):
+            file_format = csv_file[:-len("_data.CSV")]
+        else:
+            file_format = os.path.splitext(csv_file)[0]
+    else:
+        file_format = file_name("%s" % file_format)
+        csv_file = "%s_data.CSV" % file_format
+    logger.debug(file_format)
+
+    logger.info("Gathering ip\'s information...")
+    stats = MapStats(label_col)
+    groups = {}     # value of the --group-by column -> MapStats
+    writers = [OUTPUT_FORMATS[fmt](file_format, csvHeader) for fmt in output_formats]
+
+    """
+    incremental run: the ip's of the previous data file keep their
+    location and are not looked up again
+    """
+    known = {}
+    if options.incremental:
+        if not os.path.isfile(options.incremental):
+            logger.error("previous data file %s not available" % options.incremental)
+            sys.exit(1)
+        if not is_data_header(read_checkpoint(options.incremental)[0]):
+            logger.error("%s is not a data file of ip2map.py" % options.incremental)
+            sys.exit(1)
+        if processes == 1:
+            with metrics.stage("incremental"):
+                known = read_known(options.incremental)
+            logger.info("%d ip's known from %s" % (len(known), options.incremental))
+
+    if processes > 1:
+        # every process takes its own shard of the input through the stages
+        with metrics.stage("processes"):
+            stats, counters = run_shards(args[0], processes, options, label_col, csv_file, csvHeader, writers, group_col, groups)
+        logger.debug("Total unique ip's processed: %d" % counters["total"])
+        if options.incremental:
+            logger.info("Incremental: %d of %d ip's were new" % (counters["new"], counters["total"]))
+        if counters["failed"]:
+            logger.error("%d ip's could not be looked up, run again with --incremental %s to look up only those" % (counters["failed"], csv_file))
+    elif options.follow:
+        enricher = make_enricher(options, known)
+        with open(csv_file, "wb") as f:
+            writer = csv.writer(f)
+            writer.writerow(csvHeader)
+            live = follow(tail, data, enricher, writer, f, writers, options, label_col, mapHeading, mapSubHeading,
+                          not label.startswith("//"), file_format)
+            # the data file ends with the statistics of every ip, the map shows the window
+            countryStats = live.total.country_stats()
+            writer.writerows(countryStats)
+            for w in writers:
+                w.close(countryStats)
+        stats = live.map_stats()
+        logger.debug("Total unique ip's processed: %d" % len(live.known))
+        if enricher.failed:
+            logger.error("%d ip's could not be looked up" % enricher.failed)
+        enricher.log_counters()
+        enricher.close()
+    else:
+        enricher = make_enricher(options, known)
+
+        """
+        resumed run: keep the rows an earlier run already wrote to the data
+        file, count them into the map and leave their ip's out
+        """
+        resume_at = 0
+        if options.resume and os.path.isfile(csv_file):
+            done = set()
+            old_header, resume_at, old_rows = read_checkpoint(csv_file)
+            if old_header and old_header != csvHeader:
+                logger.error("%s has other columns than this run would write, cannot resume it" % csv_file)
+                sys.exit(1)
+            with metrics.stage("resume"):
+                for rows in chunked(old_rows, chunk_size):
+                    resume_at = rows[-1][1]
+                    rows = [row for row, end in rows]
+                    done.update(row[0] for row in rows)
+                    stats.add_rows(rows)
+                    if group_col >= 0:
+                        group_rows(groups, rows, group_col, label_col)
+                    for w in writers:
+                        w.write(rows)
+            logger.info("Resuming %s: %d ip's already done" % (csv_file, len(done)))
+            if done:
+                data.rows = (i for i in data.rows if i[ip_col_key] not in done)
+
+        """
+        stream the rows through the lookups in chunks, add the new columns
+        to the corresponding ip's and write them out as they come. every chunk
+        is flushed to the data file, so an interrupted run can be resumed
+        """
+        with open(csv_file, "r+b" if resume_at else "wb") as f:
+            writer = csv.writer(f)
+            if resume_at:
+                f.truncate(resume_at)   # drop the statistics or a row that was cut off
+                f.seek(resume_at)
+            else:
+                writer.writerow(csvHeader)  # add the csv header
+            for final_processed in enrich(data, enricher, chunk_size):
+                with metrics.stage("write"):
+                    writer.writerows(final_processed)
+                    f.flush()
+                    for w in writers:
+                        w.write(final_processed)
+                with metrics.stage("aggregate"):
+                    stats.add_rows(final_processed)
+                    if group_col >= 0:
+                        group_rows(groups, final_processed, group_col, label_col)
+            with metrics.stage("aggregate"):
+                countryStats = stats.country_stats()
+            with metrics.stage("write"):
+                writer.writerows(countryStats)
+                for w in writers:
+                    w.close(countryStats)
+
+        logger.debug("Total unique ip's processed: %d" % enricher.total)
+        if known:
+            logger.info("Incremental: %d of %d ip's were new" % (enricher.new, enricher.total))
+        if enricher.failed:
+            logger.error("%d ip's could not be looked up, run again with --resume %s to look up only those" % (enricher.failed, csv_file))
+        enricher.log_counters()
+        enricher.close()
+
+    labels = not label.startswith("//")
+    draw_maps(stats, file_format, options, mapHeading, mapSubHeading, labels)
+
+    if group_col >= 0:
+        # a map per group, named after the value of the --group-by column
+        logger.info("Drawing %d maps, one per %s" % (len(groups), options.group_by))
+        with metrics.stage("render_groups"):
+            files = render_groups(groups, group_files(file_format, groups), mapHeading, options.group_by, labels,
+                                  options.cluster, options.max_bubbles, options.renderer)
+        for fn in files:
+            logger.info("Group MAP file generated @ %s" % fn)
     logger.info("Data file generated @ %s" % csv_file)
-    # clean up
-    rm("map.js")
-    rm(html_file)
+    for w in writers:
+        logger.info("Data file generated @ %s" % ", ".join(w.files))
+    report_metrics(options)
 
     """
     end of main function
@@ -0,0 +1,177 @@
+#!/usr/bin/python
+"""
+    Tests of ip2map.py, with the made up locations of the fake provider,
+    so that no geo api is needed
+
+    $ python -m unittest -v test_ip2map
+"""
+import os, json, shutil, tempfile, unittest
+import requests
+import ip2map
+
+
+def fake_enricher():
+    """
+    returns: an Enricher looking the ip's up with the fake provider (as Enricher)
+    """
+    return ip2map.Enricher(client=ip2map.GeoClient(provider=ip2map.FakeProvider()))
+
+
+class NotUtf8Test(unittest.TestCase):
+    """
+    an extra input column that is not utf-8 (a latin-1 label) in the json outputs
+    """
+    SOURCE = "ip,label\n8.8.8.8,caf\xe9\n1.1.1.1,bar\n"
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, True)
+
+    def test_make_map_json(self):
+        outputs = ip2map.make_map(self.SOURCE, ("json",), fake_enricher(), label="col13")
+        labels = sorted(row["label"] for row in json.loads(outputs["json"]))
+        self.assertEqual(labels, [u"bar", u"caf\xe9"])
+
+    def test_jsonl_writer(self):
+        base = os.path.join(self.tmp_dir, "out")
+        writer = ip2map.JsonlWriter(base, ["ipaddress", "label"])
+        writer.write([["8.8.8.8", "caf\xe9"]])
+        writer.close([["US", 1]])
+        with open(base + "_data.jsonl") as f:
+            self.assertEqual(json.loads(f.readline())["label"], u"caf\xe9")
+
+
+class UnroutedTest(unittest.TestCase):
+    """
+    IPv4-mapped addresses are looked up as IPv4, private and reserved ip's stay as N/A rows
+    """
+    def test_ipv4_mapped(self):
+        self.assertEqual(ip2map.normalize_ip("::ffff:8.8.8.8"), ("8.8.8.8", 4, 0x08080808, ip2map.IP_VALID))
+        self.assertEqual(ip2map.normalize_ip("::ffff:10.0.0.1")[3], ip2map.IP_PRIVATE)
+
+    def test_private_rows(self):
+        outputs = ip2map.make_map("ip\n8.8.8.8\n10.0.0.1\n::ffff:1.1.1.1\n", ("json",), fake_enricher())
+        rows = dict((row["ipaddress"], row) for row in json.loads(outputs["json"]))
+        self.assertEqual(sorted(rows), ["1.1.1.1", "10.0.0.1", "8.8.8.8"])
+        self.assertEqual(rows["10.0.0.1"]["country_code2"], "N/A")
+        self.assertNotEqual(rows["1.1.1.1"]["country_code2"], "N/A")
+
+
+class ParseTest(unittest.TestCase):
+    """
+    the sources parse() reads
+    """
+    def test_missing_file(self):
+        self.assertRaises(IOError, ip2map.parse, "no_such_ips_2024.csv")
+
+    def test_one_ip(self):
+        self.assertEqual([row["ip"] for row in ip2map.parse("8.8.8.8").rows], ["8.8.8.8"])
+
+
+class GeoDBTest(unittest.TestCase):
+    """
+    the ranges of an offline geo database
+    """
+    HEADER = "start,end,latitude,longitude,country_code2,country_code3,country,region_code,region,city,postal_code,asn,isp\n"
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, True)
+
+    def geodb(self, ranges):
+        fn = os.path.join(self.tmp_dir, "geo.csv")
+        with open(fn, "w") as f:
+            f.write(self.HEADER + "".join("%s,%s,1,2,AU,AUS,Australia,,,,,AS1,%s\n" % r for r in ranges))
+        return ip2map.GeoDB(fn)
+
+    def isp(self, db, ip):
+        return db.lookup(ip)[-1]
+
+    def test_overlap_left_out(self):
+        db = self.geodb([("8.0.0.0", "8.255.255.255", "outer"), ("8.8.8.0", "8.8.8.255", "inner")])
+        self.assertEqual(self.isp(db, "8.8.8.8"), "outer")
+        self.assertEqual(self.isp(db, "8.9.0.1"), "outer")
+
+    def test_ipv6_integers(self):
+        db = self.geodb([(0, (1 << 32) - 1, "low"), (0xffff01000000, 0xffff010000ff, "mapped"),
+                         (0x20010200 << 96, (0x20010201 << 96) - 1, "v6")])
+        self.assertEqual(self.isp(db, "::5"), "low")
+        self.assertEqual(self.isp(db, "1.0.0.5"), "mapped")
+        self.assertEqual(self.isp(db, "2001:200::1"), "v6")
+        self.assertEqual(self.isp(db, "0.0.0.5"), "N/A")
+
+    def test_index_mode(self):
+        db = self.geodb([("8.0.0.0", "8.255.255.255", "outer")])
+        self.assertEqual(os.stat(db.path).st_mode & 0o777, ip2map.file_mode())
+
+
+class MergeTest(unittest.TestCase):
+    """
+    MapStats of shards merged in input order
+    """
+    def test_first_row_wins(self):
+        rows = [ip2map.geo_row(ip, ip2map.fake_geo("7")) + [name] for ip, name in
+                (("1.1.1.1", "first"), ("2.2.2.2", "second"), ("3.3.3.3", "third"))]
+        whole = ip2map.MapStats(12)
+        whole.add_rows(rows)
+        shards = [ip2map.MapStats(12), ip2map.MapStats(12)]
+        for shard, idx in zip(shards, ([1, 2], [0])):
+            shard.add_rows([rows[i] for i in idx])
+            shard.add_order([rows[i] for i in idx], idx)
+        merged = ip2map.MapStats(12)
+        for shard in shards:
+            merged.merge(shard)
+        self.assertEqual(merged.map_data(), whole.map_data())
+        self.assertEqual(merged.map_data()[0][1], "first")
+
+
+class CoalesceTest(unittest.TestCase):
+    """
+    a subnet is looked up once, in whichever chunk it first comes
+    """
+    def test_across_chunks(self):
+        ips = ["10%d.%d.0.%d" % (n // 10, n % 10, i) for i in range(1, 151) for n in range(20)]
+        enricher = ip2map.Enricher(client=ip2map.GeoClient(provider=ip2map.FakeProvider()), coalesce_prefix=24)
+        rows = [row for chunk in ip2map.enrich(ip2map.parse("\n".join(["ip"] + ips), 100), enricher, 100) for row in chunk]
+        self.assertEqual(len(rows), len(ips))
+        self.assertEqual(enricher.lookups, 20)
+        self.assertEqual(rows[-1][0], ips[-1])
+        self.assertEqual(rows[-1][1:], rows[19][1:])
+
+
+class BrokenSession(object):
+    """
+    a session whose every request fails halfway through the answer
+    """
+    def request(self, method, url, **kwargs):
+        raise requests.exceptions.ChunkedEncodingError("connection broken")
+
+
+class GeoClientTest(unittest.TestCase):
+    """
+    failed requests to the geo api
+    """
+    def setUp(self):
+        self.backoff = ip2map.BACKOFF
+        ip2map.BACKOFF = 0
+
+    def tearDown(self):
+        ip2map.BACKOFF = self.backoff
+
+    def test_request_exception_retried(self):
+        client = ip2map.GeoClient(session=BrokenSession(), retries=2)
+        self.assertRaises(ip2map.GeoAPIError, client.lookup, ["8.8.8.8"])
+        self.assertEqual(client.retried, 2)
+
+    def test_negative_retries(self):
+        client = ip2map.GeoClient(session=BrokenSession(), retries=-1)
+        self.assertRaises(ip2map.GeoAPIError, client.lookup, ["8.8.8.8"])
+        self.assertEqual(client.retried, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()